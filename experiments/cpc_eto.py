@@ -0,0 +1,79 @@
+"""Vectorized daily reference ET for the CPC global temperature grids.
+Kept apart from util__getGriddedWeather__cpc_global_temp.py so it can be
+used and tested without that script's plotting and GIS dependencies.
+"""
+import numpy as np
+from multiprocessing import Pool
+
+
+def etoArrays(T_min, T_max, T_mean, lat, doy, z_msl=0.0, K_rs=0.16, alb=0.23, U_2=2.0, max_ETo=15, min_ETo=0):
+	"""Computes daily FAO-56 Penman-Monteith and Hargreaves reference ET in
+	mm from temperatures in degC, latitude in degrees and day of year. The
+	arguments can be arrays of any shape that broadcast together, such as
+	(cells, 1) latitudes against (cells, days) temperatures, and the results
+	have the broadcast shape.
+
+	Everything the temperatures don't give is estimated just as the eto
+	package does for T_min/T_max only input: pressure from elevation, e_a
+	from T_min, R_s from the temperature range (Hargreaves), a wind speed of
+	2 m/s and no soil heat flux. Values are clamped to min_ETo, values over
+	max_ETo become NaN and results are rounded to 2 decimals.
+	"""
+	T_min = np.asarray(T_min, dtype='float64')
+	T_max = np.asarray(T_max, dtype='float64')
+	T_mean = np.asarray(T_mean, dtype='float64')
+	z_msl = np.asarray(z_msl, dtype='float64')
+
+	P = 101.3*((293 - 0.0065*z_msl)/293)**5.26
+	gamma = 0.665e-3*P
+
+	e_max = 0.6108*np.exp(17.27*T_max/(T_max + 237.3))
+	e_min = 0.6108*np.exp(17.27*T_min/(T_min + 237.3))
+	e_s = (e_max + e_min)/2
+	e_a = e_min
+	delta = 4098*(0.6108*np.exp(17.27*T_mean/(T_mean + 237.3)))/((T_mean + 237.3)**2)
+
+	phi = np.asarray(lat, dtype='float64')*np.pi/180
+	doy = np.asarray(doy, dtype='float64')
+	sol_dec = 0.409*np.sin(2*np.pi*doy/365 - 1.39)
+	d_r = 1 + 0.033*np.cos(2*np.pi*doy/365)
+	w_s = np.arccos(-np.tan(phi)*np.tan(sol_dec))
+	R_a = 24*60/np.pi*0.082*d_r*(w_s*np.sin(phi)*np.sin(sol_dec) + np.cos(phi)*np.cos(sol_dec)*np.sin(w_s))
+
+	T_range = np.sqrt(T_max - T_min)
+	R_s = K_rs*T_range*R_a
+	R_so = (0.75 + 2e-5*z_msl)*R_a
+	Rs_Rso = np.where(R_so > 0, np.clip(R_s/np.where(R_so > 0, R_so, 1.0), 0.0, 1.0), 1.0)
+	R_nl = 4.903e-9*(((T_max + 273.16)**4 + (T_min + 273.16)**4)/2)*(0.34 - 0.14*np.sqrt(e_a))*(1.35*Rs_Rso - 0.35)
+	R_n = (1 - alb)*R_s - R_nl
+
+	eto_fao = (0.408*delta*R_n + gamma*900/(T_mean + 273)*U_2*(e_s - e_a))/(delta + gamma*(1 + 0.34*U_2))
+	eto_har = 0.0023*(T_mean + 17.8)*T_range*R_a*0.408
+
+	results = []
+	for eto in (eto_fao, eto_har):
+		eto = np.maximum(eto, min_ETo)
+		eto = np.where(eto > max_ETo, np.nan, eto)
+		results.append(np.round(eto, 2))
+	return results[0], results[1]
+
+
+def _etoChunk(args):
+	return etoArrays(*args)
+
+
+def etoParallel(T_min, T_max, T_mean, lat, doy, z_msl=0.0, chunk_size=1000000, processes=None):
+	"""Same as etoArrays, but splits the work into chunks of chunk_size
+	values that are computed by a pool of processes. Use this for
+	multi-year grids where a single pass would need too much memory.
+	"""
+	arrays = np.broadcast_arrays(*[np.asarray(x, dtype='float64') for x in (T_min, T_max, T_mean, lat, doy, z_msl)])
+	shape = arrays[0].shape
+	flat = [x.ravel() for x in arrays]
+	n = flat[0].size
+	chunks = [tuple(x[i:i + chunk_size] for x in flat) for i in range(0, n, chunk_size)]
+	with Pool(processes) as pool:
+		parts = pool.map(_etoChunk, chunks)
+	eto_fao = np.concatenate([p[0] for p in parts] + [np.zeros(0)]).reshape(shape)
+	eto_har = np.concatenate([p[1] for p in parts] + [np.zeros(0)]).reshape(shape)
+	return eto_fao, eto_har
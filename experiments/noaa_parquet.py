@@ -0,0 +1,200 @@
+"""A bounded partition layout for the NOAA Parquet store.
+
+The original layout partitioned by the h3 index at levels 3, 5, 8, 11 and
+12 and then by year, month and day. Since a level 12 cell holds a single
+grid point, that meant one tiny file per grid point per day. Here the data
+is only partitioned by a coarse spatial key, the level 1 h3 cell (842
+cells cover the globe), and by year:
+
+    <root>/h3_index__L1=<cell>/YYYY=<year>/<name>.parquet
+
+Each write adds one file per partition it touches, named after what was
+written (such as the day), so re-running a day replaces its files instead
+of duplicating rows. `compact` folds the files of each partition into a
+single file sorted by the level 12 h3 index and time, with rows from
+newer files replacing older ones, which keeps the store to a few files per
+partition no matter how many days it holds. The fine h3 indexes stay
+ordinary columns.
+
+Run as a script, this migrates a tree in the original layout into the new
+one or compacts a tree in the new layout.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline'))
+import mrms_h3  # noqa: E402
+
+PARTITION_LEVEL = 1
+PARTITION_COLS = [f"h3_index__L{PARTITION_LEVEL}", "YYYY"]
+OLD_PARTITION_COLS = ['h3_index__L3', 'h3_index__L5', 'h3_index__L8', 'h3_index__L11', 'h3_index__L12',
+                      'YYYY', 'MM', 'DD']
+COMPACTED = "compacted.parquet"
+COMPRESSION = "zstd"
+
+
+def partition_keys(h3_index):
+    """Returns the level PARTITION_LEVEL parents of hex h3 indexes as hex"""
+    cells = np.array([int(x, 16) for x in h3_index], dtype=np.int64)
+    return [format(c, 'x') for c in mrms_h3.parents(cells, PARTITION_LEVEL).tolist()]
+
+
+def sort_keys(columns):
+    keys = ["h3_index__L12"] + (["TS"] if "TS" in columns else ["YYYY", "MM", "DD"])
+    return [k for k in keys if k in columns]
+
+
+def write_partitions(df, root, name, compression=COMPRESSION):
+    """Writes a data frame with an h3_index__L3 (or finer) column and a YYYY
+    column into the partitions of `root`, as a file called `name` in each
+    partition. Returns the number of files written.
+    """
+    df = df.copy()
+    source = "h3_index__L12" if "h3_index__L12" in df.columns else "h3_index__L3"
+    df[PARTITION_COLS[0]] = partition_keys(df[source].astype(str))
+    df["YYYY"] = df["YYYY"].astype(str)
+    n = 0
+    for (cell, year), part in df.groupby(PARTITION_COLS, sort=True):
+        part = part.drop(columns=PARTITION_COLS).sort_values(sort_keys(part.columns), kind="stable")
+        _write(pa.Table.from_pandas(part, preserve_index=False),
+               os.path.join(partition_dir(root, cell, year), name + ".parquet"), compression)
+        n += 1
+    return n
+
+
+def date_columns(df, column="TS"):
+    """Sets the YYYY, MM and DD columns of a data frame from its timestamps,
+    so that every row is filed under the year of the day it is labelled
+    with, also where a chunk of days crosses the end of a year."""
+    ts = df[column].dt
+    df["YYYY"] = ts.year.astype(str)
+    df["MM"] = ts.month.astype(str).str.zfill(2)
+    df["DD"] = ts.day.astype(str).str.zfill(2)
+    return df
+
+
+def partition_dir(root, cell, year):
+    return os.path.join(root, f"{PARTITION_COLS[0]}={cell}", f"YYYY={year}")
+
+
+def _write(table, fname, compression):
+    """Writes a table via a temporary file so readers never see a partial file"""
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp, compression=compression)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def partitions(root):
+    """Lists the partition directories under `root`"""
+    result = []
+    for a in sorted(os.listdir(root)):
+        if a.startswith(PARTITION_COLS[0] + "="):
+            for b in sorted(os.listdir(os.path.join(root, a))):
+                if b.startswith("YYYY="):
+                    result.append(os.path.join(root, a, b))
+    return result
+
+
+def compact_partition(dir, compression=COMPRESSION):
+    """Rewrites all files in a partition as one sorted file. Where files
+    hold the same grid point and day, as when a day is written again after
+    compaction, the newest file wins. Returns the number of files that
+    were folded together."""
+    files = [f for f in os.listdir(dir) if f.endswith(".parquet") and not f.startswith(".") and f != COMPACTED]
+    files.sort(key=lambda f: (os.stat(os.path.join(dir, f)).st_mtime_ns, f))
+    if os.path.exists(os.path.join(dir, COMPACTED)):
+        files.insert(0, COMPACTED)
+    if len(files) == 1 and files[0] != COMPACTED:
+        os.replace(os.path.join(dir, files[0]), os.path.join(dir, COMPACTED))
+    if len(files) < 2:
+        return 0
+    df = pd.concat([pq.read_table(os.path.join(dir, f)).to_pandas() for f in files], ignore_index=True)
+    keys = sort_keys(df.columns)
+    df = df.drop_duplicates(subset=keys, keep="last").sort_values(keys, kind="stable")
+    _write(pa.Table.from_pandas(df, preserve_index=False), os.path.join(dir, COMPACTED), compression)
+    for f in files:
+        if f != COMPACTED:
+            os.remove(os.path.join(dir, f))
+    return len(files)
+
+
+def compact(root, workers=4, years=None):
+    """Compacts every partition under `root`, or those of some `years`, with
+    a pool of `workers` processes"""
+    t0 = time.time()
+    dirs = partitions(root)
+    if years is not None:
+        dirs = [d for d in dirs if os.path.basename(d) in {f"YYYY={y}" for y in years}]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        folded = sum(pool.map(compact_partition, dirs))
+    print(f"compacted {folded} files in {len(dirs)} partitions in {time.time() - t0:.1f}s")
+    return folded
+
+
+def migrate(source, dest, batch_rows=5_000_000, workers=4):
+    """Copies a tree in the original layout into the new layout under
+    `dest` and compacts the result. The source is scanned as one dataset
+    and written out every `batch_rows` rows, so memory use stays bounded
+    however large the source is.
+    """
+    t0 = time.time()
+    schema = pa.schema([(c, pa.string()) for c in OLD_PARTITION_COLS])
+    dataset = ds.dataset(source, format="parquet", partitioning=ds.partitioning(schema, flavor="hive"))
+    pending, rows, k = [], 0, 0
+    for batch in dataset.to_batches():
+        pending.append(batch)
+        rows += batch.num_rows
+        if rows >= batch_rows:
+            write_partitions(pa.Table.from_batches(pending).to_pandas(), dest, f"migrated-{k:05d}")
+            pending, rows, k = [], 0, k + 1
+    if pending:
+        write_partitions(pa.Table.from_batches(pending).to_pandas(), dest, f"migrated-{k:05d}")
+    print(f"migrated {source} in {time.time() - t0:.1f}s")
+    compact(dest, workers)
+
+
+def read_partitions(root, cells=None, years=None, columns=None):
+    """Reads the rows of the given level 1 cells (hex) and years from the
+    store, touching only the matching partitions."""
+    schema = pa.schema([(c, pa.string()) for c in PARTITION_COLS])
+    dataset = ds.dataset(root, format="parquet", partitioning=ds.partitioning(schema, flavor="hive"),
+                         exclude_invalid_files=False, ignore_prefixes=["."])
+    filter = None
+    if cells is not None:
+        filter = ds.field(PARTITION_COLS[0]).isin(list(cells))
+    if years is not None:
+        f = ds.field("YYYY").isin([str(y) for y in years])
+        filter = f if filter is None else filter & f
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Migrate or compact the NOAA Parquet store')
+    parser.add_argument("command", choices=["migrate", "compact"])
+    parser.add_argument("--source", help="Tree in the original layout (migrate only)")
+    parser.add_argument("--dest", help="Tree in the new layout")
+    parser.add_argument("--workers", default=4, help="Number of partitions to compact in parallel. Default is 4")
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate(args.source, args.dest, workers=int(args.workers))
+    else:
+        compact(args.dest, workers=int(args.workers))
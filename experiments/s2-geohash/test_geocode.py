@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv
+
+import geocode
+import mrms_h3  # noqa: E402, on the path set up by geocode
+
+
+def test_geohash():
+    # the example of geohash.org and the one on Wikipedia
+    codes = geocode.geohashes([57.64911], [10.40744], 11)
+    assert list(geocode.geohash_text(codes, 11)) == ["u4pruydqqvj"]
+    assert list(geocode.geohash_text(geocode.geohashes([42.6], [-5.6], 5), 5)) == ["ezs42"]
+    # a shorter geohash is a prefix, so the integers sort the same way
+    assert geocode.geohashes([57.64911], [10.40744], 5)[0] == codes[0] >> 30
+
+
+def test_s2():
+    # the centers of the six faces, as in the S2 FaceDefinitions test
+    lats = [0, 0, 90, 0, 0, -90]
+    lons = [0, 90, 0, 180, -90, 0]
+    faces = geocode.s2_cells(lats, lons, 0)
+    assert [int(x) >> 61 for x in faces] == list(range(6))
+    assert [format(int(x), "x").rstrip("0") for x in faces] == ["1", "3", "5", "7", "9", "b"]
+
+    # a leaf cell published with s2sphere (Porto Alegre), and its parents,
+    # which keep the leading 2 * level bits after the face
+    leaf = 10743750136202470315
+    assert format(leaf, "x") == "951977d377e723ab"
+    for level in [30, 24, 16, 10, 5, 1]:
+        lsb = 1 << (2 * (30 - level))
+        want = (leaf & ~(lsb - 1) & (2 ** 64 - 1)) | lsb
+        assert int(geocode.s2_cells([-30.0438], [-51.14022], level)[0]) == want, level
+    assert format(int(geocode.s2_cells([-30.0438], [-51.14022], 10)[0]), "x").rstrip("0") == "951977"
+    # New York City is under the well known 89c25 prefix
+    assert format(int(geocode.s2_cells([40.7128], [-74.006], 30)[0]), "x").startswith("89c25")
+
+
+def test_h3():
+    lats, lons = np.meshgrid(np.linspace(40.0, 41.0, 20), np.linspace(-94.0, -93.0, 30), indexing="ij")
+    lats, lons = lats.reshape(-1), lons.reshape(-1)
+    assert (geocode.cell_ids(lats, lons, "h3", 12) == mrms_h3.cells(lats, lons, 12)).all()
+    # the cache keeps the finest ids and truncates them, like the pipeline
+    cached = geocode.cell_ids(lats, lons, "h3", 12, grid_cache=tempfile.mkdtemp())
+    assert (cached == mrms_h3.parents(mrms_h3.cells(lats, lons), 12)).all()
+
+
+def test_geocode_day():
+    rng = np.random.default_rng(3)
+    folder = tempfile.mkdtemp()
+    files = []
+    for hour in range(3):
+        n = 200
+        table = pa.table(dict(latitude=rng.uniform(25, 50, n), longitude=rng.uniform(-125, -65, n),
+                              datetime=np.full(n, hour, dtype=np.int64), precipitation=rng.exponential(1.0, n)))
+        files.append(os.path.join(folder, f"{hour:02d}.csv"))
+        csv.write_csv(table, files[-1])
+
+    for scheme, level in [("s2", 30), ("geohash", 7), ("h3", 9)]:
+        day = geocode.geocode_day(files, scheme, level, workers=2)
+        assert day.num_rows == 600
+        ids = day.column(f"{scheme}_{level}").to_numpy()
+        # the appended column went through the sort with the rows it belongs to
+        want = geocode.cell_ids(day.column("latitude").to_numpy(), day.column("longitude").to_numpy(), scheme, level)
+        assert (ids == want).all()
+        keys = list(zip(ids.tolist(), day.column("datetime").to_pylist()))
+        assert keys == sorted(keys)
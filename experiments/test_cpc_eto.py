@@ -0,0 +1,56 @@
+import numpy as np
+from eto import ETo
+
+from cpc_eto import etoArrays, etoParallel
+
+# both are rounded to 2 decimals, so they may differ by one in the last
+TOLERANCE = 0.011
+
+# lat, day of year, T_min, T_max: summer and winter in both hemispheres,
+# the tropics, high latitudes and a frost day
+CELLS = [
+    (41.5, 180, 15.0, 30.0),
+    (41.5, 15, -6.0, 3.0),
+    (-33.9, 15, 18.0, 29.0),
+    (-33.9, 190, 7.0, 16.0),
+    (0.5, 270, 22.0, 31.0),
+    (60.2, 100, -2.0, 8.0),
+    (45.0, 355, -8.0, 1.0),
+]
+
+
+def reference(lat, doy, t_min, t_max):
+    # the per-row computation the vectorized one replaced
+    et = ETo()
+    et.param_est({"T_min": np.array([t_min]), "T_max": np.array([t_max])}, "D", 0.0, lat, day_of_year=np.array([doy]))
+    return et.eto_fao()[0], et.eto_hargreaves()[0]
+
+
+def test_matches_eto():
+    lat, doy, t_min, t_max = (np.array(x) for x in zip(*CELLS))
+    fao, har = etoArrays(t_min, t_max, (t_min + t_max)/2, lat, doy)
+    for k, cell in enumerate(CELLS):
+        ref_fao, ref_har = reference(*cell)
+        assert abs(fao[k] - ref_fao) <= TOLERANCE, cell
+        assert abs(har[k] - ref_har) <= TOLERANCE, cell
+
+
+def test_grid():
+    # (days, cells) temperatures against per-cell latitudes and per-day
+    # days of year, as backfillChunk calls it
+    lat = np.array([41.5, -33.9, 0.5])
+    doy = np.array([15, 100, 180, 270])
+    t_min = np.array([[-6.0, 18.0, 22.0], [4.0, 12.0, 21.0], [15.0, 8.0, 22.0], [9.0, 11.0, 23.0]])
+    t_max = t_min + np.array([9.0, 11.0, 9.0])
+    fao, har = etoArrays(t_min, t_max, (t_min + t_max)/2, lat[None, :], doy[:, None])
+    assert fao.shape == har.shape == (4, 3)
+    for d in range(4):
+        for c in range(3):
+            ref_fao, ref_har = reference(lat[c], doy[d], t_min[d, c], t_max[d, c])
+            assert abs(fao[d, c] - ref_fao) <= TOLERANCE
+            assert abs(har[d, c] - ref_har) <= TOLERANCE
+
+    par_fao, par_har = etoParallel(t_min, t_max, (t_min + t_max)/2, lat[None, :], doy[:, None],
+                                   chunk_size=5, processes=2)
+    np.testing.assert_array_equal(par_fao, fao)
+    np.testing.assert_array_equal(par_har, har)
@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import noaa_parquet
+import mrms_h3  # noqa: E402, on the path set up by noaa_parquet
+
+
+def test_year_boundary():
+    # the last two days of tmin.2019.nc, labelled as the day after
+    cells = mrms_h3.cells(np.array([40.0, -30.0]), np.array([-100.0, 20.0]), 12)
+    df = pd.DataFrame({
+        "TS": pd.to_datetime(["2019-12-31", "2019-12-31", "2020-01-01", "2020-01-01"]),
+        "T_min": [1.0, 2.0, 3.0, 4.0],
+        "h3_index__L12": [format(c, "x") for c in np.tile(cells, 2)],
+    })
+    noaa_parquet.date_columns(df)
+    assert list(df["YYYY"]) == ["2019", "2019", "2020", "2020"]
+    assert list(df["MM"] + df["DD"]) == ["1231", "1231", "0101", "0101"]
+
+    root = tempfile.mkdtemp()
+    assert noaa_parquet.write_partitions(df, root, "backfill-2019-360") == 4
+    new_year = noaa_parquet.read_partitions(root, years=[2020]).to_pandas()
+    assert sorted(new_year["T_min"]) == [3.0, 4.0]
+    assert (new_year["TS"] == pd.Timestamp("2020-01-01")).all()
+
+    # the same day written by the daily run replaces the backfilled one
+    daily = noaa_parquet.date_columns(df[2:].assign(T_min=[5.0, 6.0]))
+    noaa_parquet.write_partitions(daily, root, "20200101")
+    noaa_parquet.compact(root, workers=1, years=["2020"])
+    files = [os.listdir(d) for d in noaa_parquet.partitions(root)]
+    assert files == [["backfill-2019-360.parquet"], [noaa_parquet.COMPACTED]] * 2
+    new_year = noaa_parquet.read_partitions(root, years=[2020]).to_pandas()
+    assert sorted(new_year["T_min"]) == [5.0, 6.0]
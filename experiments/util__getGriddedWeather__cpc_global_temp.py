@@ -155,95 +155,47 @@ import pandas as pd
 import numpy as np
 import mpl_toolkits as mp
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pipeline'))
+import mrms_grid
+import mrms_h3
+import mrms_metrics
+import noaa_parquet
+from cpc_eto import etoArrays, etoParallel
 #mpl_toolkits.__path__.append('/usr/lib/python3.7/dist-packages/mpl_toolkits/')
 #from mpl_toolkits.basemap import Basemap
 
 
-def getETo(o_df):
-   
-	et1 = ETo()
-	freq = 'D'
+def getETo(o_df, processes=1):
+	"""Adds FAO-56 and Hargreaves ETo (mm and inches) and h3 indexes to a
+	frame of daily T_min, T_max and T_mean by lat, lon and elev. All rows
+	are computed at once with etoArrays, or by etoParallel if more than one
+	process is requested.
+	"""
+	p_df = o_df[['TS','T_min','T_max','T_mean']].copy()
+	p_df['TS'] = pd.to_datetime(p_df['TS'])
 
-	z_msl=o_df['elev'].tolist()
-	lat=o_df['lat'].tolist()
-	lon=o_df['lon'].tolist()
+	args = (p_df['T_min'].to_numpy(dtype='float64'), p_df['T_max'].to_numpy(dtype='float64'),
+		p_df['T_mean'].to_numpy(dtype='float64'), o_df['lat'].to_numpy(dtype='float64'),
+		p_df['TS'].dt.dayofyear.to_numpy(), o_df['elev'].to_numpy(dtype='float64'))
+	if processes > 1:
+		eto1_arr, eto2_arr = etoParallel(*args, processes=processes)
+	else:
+		eto1_arr, eto2_arr = etoArrays(*args)
+	avg_arr = (eto1_arr + eto2_arr)/2
 
-	p_df = o_df[['TS','T_min','T_max','T_mean']]
-	p_df.TS = pd.to_datetime(p_df.TS)
-	
-
-	eto1_arr=[]
-	eto2_arr=[]
-	h3_index__L3=[]
-	h3_index__L5=[]
-	h3_index__L8=[]
-	h3_index__L11=[]
-	h3_index__L12=[]
-
-	#print(type(lat))
-	#print(lat)
-
-	for i, row in p_df.iterrows():
-		#print(i)
-		lat_i=lat[i]
-		lon_i=lon[i]
-		z_msl_i=z_msl[i]
-
-		pp_df = p_df.iloc[[i]]
-		pp_df.set_index('TS',drop=True, inplace=True)
-		pp_df.index.name='date'
-		pp_df = pp_df.astype('float')
-
-		et1.param_est(pp_df,freq,z_msl_i,lat_i,lon_i)
-		res_df = et1.ts_param
-		#Rn=float(res_df.R_n[0]) #Net radiation (MJ/m2)
-		#Rs=float(res_df.R_s[0]) #Incoming shortwave radiation (MJ/m2)
-
-		eto1 = et1.eto_fao()
-		eto2 = et1.eto_hargreaves()
-
-		eto_1=eto1[0]
-		eto_2=eto2[0]
-
-		eto1_arr.append(eto_1)
-		eto2_arr.append(eto_2)
-
-		L3=h3.geo_to_h3(lat_i, lon_i, 3)
-		L5=h3.geo_to_h3(lat_i, lon_i, 5)
-		L8=h3.geo_to_h3(lat_i, lon_i, 8)
-		L11=h3.geo_to_h3(lat_i, lon_i, 11)
-		L12=h3.geo_to_h3(lat_i, lon_i, 12)
-
-		h3_index__L3.append(L3)
-		h3_index__L5.append(L5)
-		h3_index__L8.append(L8)
-		h3_index__L11.append(L11)
-		h3_index__L12.append(L12)
-
-		#print([lat_i, lon_i, eto_1, eto_2, L5, L8])
-
-	avg_arr = [(eto1_arr[x]+eto2_arr[x])/2 for x in range(0, len(eto1_arr))]
-	eto1_arr_in = [(eto1_arr[x] / 25.4) for x in range(0, len(eto1_arr))]
-	eto2_arr_in = [(eto2_arr[x] / 25.4) for x in range(0, len(eto2_arr))]
-	avg_arr_in = [(avg_arr[x] / 25.4) for x in range(0, len(avg_arr))]
-
-	p_df['Lat'] = lat
-	p_df['Lon'] = lon
+	p_df['Lat'] = o_df['lat'].to_numpy()
+	p_df['Lon'] = o_df['lon'].to_numpy()
 
 	p_df['ETo_FAO_MM'] = eto1_arr
 	p_df['ETo_HAR_MM'] = eto2_arr
 	p_df['ETo_AVG_MM'] = avg_arr
 
-	p_df['ETo_FAO_IN'] = eto1_arr_in
-	p_df['ETo_HAR_IN'] = eto2_arr_in
-	p_df['ETo_AVG_IN'] = avg_arr_in
-		
-	p_df['h3_index__L3']=h3_index__L3
-	p_df['h3_index__L5']=h3_index__L5
-	p_df['h3_index__L8']=h3_index__L8
-	p_df['h3_index__L11']=h3_index__L11
-	p_df['h3_index__L12']=h3_index__L12 
-	
+	p_df['ETo_FAO_IN'] = eto1_arr / 25.4
+	p_df['ETo_HAR_IN'] = eto2_arr / 25.4
+	p_df['ETo_AVG_IN'] = avg_arr / 25.4
+
+	addH3Columns(p_df, p_df['Lat'], p_df['Lon'])
+
 	p_df['YYYY']=o_df['YYYY']
 	p_df['MM']=o_df['MM']
 	p_df['DD']=o_df['DD']
@@ -267,105 +219,194 @@ def getTile(lat,lon):
 	return tile_list
 
 
-def getGriddedDataForMostRecentDateInYr(vname, yr):
-	vnm_df =pd.DataFrame()
+H3_LEVELS = [3, 5, 8, 11, 12]
+gridCacheDir = '/mnt/md1/NOAA/GRIDS'
+
+
+def gridToDataFrame(grid, lats, lons, vname_full, grid_cache=None):
+	"""Flattens a lat x lon grid into a frame with one row per non-NaN cell
+	holding the value, lat, lon and the h3 index of the cell at each of
+	H3_LEVELS. Rows are ordered by lon and then lat.
+
+	The h3 indexes of the whole grid are computed only once and kept in
+	grid_cache (gridCacheDir by default), so daily runs just look them up.
+	"""
+	lon_grid, lat_grid = np.meshgrid(np.asarray(lons, dtype='float64'), np.asarray(lats, dtype='float64'))
+	# transposed so that lat varies fastest
+	lat_flat = lat_grid.T.ravel()
+	lon_flat = lon_grid.T.ravel()
+	values = np.asarray(grid, dtype='float64').T.ravel()
+	keep = ~np.isnan(values)
+	df = pd.DataFrame({
+		vname_full: values[keep],
+		'lat': lat_flat[keep],
+		'lon': lon_flat[keep],
+	})
+
+	geometry = mrms_grid.GridGeometry(lat_flat, lon_flat, grid_cache or gridCacheDir, res=max(H3_LEVELS))
+	addH3Columns(df, df['lat'], df['lon'], cells=geometry.cells()[keep])
+	return df
+
+
+def addH3Columns(df, lats, lons, cells=None):
+	"""Adds an h3_index__L<level> column to df for each of H3_LEVELS. Only
+	the finest level is computed from lat and lon (unless it is given as
+	integer cells), the coarser ones are its parents.
+	"""
+	if cells is None:
+		cells = mrms_h3.cells(np.asarray(lats), np.asarray(lons), max(H3_LEVELS))
+	for level in H3_LEVELS:
+		df['h3_index__L'+str(level)] = [format(c, 'x') for c in mrms_h3.parents(cells, level).tolist()]
+
+
+CPC_URL = 'https://downloads.psl.noaa.gov/Datasets/cpc_global_temp/'
+cpcDownloadDir = '/mnt/md1/NOAA/CPC'
+
+
+def readCPCMeta(path):
+	"""Reads what we know about a local CPC file: the ETag and Last-Modified
+	of the download and how many days of it have been ingested"""
+	if not os.path.exists(path+'.json'):
+		return {}
+	with open(path+'.json') as f:
+		return json.load(f)
+
+
+def writeCPCMeta(path, meta):
+	with open(path+'.json.tmp', 'w') as f:
+		json.dump(meta, f)
+	os.replace(path+'.json.tmp', path+'.json')
+
+
+def downloadCPC(vname, yr, download_dir=None, chunk_size=1<<20):
+	"""Brings the local copy of vname.yr.nc up to date and returns its path
+	and whether it changed. The copy is kept between runs.
+
+	The request is conditional on the ETag and Last-Modified of the copy,
+	so an unchanged file costs one round trip. The response is streamed to
+	a .part file a chunk at a time. If an earlier download was interrupted,
+	only the rest of the file is requested, as long as the file hasn't
+	changed since (If-Range). A changed file is fetched whole: NetCDF keeps
+	its dimensions in the header, so new days can't just be appended.
+	"""
+	download_dir = download_dir or cpcDownloadDir
+	os.makedirs(download_dir, exist_ok=True)
+	fl = vname+'.'+yr+'.nc'
+	path = os.path.join(download_dir, fl)
+	part = path+'.part'
+	meta = readCPCMeta(path)
+
+	headers = {}
+	if os.path.exists(path):
+		if meta.get('etag'):
+			headers['If-None-Match'] = meta['etag']
+		if meta.get('last_modified'):
+			headers['If-Modified-Since'] = meta['last_modified']
+	if os.path.exists(part) and meta.get('part_etag'):
+		headers['Range'] = 'bytes=%d-' % os.path.getsize(part)
+		headers['If-Range'] = meta['part_etag']
+
+	with requests.get(CPC_URL+fl, headers=headers, stream=True, allow_redirects=True, timeout=60) as r:
+		if r.status_code == 304:
+			return path, False
+		r.raise_for_status()
+		meta['part_etag'] = r.headers.get('ETag')
+		writeCPCMeta(path, meta)
+		with open(part, 'ab' if r.status_code == 206 else 'wb') as f:
+			for chunk in r.iter_content(chunk_size):
+				f.write(chunk)
+		os.replace(part, path)
+		meta.update(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'), part_etag=None)
+	writeCPCMeta(path, meta)
+	return path, True
+
+
+def readCPCSlices(path, vname, start=0, end=None):
+	"""Reads the days start:end of a CPC file. Only those time slices are
+	read from disk. Returns the dates, lats, lons, units and a days x lat x
+	lon masked array of values.
+	"""
+	nc = netCDF4.Dataset(path)
 	try:
-		grid_url = 'https://downloads.psl.noaa.gov/Datasets/cpc_global_temp/'+vname+'.'+yr+'.nc'
-		fl = grid_url.split('/')[-1]
-		downloadFilename = '/home/sumer/Downloads/'+fl
-		r = requests.get(grid_url, allow_redirects=True)
-		with open(downloadFilename, 'wb') as f:
-			f.write(r.content)
-	
-		nc = netCDF4.Dataset(downloadFilename)
-		#tm = nc.variables['time']
-		tms = [(datetime(1900,1,1) + timedelta(hours=x)) for x in nc.variables['time'][:]]
-		dt = datetime(datetime.today().year, 1, 1) + timedelta(days=int(tms[-1].strftime('%j')))
-		YYYY = str(dt.year)
-		MM = str(dt.month).zfill(2)
-		DD = str(dt.day).zfill(2) 
-
-		lons = nc.variables['lon'][:]
+		tms = [(datetime(1900,1,1) + timedelta(hours=float(x))) for x in nc.variables['time'][start:end]]
+		# dates are labelled as the day after the time in the file
+		dates = [datetime(t.year, 1, 1) + timedelta(days=int(t.strftime('%j'))) for t in tms]
 		lats = nc.variables['lat'][:]
-		vnm = nc.variables[vname][:]
-		lons_fixed= lons-180
-		#(lons + 180) % 360 - 180
-		
-		vnm_units = (nc.variables[vname].units).replace(' ','')
-
+		lons = nc.variables['lon'][:]
+		units = (nc.variables[vname].units).replace(' ','')
+		cube = nc.variables[vname][start:end, :, :]
+	finally:
 		nc.close()
-		#delete the file
-		os.remove(downloadFilename)
-
-		"""
-		doy = vnm.shape[0]
-		dt_start_of_year = datetime.strptime(yr+'-01-01', '%Y-%m-%d')
-		dt_today = dt_start_of_year + timedelta(days=doy)
-		dtStr_today = datetime.strftime(dt_today, '%Y-%m-%d')
-		YYYY = dtStr_today.split('-')[0]
-		MM = dtStr_today.split('-')[1]
-		DD = dtStr_today.split('-')[-1]
-		"""
-		
-		vname_yesterday = np.squeeze(vnm[-1,:,:]) #For the last day (yesterday)
-		
-		vnm_filled = vname_yesterday.filled()
-		vnm_filled[vnm_filled>200]=np.nan
-		vnm_filled[vnm_filled<-200]=np.nan
-		
-		vname_full = vname+'__'+vnm_units
-		#tmax_units
-		
-		df = pd.DataFrame()
-		idx=0
-		for j in range(0,len(lons_fixed)):
-			lon=lons_fixed[j]
-			for i in range(0,len(lats)):
-				lat = lats[i]
-				vnm=vnm_filled[i,j]
-				if not np.isnan(vnm):
-					h3_index__L3= h3.geo_to_h3(lat, lon, 3)
-					h3_index__L5 = h3.geo_to_h3(lat, lon, 5)
-					h3_index__L8= h3.geo_to_h3(lat, lon, 8)
-					h3_index__L11= h3.geo_to_h3(lat, lon, 11)
-					h3_index__L12= h3.geo_to_h3(lat, lon, 12)
-
-					#populate a dataframe
-					df.loc[idx,vname_full]=vnm
-					df.loc[idx,'lat']=lat
-					df.loc[idx,'lon']=lon
-					df.loc[idx,'h3_index__L3']=h3_index__L3
-					df.loc[idx,'h3_index__L5']=h3_index__L5
-					df.loc[idx,'h3_index__L8']=h3_index__L8
-					df.loc[idx,'h3_index__L11']=h3_index__L11
-					df.loc[idx,'h3_index__L12']=h3_index__L12
-
-					idx=idx+1
-		#Add the Dt Cols
-		df['YYYY']=YYYY
-		df['MM']=MM
-		df['DD']=DD
-		
-		vnm_df = df[[vname_full,'lat','lon','h3_index__L3','h3_index__L5','h3_index__L8','h3_index__L11','h3_index__L12','YYYY','MM','DD']] #tmax_df
+	return dates, lats, lons, units, cube
 
-		
+
+def cpcFrame(grid, lats, lons, vname_full, dt, grid_cache=None):
+	"""Turns one day of a CPC variable into a frame"""
+	vnm_filled = np.ma.filled(np.squeeze(grid)).astype('float64')
+	vnm_filled[vnm_filled>200]=np.nan
+	vnm_filled[vnm_filled<-200]=np.nan
+	lons_fixed= lons-180
+	#(lons + 180) % 360 - 180
+
+	df = gridToDataFrame(vnm_filled, lats, lons_fixed, vname_full, grid_cache)
+	#Add the Dt Cols
+	df['YYYY']=str(dt.year)
+	df['MM']=str(dt.month).zfill(2)
+	df['DD']=str(dt.day).zfill(2)
+	return df[[vname_full,'lat','lon','h3_index__L3','h3_index__L5','h3_index__L8','h3_index__L11','h3_index__L12','YYYY','MM','DD']]
+
+
+def getGriddedDataForMostRecentDateInYr(vname, yr, download_dir=None, grid_cache=None):
+	vnm_df =pd.DataFrame()
+	try:
+		path, changed = downloadCPC(vname, yr, download_dir)
+		dates, lats, lons, units, cube = readCPCSlices(path, vname, -1)
+		vnm_df = cpcFrame(cube[-1], lats, lons, vname+'__'+units, dates[-1], grid_cache)
 	except Exception as e:
 		print(e)
 
 	return vnm_df
 
 
-
-def writeNOAAParquet(vnm_df, pa_fileName):
+def getNewGriddedDataInYr(vname, yr, download_dir=None, grid_cache=None):
+	"""Returns a frame for every day of vname.yr.nc that hasn't been
+	ingested yet, along with the index of the first of them. Only the new
+	days are read. Call markIngested once they are stored.
+	"""
+	path, changed = downloadCPC(vname, yr, download_dir)
+	start = readCPCMeta(path).get('ingested', 0)
+	dates, lats, lons, units, cube = readCPCSlices(path, vname, start)
+	frames = [cpcFrame(cube[k], lats, lons, vname+'__'+units, dates[k], grid_cache) for k in range(len(dates))]
+	return frames, start
+
+
+def markIngested(vname, yr, n, download_dir=None):
+	"""Records that the first n days of vname.yr.nc have been ingested"""
+	path = os.path.join(download_dir or cpcDownloadDir, vname+'.'+yr+'.nc')
+	meta = readCPCMeta(path)
+	meta['ingested'] = n
+	writeCPCMeta(path, meta)
+
+
+def writeNOAAParquet(vnm_df, pa_fileName, layout='bucketed'):
+	"""Writes a day of data into the store at pa_fileName. The default
+	'bucketed' layout writes one file per level 1 h3 cell and year (see
+	noaa_parquet.py); 'hive' is the original layout with one directory per
+	h3 level 3/5/8/11/12 cell and day.
+	"""
 	try:
 		print('\n\tWriting Parquet File '+pa_fileName)
 		
-		vnm_df.to_parquet(
-			path=pa_fileName,
-			engine='pyarrow',
-			compression='gzip',
-			partition_cols=['h3_index__L3','h3_index__L5', 'h3_index__L8','h3_index__L11','h3_index__L12','YYYY', 'MM', 'DD'],
-		)
+		if layout == 'bucketed':
+			day = vnm_df['YYYY'].iloc[0]+vnm_df['MM'].iloc[0]+vnm_df['DD'].iloc[0]
+			noaa_parquet.write_partitions(vnm_df, pa_fileName, day)
+		else:
+			vnm_df.to_parquet(
+				path=pa_fileName,
+				engine='pyarrow',
+				compression='gzip',
+				partition_cols=['h3_index__L3','h3_index__L5', 'h3_index__L8','h3_index__L11','h3_index__L12','YYYY', 'MM', 'DD'],
+			)
 		print('\tDone!')
 	except Exception as e:
 		print(e)
@@ -383,23 +424,7 @@ def loadingBar(count,total,size):
 
 noaa_pa_fileName = '/mnt/md1/NOAA/PARQUET'
 
-try:
-	begin_time = time.time()
-	print('\n\n\t--- Retrieving cpc_global_temp Data from NOAA ---')
-	vname = 'tmin'
-	yr = str(datetime.now().year)
-	start_time = time.time()
-	tmin_df = getGriddedDataForMostRecentDateInYr(vname, yr)
-	#print(tmin_df.columns)
-	#print(len(tmin_df))
-
-	vname = 'tmax'
-	yr = str(datetime.now().year)
-	start_time = time.time()
-	tmax_df = getGriddedDataForMostRecentDateInYr(vname, yr)
-	#print(tmax_df.columns)
-	#print(len(tmax_df))
-
+def processCPCDay(tmax_df, tmin_df, store=None):
 	start_time = time.time()
 	new_df = pd.merge(tmax_df, tmin_df,  how='left', left_on=['lat','lon','h3_index__L5', 'h3_index__L8', 'YYYY', 'MM', 'DD'], right_on = ['lat','lon','h3_index__L5', 'h3_index__L8', 'YYYY', 'MM', 'DD'])
 	#print(new_df.columns)
@@ -414,32 +439,151 @@ try:
 	new_df.rename(columns={'tmin__degC':'T_min', 'tmax__degC':'T_max', 'tmean__degC':'T_mean'}, inplace=True)
 	new_df['elev']=0.0
 	new_df['TS'] = pd.to_datetime(new_df['TS'])
-	#print(new_df.columns)
-	#print(len(new_df))
-	#print(new_df.tail(10))
-
-	#get the ETO
-	start_time = time.time()
-
-	#print(new_df.columns)
-	#print(len(new_df))
-	#print(new_df.head(10))
 
 	##########
 	pnew_df = getETo(new_df)
 	##########
 
 	print(pnew_df.columns)
-	#print(len(pnew_df))
 	print(pnew_df.head(10))
 	print("\t--- %s minutes ---\n\n" % str(round(((time.time() - start_time)/60),2)))
 
 	#write ETo to the parquet file
 	print('\n\t--- Writing Parquet File ---')
 	
-	writeNOAAParquet(pnew_df, noaa_pa_fileName)
+	writeNOAAParquet(pnew_df, store or noaa_pa_fileName)
 	print("\t--- %s minutes ---\n" % str(round(((time.time() - start_time)/60),2)))
-	print("\n\n--- %s TOTAL minutes ---\n\n\n" % str(round(((time.time() - begin_time)/60),2)))
-except Exception as e:
-	print(e)
 
+
+def ingestNewCPCDays(store=None, download_dir=None, grid_cache=None):
+	"""Ingests the days of the current year that are new since the last
+	run. store, download_dir and grid_cache default to noaa_pa_fileName,
+	cpcDownloadDir and gridCacheDir.
+	"""
+	store = store or noaa_pa_fileName
+	try:
+		begin_time = time.time()
+		print('\n\n\t--- Retrieving cpc_global_temp Data from NOAA ---')
+		yr = str(datetime.now().year)
+		# only the days that haven't been ingested yet are read
+		tmin_frames, tmin_start = getNewGriddedDataInYr('tmin', yr, download_dir, grid_cache)
+		tmax_frames, tmax_start = getNewGriddedDataInYr('tmax', yr, download_dir, grid_cache)
+		days = min(len(tmin_frames), len(tmax_frames))
+		print('\t%d new days' % days)
+
+		for k in range(days):
+			with mrms_metrics.span('day') as span:
+				processCPCDay(tmax_frames[k], tmin_frames[k], store)
+				span.add(rows=len(tmax_frames[k]))
+			markIngested('tmin', yr, tmin_start + k + 1, download_dir)
+			markIngested('tmax', yr, tmax_start + k + 1, download_dir)
+		if days:
+			# every day adds a file to each partition of its year, fold them in
+			years = {tmax_frames[k]['YYYY'].iloc[0] for k in range(days)}
+			noaa_parquet.compact(store, years=years)
+		print("\n\n--- %s TOTAL minutes ---\n\n\n" % str(round(((time.time() - begin_time)/60),2)))
+	except Exception as e:
+		print(e)
+
+
+def cleanCPC(cube):
+	"""Fills masked and out of range values of a CPC array with NaN"""
+	values = np.ma.filled(cube.astype('float64'), np.nan)
+	values[(values>200) | (values<-200)] = np.nan
+	return values
+
+
+def cpcDays(path):
+	nc = netCDF4.Dataset(path)
+	try:
+		return len(nc.dimensions['time'])
+	finally:
+		nc.close()
+
+
+def _downloadCPC(args):
+	vname, yr, download_dir = args
+	return downloadCPC(vname, yr, download_dir)[0]
+
+
+def backfillChunk(args):
+	"""Computes ETo for days start:end of one year and writes them into the
+	store. tmin and tmax come from the same grid, so they are joined by
+	position, and ETo is computed for all days and grid points of the
+	chunk at once. Returns the number of rows written.
+	"""
+	yr, start, end, store, download_dir, grid_cache = args
+	dates, lats, lons, units, tmin = readCPCSlices(os.path.join(download_dir, 'tmin.'+yr+'.nc'), 'tmin', start, end)
+	tmax_dates, _, _, _, tmax = readCPCSlices(os.path.join(download_dir, 'tmax.'+yr+'.nc'), 'tmax', start, end)
+	days = min(len(dates), len(tmax_dates))
+	if days == 0:
+		return 0
+
+	# days x points with lat varying fastest, as in gridToDataFrame
+	lon_grid, lat_grid = np.meshgrid(np.asarray(lons - 180, dtype='float64'), np.asarray(lats, dtype='float64'))
+	lat_flat = lat_grid.T.ravel()
+	lon_flat = lon_grid.T.ravel()
+	T_min = cleanCPC(tmin[:days]).transpose(0, 2, 1).reshape(days, -1)
+	T_max = cleanCPC(tmax[:days]).transpose(0, 2, 1).reshape(days, -1)
+	T_mean = np.where(np.isnan(T_min), T_max, (T_min + T_max)/2)
+	doy = np.array([d.timetuple().tm_yday for d in dates[:days]])
+	eto_fao, eto_har = etoArrays(T_min, T_max, T_mean, lat_flat[None, :], doy[:, None])
+
+	# rows where there is a tmax, like the left join of the daily run
+	day, point = np.nonzero(~np.isnan(T_max))
+	avg = (eto_fao[day, point] + eto_har[day, point])/2
+	df = pd.DataFrame({
+		'TS': pd.to_datetime(np.array([np.datetime64(d, 'D') for d in dates[:days]])[day]),
+		'T_min': T_min[day, point], 'T_max': T_max[day, point], 'T_mean': T_mean[day, point],
+		'Lat': lat_flat[point], 'Lon': lon_flat[point],
+		'ETo_FAO_MM': eto_fao[day, point], 'ETo_HAR_MM': eto_har[day, point], 'ETo_AVG_MM': avg,
+		'ETo_FAO_IN': eto_fao[day, point]/25.4, 'ETo_HAR_IN': eto_har[day, point]/25.4, 'ETo_AVG_IN': avg/25.4,
+	})
+	geometry = mrms_grid.GridGeometry(lat_flat, lon_flat, grid_cache, res=max(H3_LEVELS))
+	addH3Columns(df, None, None, cells=np.asarray(geometry.cells())[point])
+	# the last day of a year is labelled as the first of the next (see
+	# readCPCSlices), and goes with it as in the daily run
+	noaa_parquet.date_columns(df)
+
+	noaa_parquet.write_partitions(df, store, 'backfill-%s-%03d' % (yr, start))
+	return len(df)
+
+
+def backfillCPC(first_year, last_year, processes=4, chunk_days=31, store=None, download_dir=None, grid_cache=None):
+	"""Ingests every day of the years first_year to last_year. Downloads
+	fan out over (variable, year) and the days of each year are processed
+	in chunks of chunk_days, all by a pool of processes. The store is
+	compacted at the end. store, download_dir and grid_cache default to
+	noaa_pa_fileName, cpcDownloadDir and gridCacheDir.
+	"""
+	store = store or noaa_pa_fileName
+	download_dir = download_dir or cpcDownloadDir
+	grid_cache = grid_cache or gridCacheDir
+	begin_time = time.time()
+	years = [str(y) for y in range(first_year, last_year + 1)]
+	with Pool(processes) as pool:
+		pool.map(_downloadCPC, [(vname, yr, download_dir) for vname in ('tmin', 'tmax') for yr in years])
+		print('\tdownloaded %d years in %.1f minutes' % (len(years), (time.time() - begin_time)/60))
+
+		chunks = []
+		for yr in years:
+			days = min(cpcDays(os.path.join(download_dir, vname+'.'+yr+'.nc')) for vname in ('tmin', 'tmax'))
+			chunks += [(yr, start, min(start + chunk_days, days), store, download_dir, grid_cache) for start in range(0, days, chunk_days)]
+		rows = 0
+		for k, n in enumerate(pool.imap_unordered(backfillChunk, chunks)):
+			rows += n
+			loadingBar(k + 1, len(chunks), 2)
+	print('\n\twrote %d rows in %.1f minutes' % (rows, (time.time() - begin_time)/60))
+	noaa_parquet.compact(store, processes)
+
+
+if __name__ == '__main__':
+	# execute only if run as a script
+	# python util__getGriddedWeather__cpc_global_temp.py backfill <first year> <last year> [processes]
+	# stage metrics and profiles go where MRMS_METRICS and MRMS_PROFILE say (see mrms_metrics)
+	if len(sys.argv) > 2 and sys.argv[1] == 'backfill':
+		with mrms_metrics.run('cpc-backfill'):
+			backfillCPC(int(sys.argv[2]), int(sys.argv[3]), processes=int(sys.argv[4]) if len(sys.argv) > 4 else 4)
+	else:
+		with mrms_metrics.run('cpc-ingest'):
+			ingestNewCPCDays()
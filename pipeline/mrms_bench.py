@@ -0,0 +1,349 @@
+"""An offline benchmark of the whole pipeline.
+
+Synthetic hourly MRMS files are written as GRIB2 on a 0.01 degree grid like
+the real one, cropped to the requested size around the middle of CONUS so
+that tiles hold as many points as they would in production. Precipitation
+comes in smooth storm-like patches covering `1 - dry` of the grid. The
+files are served by a local stand-in for the Iowa State archive that lists
+directories the way mtarchive does. Then the inventory, download, split,
+merge, point, nearest grid point and region query stages are run and timed for each grid size
+and tile level.
+
+Results are written as JSON lines, one record per stage, size and tile
+level, together with a description of the machine so that runs can be
+compared over time.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pyarrow.feather
+
+import mrms_download
+import mrms_index
+import mrms_inventory
+import mrms_merge
+import mrms_query
+import mrms_region
+import mrms_split
+
+# the MRMS CONUS grid is 3500 rows by 7000 columns 0.01 degrees apart
+# starting at 54.995N 129.995W. Synthetic grids are centered on CENTER
+STEP = 0.01
+CENTER = (40.0, -95.0)
+
+DIR = "MultiSensor_QPE_01H_Pass2"
+URL = "http://{host}:{port}/{{year:4d}}/{{month:02d}}/{{day:02d}}/mrms/ncep/{{dir:s}}"
+
+# precipitation is packed in units of 0.1 mm as MRMS does
+DECIMAL_SCALE = 1
+
+
+def grid(shape, center=CENTER, step=STEP):
+    """Returns the latitude of the first (northernmost) row and the
+    longitude of the first (westernmost) column of a grid of `shape`
+    (rows, columns) centered on `center`"""
+    rows, cols = shape
+    return round(center[0] + step * (rows - 1) / 2, 3), round(center[1] - step * (cols - 1) / 2, 3)
+
+
+def synthetic_field(shape, dry, rng, patch=50):
+    """Returns a precipitation field of `shape` in mm where a fraction
+    `dry` of the points is zero. Wet points come in patches about `patch`
+    points across with heavier rain towards their middle."""
+    rows, cols = shape
+    coarse = rng.standard_normal((rows // patch + 2, cols // patch + 2))
+    # bilinear interpolation of the coarse noise gives smooth patches
+    y = np.arange(rows) / patch
+    x = np.arange(cols) / patch
+    y0, x0 = y.astype(int), x.astype(int)
+    fy, fx = (y - y0)[:, None], (x - x0)[None, :]
+    field = ((1 - fy) * (1 - fx) * coarse[y0][:, x0] + (1 - fy) * fx * coarse[y0][:, x0 + 1]
+             + fy * (1 - fx) * coarse[y0 + 1][:, x0] + fy * fx * coarse[y0 + 1][:, x0 + 1])
+    threshold = np.quantile(field, dry) if dry > 0 else -np.inf
+    wet = np.maximum(field - threshold, 0)
+    return (wet * 10 * rng.exponential(1.0, shape)).astype(np.float32)
+
+
+def write_grib(fname, values, first, t, step=STEP):
+    """Writes a field as a GRIB2 message on a regular latitude/longitude
+    grid, with rows from north to south as in MRMS files, and simple
+    packing. `first` is the latitude and longitude of the first point and
+    `t` the time as a datetime. Names ending in .gz are compressed."""
+    rows, cols = values.shape
+    n = rows * cols
+
+    def angle(x):
+        # GRIB2 stores signed values with a sign bit instead of two's complement
+        micro = int(round(x * 1e6))
+        return (abs(micro) | (0x80000000 if micro < 0 else 0)).to_bytes(4, "big")
+
+    lat1, lon1 = first
+    lat2, lon2 = lat1 - step * (rows - 1), lon1 + step * (cols - 1)
+    section1 = struct.pack(">IBHHBBBHBBBBBBB", 21, 1, 161, 0, 2, 1, 1,
+                           t.year, t.month, t.day, t.hour, t.minute, t.second, 0, 0)
+    template3 = (struct.pack(">BBIBIBIII", 6, 0, 0, 0, 0, 0, 0, cols, rows) + struct.pack(">II", 0, 0xFFFFFFFF)
+                 + angle(lat1) + angle(lon1 % 360) + bytes([0x30]) + angle(lat2) + angle(lon2 % 360)
+                 + struct.pack(">II", int(round(step * 1e6)), int(round(step * 1e6))) + bytes([0x00]))
+    section3 = struct.pack(">IBBIBBH", 14 + len(template3), 3, 0, n, 0, 0, 0) + template3
+    template4 = struct.pack(">BBBBBHBBIBBIBBI", 1, 8, 0, 0, 0, 0, 0, 1, 0, 1, 0, 0, 255, 0, 0)
+    section4 = struct.pack(">IBHH", 9 + len(template4), 4, 0, 0) + template4
+
+    scaled = np.round(values.reshape(-1).astype(np.float64) * 10 ** DECIMAL_SCALE).astype(np.int64)
+    reference = int(scaled.min()) if n else 0
+    packed = scaled - reference
+    bits = max(1, int(packed.max()).bit_length()) if n else 1
+    section5 = struct.pack(">IBIH", 21, 5, n, 0) + struct.pack(">fHHBB", reference, 0, DECIMAL_SCALE, bits, 0)
+    section6 = struct.pack(">IBB", 6, 6, 255)
+    data = pack_bits(packed, bits)
+    section7 = struct.pack(">IB", 5 + len(data), 7)
+    body = section1 + section3 + section4 + section5 + section6 + section7
+    total = 16 + len(body) + len(data) + 4
+
+    opener = gzip.open if fname.endswith(".gz") else open
+    tmp = fname + ".tmp"
+    with opener(tmp, "wb") as out:
+        out.write(b"GRIB" + struct.pack(">HBBQ", 0, 209, 2, total))
+        out.write(body)
+        out.write(data)
+        out.write(b"7777")
+    os.replace(tmp, fname)
+
+
+def pack_bits(values, bits, chunk=1 << 20):
+    """Packs non-negative integers into `bits` bits each, most significant
+    bit first, a chunk at a time to bound memory"""
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.int64)
+    out = []
+    # a chunk of a multiple of 8 values always ends on a byte boundary
+    chunk -= chunk % 8
+    for i in range(0, len(values), chunk):
+        x = values[i:i + chunk]
+        out.append(np.packbits(((x[:, None] >> shifts) & 1).astype(np.uint8).reshape(-1)).tobytes())
+    return b"".join(out)
+
+
+def file_name(t):
+    return f"MRMS_{DIR}_00.00_{t:%Y%m%d-%H}0000.grib2.gz"
+
+
+def build_archive(root, day, hours, shape, dry, seed=1):
+    """Writes `hours` hourly files for `day` into `root` in the layout of
+    mtarchive. Returns the total size of the files."""
+    folder = os.path.join(root, day.strftime("%Y/%m/%d"), "mrms/ncep", DIR)
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    first = grid(shape)
+    size = 0
+    for h in range(hours):
+        t = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(hours=h)
+        fname = os.path.join(folder, file_name(t))
+        write_grib(fname, synthetic_field(shape, dry, rng), first, t)
+        size += os.path.getsize(fname)
+    return size
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serves files under `root` and lists directories with the same
+    markup as the Iowa State archive, with keep-alive connections"""
+    root = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = os.path.join(self.root, self.path.split("?")[0].strip("/"))
+        if os.path.isdir(path):
+            self.send(200, self.listing(path).encode("utf-8"), "text/html")
+        elif os.path.isfile(path):
+            with open(path, "rb") as input:
+                self.send(200, input.read(), "application/octet-stream")
+        else:
+            self.send(404, b"not found", "text/plain")
+
+    def listing(self, path):
+        rows = []
+        for f in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, f))
+            mtime = datetime.fromtimestamp(st.st_mtime, timezone.utc).strftime("%Y-%m-%d %H:%M")
+            rows.append(f'<tr><td><a href="{f}">{f}</a></td><td align="right">{mtime}  </td>'
+                        f'<td align="right">{max(1, round(st.st_size / 1024))}K</td></tr>')
+        return "<html><body><table>\n" + "\n".join(rows) + "\n</table></body></html>\n"
+
+    def send(self, status, content, kind):
+        self.send_response(status)
+        self.send_header("Content-Type", kind)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_archive(root):
+    """Serves an archive from a background thread. Returns the server,
+    which should be shut down when done."""
+    handler = type("Handler", (ArchiveHandler,), dict(root=root))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Timer:
+    """Collects timings as result records sharing some fields"""
+
+    def __init__(self, **common):
+        self.common = common
+        self.results = []
+
+    def run(self, stage, f, **fields):
+        t0, c0 = time.perf_counter(), time.process_time()
+        value = f()
+        record = dict(self.common, stage=stage, seconds=time.perf_counter() - t0,
+                      cpu_seconds=time.process_time() - c0, **fields)
+        self.results.append(record)
+        print(f"{stage:>10} {json.dumps(fields)} {record['seconds']:.3f}s")
+        return value
+
+
+def dir_size(root):
+    files, size = 0, 0
+    for dirpath, _, names in os.walk(root):
+        for f in names:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, f))
+    return files, size
+
+
+def random_fields(shape, n, rng, size=0.01):
+    """Returns `n` random square polygons `size` degrees across inside a
+    grid of `shape`. The default is about a square km, a large field."""
+    lat1, lon1 = grid(shape)
+    lat0, lon1b = lat1 - STEP * (shape[0] - 1), lon1 + STEP * (shape[1] - 1)
+    result = {}
+    for i in range(n):
+        lat = rng.uniform(lat0 + size, lat1 - size)
+        lon = rng.uniform(lon1 + size, lon1b - size)
+        ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+        result[i] = dict(type="Polygon", coordinates=[ring])
+    return result
+
+
+def benchmark(work, shapes, levels=(3, 4, 5), hours=4, dry=0.9, day=date(2021, 8, 21),
+              points=200, fields=50, workers=2):
+    """Runs the pipeline on synthetic data in `work` for each grid shape
+    and tile level and returns the list of result records"""
+    timer = Timer(machine=machine())
+    rng = np.random.default_rng(7)
+    for shape in shapes:
+        size = dict(rows=shape[0], cols=shape[1], hours=hours, dry=dry)
+        root = os.path.join(work, f"{shape[0]}x{shape[1]}")
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        archive, data = os.path.join(root, "archive"), os.path.join(root, "data")
+        timer.run("generate", lambda: build_archive(archive, day, hours, shape, dry), **size)
+
+        server = serve_archive(archive)
+        try:
+            url = URL.format(host="127.0.0.1", port=server.server_port)
+            inv = timer.run("inventory", lambda: mrms_inventory.inventory(day, day, url=url, search_path=[DIR]),
+                            **size)
+            inventory_file = os.path.join(root, "inventory.feather")
+            pyarrow.feather.write_feather(inv, inventory_file)
+            timer.run("download", lambda: mrms_download.download(inventory_file, data, max_download=len(inv),
+                                                                 concurrency=4), **size)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        lat1, lon1 = grid(shape)
+        for level in levels:
+            tiles = os.path.join(root, f"tiles-{level}")
+            cache = os.path.join(root, "grid-cache")
+            options = dict(size, tile_level=level)
+            timer.run("split", lambda: mrms_split.process_days(data, tiles, day, day, level, workers=workers,
+                                                               grid_cache=cache), **options)
+            timer.run("merge", lambda: mrms_merge.merge_days(tiles, day, day, workers=workers), **options)
+            files, bytes = dir_size(os.path.join(tiles, "daily/data"))
+            timer.results[-1].update(files=files, bytes=bytes)
+
+            store = mrms_query.TileStore(tiles, tile_level=level)
+            dirs = store.dirs(day, day)
+            # grid point coordinates go through float32 and degrees east in
+            # the split, so queries for grid points have to do the same
+            lats = (lat1 - STEP * rng.integers(0, shape[0], points)).astype(np.float32)
+            lons = ((lon1 + STEP * rng.integers(0, shape[1], points)) % 360).astype(np.float32)
+            lons[lons > 180.0] -= 360.0
+
+            def points_query():
+                for lat, lon in zip(lats, lons):
+                    store.history(lat, lon, dirs)
+            timer.run("point", points_query, queries=points, **options)
+            timer.run("point_hot", points_query, queries=points, **options)
+            index_file = os.path.join(root, f"index-{level}.arrow")
+            mrms_index.build_index(dirs, index_file)
+            index = mrms_index.GridIndex(index_file)
+            timer.run("nearest", lambda: [index.nearest(lat, lon) for lat, lon in zip(lats, lons)], queries=points,
+                      **options)
+            refs = store.locate(lats, lons)
+            starts = np.full(points, mrms_query.millis(day))
+            ends = starts + 24 * 3600_000 - 1
+            found = timer.run("batch", lambda: sum(b.num_rows for b in store.batch(refs, starts, ends)),
+                              queries=points, **options)
+            timer.results[-1].update(rows_found=found)
+            regions = random_fields(shape, fields, rng)
+            timer.run("region", lambda: mrms_region.query_regions(store, regions, dirs), queries=fields, **options)
+    return timer.results
+
+
+def machine():
+    """Describes the machine and code that produced a result"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(host=platform.node(), python=platform.python_version(), cpus=os.cpu_count(), commit=commit,
+                started=datetime.now(timezone.utc).isoformat(timespec="seconds"))
+
+
+def parse_shape(s):
+    rows, cols = s.lower().split("x")
+    return int(rows), int(cols)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Benchmark the MRMS pipeline on synthetic data')
+    parser.add_argument("--work", default=None, help="Directory for the synthetic archive and tiles. Default is temporary")
+    parser.add_argument("--sizes", default="350x700,1000x2000",
+                        help="Comma separated grid sizes as rowsxcolumns. The full MRMS grid is 3500x7000")
+    parser.add_argument("--levels", default="3,4,5", help="Comma separated tile levels. Default is 3,4,5")
+    parser.add_argument("--hours", default=4, help="Number of hours of data. Default is 4")
+    parser.add_argument("--dry", default=0.9, help="Fraction of grid points without precipitation. Default is 0.9")
+    parser.add_argument("--workers", default=2, help="Number of processes for split and merge. Default is 2")
+    parser.add_argument("--output", default="bench.jsonl", help="File to append results to as JSON lines")
+
+    args = parser.parse_args()
+    work = args.work or tempfile.mkdtemp(prefix="mrms-bench-")
+    results = benchmark(work, [parse_shape(s) for s in args.sizes.split(",")],
+                        levels=[int(x) for x in args.levels.split(",")], hours=int(args.hours),
+                        dry=float(args.dry), workers=int(args.workers))
+    with open(args.output, "a") as out:
+        for r in results:
+            out.write(json.dumps(r) + "\n")
+    if not args.work:
+        shutil.rmtree(work)
+    print(f"wrote {len(results)} results to {args.output} in {math.fsum(r['seconds'] for r in results):.1f}s")
@@ -0,0 +1,353 @@
+"""A catalog of the tile files in a tile tree.
+
+Answering a query from the tile tree alone means listing the directories
+of every day in the range, looking for the tile file in each of them and
+reading the footer of every file found. Over a month of hourly
+directories that planning costs far more than reading the data. The
+catalog is a single SQLite file at the root of the tree that records,
+for every tile file, its directory, tile, h3 and time range, number of
+rows and the offset, size and h3 and time range of each of its row
+groups. It is updated by `mrms_split` and `mrms_merge` as they swap new
+directories into place, and can be rebuilt from the tree by running this
+module as a script.
+
+A reader loads the catalog into memory once and again only after a
+writer changed it, so that finding the files and row groups holding some
+grid points of a tile between two times needs no file system access.
+Directories the catalog doesn't know about (such as the rollups) are
+simply read as before.
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+import pyarrow.parquet as pq
+
+import mrms_tiles
+
+CATALOG = "catalog.sqlite"
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS dirs (
+    dir TEXT PRIMARY KEY, period TEXT NOT NULL, day TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL, name TEXT NOT NULL, tile_level INTEGER NOT NULL, tile INTEGER NOT NULL,
+    sparse INTEGER NOT NULL, h3_min INTEGER, h3_max INTEGER, t_min INTEGER, t_max INTEGER, rows INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, ino INTEGER NOT NULL,
+    PRIMARY KEY (dir, name));
+CREATE TABLE IF NOT EXISTS row_groups (
+    dir TEXT NOT NULL, name TEXT NOT NULL, row_group INTEGER NOT NULL, offset INTEGER NOT NULL,
+    bytes INTEGER NOT NULL, h3_min INTEGER, h3_max INTEGER, t_min INTEGER, t_max INTEGER, rows INTEGER NOT NULL,
+    PRIMARY KEY (dir, name, row_group));
+"""
+
+# tile directories, relative to the root of the tree
+DIR_PATTERN = re.compile(r"(hourly|daily|monthly)/data/(\d{4})/(\d{2})(?:/(\d{2}))?(?:/(\d{2}))?$")
+DEPTH = dict(monthly=2, daily=3, hourly=4)
+TILE_PATTERN = re.compile(r"x-(\d+)-(\d+)$")
+
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def describe(fname):
+    """Returns a dict describing a tile file and a list of dicts
+    describing its row groups, in the form stored in the catalog"""
+    pf = pq.ParquetFile(fname)
+    md = pf.metadata
+    schema = pf.schema_arrow
+    metadata = schema.metadata or {}
+    columns = {name: schema.get_field_index(name) for name in ["h3", "t"]}
+    groups = []
+    for i in range(md.num_row_groups):
+        rg = md.row_group(i)
+        stats = {name: rg.column(c).statistics for name, c in columns.items()}
+        if all(s is not None and s.has_min_max for s in stats.values()):
+            h3_min, h3_max = stats["h3"].min, stats["h3"].max
+            t_min, t_max = stats["t"].min, stats["t"].max
+            if metadata.get(b"encoding") == b"compact":
+                t0, t_step = int(metadata[b"t0"]), int(metadata[b"t_step"])
+                t_min, t_max = t0 + t_min * t_step, t0 + t_max * t_step
+        else:
+            table = mrms_tiles.decode(pf.read_row_group(i, columns=["h3", "t"]).replace_schema_metadata(metadata))
+            h3, t = table["h3"].to_numpy(), table["t"].to_numpy()
+            h3_min, h3_max, t_min, t_max = int(h3.min()), int(h3.max()), int(t.min()), int(t.max())
+        first = rg.column(0)
+        offset = first.dictionary_page_offset if first.has_dictionary_page else first.data_page_offset
+        groups.append(dict(row_group=i, offset=offset, bytes=sum(rg.column(c).total_compressed_size
+                                                                 for c in range(rg.num_columns)),
+                           h3_min=int(h3_min), h3_max=int(h3_max), t_min=int(t_min), t_max=int(t_max),
+                           rows=rg.num_rows))
+
+    manifest = mrms_tiles.manifest(schema)
+    if manifest is not None:
+        # a sparse tile covers every point and time of its manifest
+        h3, t = manifest
+    else:
+        h3 = [g["h3_min"] for g in groups] + [g["h3_max"] for g in groups]
+        t = [g["t_min"] for g in groups] + [g["t_max"] for g in groups]
+    (h3_min, h3_max), (t_min, t_max) = _range(h3), _range(t)
+    level, tile = TILE_PATTERN.match(os.path.basename(fname)).groups()
+    st = os.stat(fname)
+    return (dict(tile_level=int(level), tile=int(tile), sparse=int(manifest is not None),
+                 h3_min=h3_min, h3_max=h3_max, t_min=t_min, t_max=t_max, rows=md.num_rows,
+                 mtime_ns=st.st_mtime_ns, size=st.st_size, ino=st.st_ino),
+            groups)
+
+
+def dir_day(rel):
+    """Returns the period (hourly, daily or monthly) and day of a tile
+    directory given relative to the root, or None if it isn't one. The day
+    of a monthly directory is the first of the month."""
+    m = DIR_PATTERN.match(rel)
+    if m is None or sum(x is not None for x in m.groups()[1:]) != DEPTH[m.group(1)]:
+        return None
+    return m.group(1), f"{m.group(2)}-{m.group(3)}-{m.group(4) or '01'}"
+
+
+def tree_dirs(root, day):
+    """Lists the tile directories of one day found on disk under `root`:
+    the monthly directory of its month if there is one, or else its daily
+    directory or else its hourly directories"""
+    path = day.strftime("%Y/%m/%d")
+    monthly = os.path.join(root, "monthly/data", day.strftime("%Y/%m"))
+    daily = os.path.join(root, "daily/data", path)
+    hourly = os.path.join(root, "hourly/data", path)
+    if os.path.isdir(monthly):
+        return [monthly]
+    if os.path.isdir(daily):
+        return [daily]
+    if os.path.isdir(hourly):
+        return [os.path.join(hourly, h) for h in sorted(os.listdir(hourly)) if h.isdigit()]
+    return []
+
+
+def _range(x):
+    return (int(min(x)), int(max(x))) if len(x) else (None, None)
+
+
+class CatalogFile:
+    """A catalogued tile file with the ranges of its row groups"""
+
+    def __init__(self, path, version, sparse, t_min, t_max, groups):
+        self.path = path
+        self.version = version
+        self.sparse = sparse
+        # the place of the file in its CatalogTile
+        self.position = None
+        self.t_min = INT64_MIN if t_min is None else t_min
+        self.t_max = INT64_MAX if t_max is None else t_max
+        self.h3_min, self.h3_max, self.group_t_min, self.group_t_max = (
+            np.array([g[k] for g in groups], dtype=np.int64).reshape(-1) for k in range(4))
+
+    def row_groups(self, lo, hi, start=None, end=None):
+        """Returns the row groups overlapping any of the sorted h3 ranges
+        from `lo` to `hi` and the times from `start` to `end`"""
+        return np.flatnonzero(_overlaps(self.h3_min, self.h3_max, self.group_t_min, self.group_t_max,
+                                        lo, hi, start, end))
+
+
+class CatalogTile:
+    """The catalogued files of one tile by directory. The ranges of all
+    of their row groups are also kept in flat arrays, so that finding the
+    files worth reading takes a few vector operations however many files
+    there are."""
+
+    def __init__(self, files):
+        self.files = files
+        entries = list(files.values())
+        for k, e in enumerate(entries):
+            e.position = k
+        self.owner = np.repeat(np.arange(len(entries)), [len(e.h3_min) for e in entries])
+        self.h3_min, self.h3_max, self.t_min, self.t_max = (
+            np.concatenate([getattr(e, k) for e in entries] + [np.zeros(0, np.int64)])
+            for k in ["h3_min", "h3_max", "group_t_min", "group_t_max"])
+
+    def wanted(self, lo, hi, start=None, end=None):
+        """Tells for each file whether any of its row groups overlaps the
+        h3 ranges and times"""
+        keep = _overlaps(self.h3_min, self.h3_max, self.t_min, self.t_max, lo, hi, start, end)
+        return np.bincount(self.owner[keep], minlength=len(self.files)) > 0
+
+
+def _overlaps(h3_min, h3_max, t_min, t_max, lo, hi, start, end):
+    """Tells which row groups overlap any of the sorted h3 ranges from `lo`
+    to `hi` and the times from `start` to `end`"""
+    if len(lo) == 0:
+        return np.zeros(len(h3_min), bool)
+    i = np.searchsorted(hi, h3_min, "left")
+    keep = (i < len(lo)) & (lo[np.minimum(i, len(lo) - 1)] <= h3_max)
+    if start is not None:
+        keep &= t_max >= start
+    if end is not None:
+        keep &= t_min <= end
+    return keep
+
+
+class Catalog:
+    """The catalog of the tile tree at `root`, kept in `fname` (by
+    default catalog.sqlite at the root). Any number of processes may
+    update it; SQLite serializes the writers."""
+
+    def __init__(self, root, fname=None, timeout=60):
+        self.root = os.path.abspath(root)
+        self.fname = fname or os.path.join(self.root, CATALOG)
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        self.db = sqlite3.connect(self.fname, timeout=timeout, check_same_thread=False)
+        self.db.executescript(TABLES)
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.days = {}
+        self.tiles = {}
+        self.known = set()
+
+    def close(self):
+        self.db.close()
+
+    def update_dir(self, dir):
+        """Brings the entries for one tile directory up to date with the
+        files in it, describing only the files that changed. A directory
+        that no longer exists is removed."""
+        rel = os.path.relpath(os.path.abspath(dir), self.root)
+        key = dir_day(rel)
+        if key is None:
+            raise ValueError(f"{dir} is not a tile directory under {self.root}")
+        if not os.path.isdir(dir):
+            return self.remove_dir(dir)
+        with self.lock:
+            known = {name: tuple(v) for name, *v in
+                     self.db.execute("SELECT name, mtime_ns, size, ino FROM files WHERE dir = ?", (rel,))}
+        names = mrms_tiles.list_tiles(dir)
+        changed = {}
+        for name in names:
+            st = os.stat(os.path.join(dir, name))
+            if known.get(name) != (st.st_mtime_ns, st.st_size, st.st_ino):
+                changed[name] = describe(os.path.join(dir, name))
+        gone = set(known) - set(names)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel, *key))
+            for name in gone | set(changed):
+                self.db.execute("DELETE FROM files WHERE dir = ? AND name = ?", (rel, name))
+                self.db.execute("DELETE FROM row_groups WHERE dir = ? AND name = ?", (rel, name))
+            for name, (f, groups) in changed.items():
+                self.db.execute("INSERT INTO files VALUES (:dir, :name, :tile_level, :tile, :sparse, :h3_min, :h3_max, "
+                                ":t_min, :t_max, :rows, :mtime_ns, :size, :ino)", dict(f, dir=rel, name=name))
+                self.db.executemany("INSERT INTO row_groups VALUES (:dir, :name, :row_group, :offset, :bytes, "
+                                    ":h3_min, :h3_max, :t_min, :t_max, :rows)",
+                                    [dict(g, dir=rel, name=name) for g in groups])
+            self.data_version = None
+        return len(changed)
+
+    def remove_dir(self, dir):
+        """Removes the entries for a tile directory"""
+        rel = os.path.relpath(os.path.abspath(dir), self.root)
+        with self.lock, self.db:
+            for table in ["dirs", "files", "row_groups"]:
+                self.db.execute(f"DELETE FROM {table} WHERE dir = ?", (rel,))
+            self.data_version = None
+        return 0
+
+    def rebuild(self):
+        """Catalogs every tile directory in the tree and drops the entries
+        of directories that are gone. Returns the number of files that had
+        to be described."""
+        found = []
+        for period in DEPTH:
+            top = os.path.join(self.root, period, "data")
+            for d, subdirs, _ in os.walk(top):
+                subdirs[:] = sorted(s for s in subdirs if not s.startswith(".") and s.isdigit())
+                if dir_day(os.path.relpath(d, self.root)):
+                    found.append(d)
+        with self.lock:
+            known = [rel for rel, in self.db.execute("SELECT dir FROM dirs")]
+        for rel in set(known) - set(os.path.relpath(d, self.root) for d in found):
+            self.remove_dir(os.path.join(self.root, rel))
+        return sum(self.update_dir(d) for d in found)
+
+    def refresh(self):
+        """Reloads the catalog into memory if it changed since last time"""
+        with self.lock:
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return
+            days = {}
+            for rel, period, day in self.db.execute("SELECT dir, period, day FROM dirs ORDER BY dir"):
+                days.setdefault(date.fromisoformat(day), {}).setdefault(period, []).append(
+                    os.path.join(self.root, rel))
+            groups = {}
+            for rel, name, *g in self.db.execute("SELECT dir, name, h3_min, h3_max, t_min, t_max FROM row_groups "
+                                                 "ORDER BY dir, name, row_group"):
+                groups.setdefault((rel, name), []).append(g)
+            tiles = {}
+            for rel, name, level, tile, sparse, t_min, t_max, *version_ in self.db.execute(
+                    "SELECT dir, name, tile_level, tile, sparse, t_min, t_max, mtime_ns, size, ino FROM files"):
+                d = os.path.join(self.root, rel)
+                tiles.setdefault((level, tile), {})[d] = CatalogFile(
+                    os.path.join(d, name), tuple(version_), bool(sparse), t_min, t_max, groups.get((rel, name), []))
+            tiles = {key: CatalogTile(files) for key, files in tiles.items()}
+            known = set(d for periods in days.values() for dirs in periods.values() for d in dirs)
+            self.days, self.tiles, self.known, self.data_version = days, tiles, known, version
+
+    def dirs(self, first, last):
+        """Lists the tile directories covering the days from `first` to
+        `last`, monthly, daily or hourly, just as `TileStore.dirs` would
+        find them. Days the catalog knows nothing about, such as days
+        written before it existed, are looked up on disk."""
+        self.refresh()
+        result = []
+        day = first
+        while day <= last:
+            monthly = self.days.get(day.replace(day=1), {}).get("monthly")
+            if monthly:
+                found = monthly
+            elif day in self.days:
+                found = self.days[day].get("daily") or self.days[day].get("hourly", [])
+            else:
+                found = tree_dirs(self.root, day)
+            result.extend(d for d in found if d not in result[-1:])
+            day += timedelta(days=1)
+        return result
+
+    def files(self, tile_level, tile, dirs, lo, hi, start=None, end=None):
+        """Returns (file name, catalog entry) for each file of a tile in
+        `dirs` that may hold grid points in the sorted h3 ranges from `lo`
+        to `hi` at times from `start` to `end`. Files in directories the
+        catalog doesn't know come with no entry."""
+        self.refresh()
+        known = self.known
+        catalogued = self.tiles.get((tile_level, tile))
+        files = catalogued.files if catalogued is not None else {}
+        wanted = catalogued.wanted(lo, hi, start, end) if catalogued is not None else None
+        result = []
+        for d in dirs:
+            entry = files.get(d)
+            if entry is None and d not in known:
+                d = os.path.abspath(d)
+                entry = files.get(d)
+                if entry is None and d not in known:
+                    result.append((os.path.join(d, mrms_tiles.tile_name(tile_level, tile)), None))
+                    continue
+            if entry is None:
+                continue
+            if (start is None or entry.t_max >= start) and (end is None or entry.t_min <= end):
+                if entry.sparse or wanted[entry.position]:
+                    result.append((entry.path, entry))
+        return result
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Build or update the catalog of a tile tree')
+    parser.add_argument("--root", help="Root of the tile tree written by mrms_split and mrms_merge")
+    parser.add_argument("--catalog", default=None, help="Catalog file. Default is catalog.sqlite under the root")
+
+    args = parser.parse_args()
+    catalog = Catalog(args.root, args.catalog)
+    n = catalog.rebuild()
+    catalog.refresh()
+    print(f"described {n} files, {sum(len(x.files) for x in catalog.tiles.values())} files in {len(catalog.days)} days")
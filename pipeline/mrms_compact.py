@@ -0,0 +1,217 @@
+"""Compaction and retention for the tile tree.
+
+Splitting writes one directory of tiles per hour, and merging adds one per
+day, so left alone the tree grows by about 25 directories and 25 times the
+number of tiles every day (94718 files an hour at tile level 5). This
+folds the tree into coarser directories as it ages:
+
+    hourly/data/yyyy/mm/dd/hh   kept for `hourly_days` days, then folded
+                                into daily/data/yyyy/mm/dd and removed
+    daily/data/yyyy/mm/dd       kept for `daily_days` days after the end of
+                                their month, then folded into
+                                monthly/data/yyyy/mm and removed
+    monthly/data/yyyy/mm        kept
+
+so the tree holds at most about 24 * `hourly_days` + `daily_days` + 31
+directories of tiles plus one per month of history, however long the
+history gets.
+
+Folding uses `mrms_merge.merge_data`, which writes into a staging
+directory and swaps it into place. A monthly directory replaces the days
+of its month for readers (see `TileStore.dirs`) as soon as it is swapped
+in, and finer directories are only removed once their content is in the
+coarser one, by renaming them out of the way first. So a reader sees every
+hour exactly once at all times, and a compaction that is interrupted is
+simply finished by the next one, which first puts back or deletes any
+directory a crash left renamed out of the way.
+
+Hourly directories must be kept longer than the window that `mrms_split`
+revisits, or hours that are still on disk in the source would be split
+again and then merged over the complete day.
+"""
+
+import argparse
+import os
+import shutil
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import mrms_catalog
+import mrms_manifest
+import mrms_merge
+import mrms_metrics
+import mrms_tiles
+
+HOURLY_DAYS = 7
+DAILY_DAYS = 35
+
+
+def remove_dir(dir):
+    """Removes a directory in a way that readers see it either whole or
+    not at all"""
+    if not os.path.exists(dir):
+        return
+    old = f"{dir}{mrms_tiles.OLD}{os.getpid()}"
+    os.rename(dir, old)
+    shutil.rmtree(old)
+
+
+def subdirs(dir):
+    """Lists the numbered subdirectories of a directory"""
+    if not os.path.isdir(dir):
+        return []
+    return [os.path.join(dir, d) for d in sorted(os.listdir(dir)) if d.isdigit()]
+
+
+def recover(dest):
+    """Puts back or deletes the directories that interrupted swaps and
+    removals left in the tree (see `mrms_tiles.recover_dirs`). Returns the
+    number of directories cleaned up."""
+    n = 0
+    for period, depth in mrms_catalog.DEPTH.items():
+        for kind in ["data", "hash"]:
+            top = os.path.join(dest, period, kind)
+            for d, dirs, _ in os.walk(top):
+                n += mrms_tiles.recover_dirs(d, dirs)
+                rel = os.path.relpath(d, top)
+                level = 0 if rel == "." else rel.count(os.sep) + 1
+                # the tile directories themselves are not looked into
+                dirs[:] = [x for x in dirs if x.isdigit()] if level < depth - 1 else []
+    return n
+
+
+def compact_day(dest, day, catalog, workers=2, **options):
+    """Folds the hourly tiles of a day into its daily tiles and removes
+    the hourly directories. Returns the number of hours removed."""
+    path = day.strftime("%Y/%m/%d")
+    hourly = os.path.join(dest, "hourly/data", path)
+    hours = subdirs(hourly)
+    if hours:
+        daily = os.path.join(dest, "daily/data", path)
+        os.makedirs(os.path.dirname(daily), exist_ok=True)
+        # this merges nothing unless an hour changed since the last merge
+        mrms_merge.merge_data(daily, hours, hash_dir=os.path.join(dest, "daily/hash", path), workers=workers,
+                              **options)
+        catalog.update_dir(daily)
+    remove_dir(hourly)
+    remove_dir(os.path.join(dest, "hourly/hash", path))
+    for h in hours:
+        catalog.remove_dir(h)
+    mrms_metrics.add(hours=len(hours))
+    return len(hours)
+
+
+def folded(monthly, daily):
+    """True if every tile of a daily directory went into a monthly one"""
+    artifacts = mrms_manifest.Manifest.load(os.path.join(monthly, mrms_manifest.MANIFEST)).artifacts
+    names = mrms_tiles.list_tiles(daily)
+    day = os.path.basename(daily)
+    return all(artifacts.get(f, {}).get("inputs", {}).get(os.path.join(day, f)) == digest
+               for f, digest in mrms_manifest.dir_hashes(daily, names).items())
+
+
+def compact_month(dest, year, month, catalog, workers=2, **options):
+    """Folds the daily tiles of a month into monthly tiles and removes the
+    daily directories. Returns the number of days removed.
+
+    A month is only folded once it has no hourly directories left. Days
+    that turn up or change after their month was folded are merged into
+    the monthly tiles, replacing what they held for those days."""
+    path = date(year, month, 1).strftime("%Y/%m")
+    if any(subdirs(d) for d in subdirs(os.path.join(dest, "hourly/data", path))):
+        print(f"not compacting {path}, it still has hourly tiles")
+        return 0
+    days = subdirs(os.path.join(dest, "daily/data", path))
+    if not days:
+        return 0
+    monthly = os.path.join(dest, "monthly/data", path)
+    hash_dir = os.path.join(dest, "monthly/hash", path)
+    if os.path.isdir(monthly):
+        # left over from an interrupted compaction, or late
+        late = [d for d in days if not folded(monthly, d)]
+        if late:
+            print(f"folding {len(late)} late days into {monthly}")
+            mrms_merge.merge_data(monthly, late, hash_dir=hash_dir, workers=workers, update=True, **options)
+            catalog.update_dir(monthly)
+    else:
+        os.makedirs(os.path.dirname(monthly), exist_ok=True)
+        mrms_merge.merge_data(monthly, days, hash_dir=hash_dir, workers=workers, **options)
+        catalog.update_dir(monthly)
+    for d in days:
+        remove_dir(d)
+        remove_dir(os.path.join(dest, "daily/hash", path, os.path.basename(d)))
+        catalog.remove_dir(d)
+    mrms_metrics.add(days=len(days))
+    return len(days)
+
+
+def compact(dest, today, hourly_days=HOURLY_DAYS, daily_days=DAILY_DAYS, workers=2, **options):
+    """Folds the hours of days more than `hourly_days` before `today` into
+    days, and the days of months that ended more than `daily_days` before
+    `today` into months. Any `options` (`compact`, `quantum`) are passed
+    to the merge and must match those of `mrms_merge`."""
+    n = recover(dest)
+    if n:
+        print(f"cleaned up {n} directories left by interrupted runs")
+    catalog = mrms_catalog.Catalog(dest)
+    hourly = os.path.join(dest, "hourly/data")
+    for day_dir in [d for y in subdirs(hourly) for m in subdirs(y) for d in subdirs(m)]:
+        day = date(*[int(x) for x in os.path.relpath(day_dir, hourly).split(os.sep)])
+        if day < today - timedelta(days=hourly_days):
+            with mrms_metrics.span("day", day=str(day)):
+                n = compact_day(dest, day, catalog, workers, **options)
+            print(f"folded {n} hours of {day} into a day")
+
+    for year_dir in subdirs(os.path.join(dest, "daily/data")):
+        for month_dir in subdirs(year_dir):
+            year, month = int(os.path.basename(year_dir)), int(os.path.basename(month_dir))
+            end = (date(year, month, 1) + timedelta(days=32)).replace(day=1)
+            if end <= today - timedelta(days=daily_days):
+                with mrms_metrics.span("month", month=f"{year}-{month:02d}"):
+                    n = compact_month(dest, year, month, catalog, workers, **options)
+                print(f"folded {n} days of {year}-{month:02d} into a month")
+    catalog.close()
+    counts = count_files(dest)
+    mrms_metrics.add(**{f"{period}_files": n for period, n in counts.items()})
+    print("files: " + ", ".join(f"{n} {period}" for period, n in counts.items()))
+    return counts
+
+
+def count_files(dest):
+    """Counts the tile files at each level of the tree"""
+    counts = {}
+    for period in ["hourly", "daily", "monthly"]:
+        n = 0
+        for d, dirs, files in os.walk(os.path.join(dest, period, "data")):
+            dirs[:] = [x for x in dirs if x.isdigit()]
+            n += sum(f.startswith("x-") for f in files)
+        counts[period] = n
+    return counts
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Fold old hourly tiles into days and old days into months')
+    parser.add_argument("--dest", help="Root of the tile tree written by mrms_split and mrms_merge")
+    parser.add_argument("--hourly-days", default=HOURLY_DAYS,
+                        help="Days to keep hourly tiles for, longer than mrms_split looks back. "
+                             f"Default is {HOURLY_DAYS}")
+    parser.add_argument("--daily-days", default=DAILY_DAYS,
+                        help=f"Days after the end of a month to keep its daily tiles for. Default is {DAILY_DAYS}")
+    parser.add_argument("--workers", default=2, help="Number of tiles to merge in parallel. Default is 2")
+    parser.add_argument("--compact", action="store_true", help="Use the compact tile encoding, as mrms_merge does")
+    parser.add_argument("--quantum", default=None,
+                        help="Store precipitation as multiples of this amount (compact tiles only), as mrms_merge does")
+    parser.add_argument("--interval", default=None,
+                        help="Keep running, compacting every this many seconds. By default, compact once")
+    mrms_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    while True:
+        with mrms_metrics.run("compact", args.metrics, args.profile):
+            compact(args.dest, datetime.now(timezone.utc).date(), int(args.hourly_days), int(args.daily_days),
+                    workers=int(args.workers), compact=args.compact,
+                    quantum=float(args.quantum) if args.quantum else None)
+        if args.interval is None:
+            break
+        time.sleep(float(args.interval))
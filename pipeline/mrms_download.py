@@ -1,26 +1,83 @@
 import argparse
 import pyarrow.feather as feather
+import hashlib
 import re
 import os
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
 from urllib.request import urlopen
 
+import mrms_manifest
+import mrms_metrics
 
-def download(inventory, dest_dir, max_download=4):
+VERSION = mrms_manifest.stage_version("download", 1)
+CHUNK_SIZE = 1 << 20
+# seconds to wait on a pooled connection
+TIMEOUT = 60
+
+# each worker thread keeps one keep-alive connection per host. The pools
+# of all threads are also kept here by id so close_connections can reach
+# them once the workers are done
+_connections = threading.local()
+_pools = {}
+_pools_lock = threading.Lock()
+
+# statuses that the pooled fetch leaves to urlopen, which follows them
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+def _umask():
+    # the umask can only be read by setting it, which is done once here
+    # rather than while other threads may be creating files
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+UMASK = _umask()
+
+
+def download(inventory, dest_dir, max_download=4, concurrency=1):
     """Given an inventory file for a particular day, and a destination
     directory, download all files in the inventory that are not
     already in the destination directory with the same size.
 
     While at it, don't download more than `max_download` files in this
     call.
+
+    Up to `concurrency` files are fetched at the same time. Each worker
+    reuses a keep-alive connection to each host and streams the response
+    to a temporary file that is renamed into place once complete, so a
+    partial download never looks like a finished one.
+
+    A manifest in `dest_dir` records the inventory entry (url, mtime and
+    size) and the content hash of each downloaded file. A file is also
+    downloaded again if its inventory entry has changed since, as happens
+    when a file is re-issued upstream. The hashes let later stages see
+    which files actually changed without reading them.
+
+    Returns the number of files downloaded.
     """
 
     inv_df = feather.read_feather(inventory)
-    downloads = 0
 
     if not os.path.exists(dest_dir):
         os.mkdir(dest_dir)
+    manifest_file = os.path.join(dest_dir, mrms_manifest.MANIFEST)
+    manifest = mrms_manifest.Manifest.load(manifest_file)
+    if manifest.version != VERSION:
+        manifest = mrms_manifest.Manifest(VERSION, artifacts=manifest.artifacts)
 
+    pending = []
+    skipped = 0
     for i in range(0, inv_df.shape[0]):
+        if len(pending) >= max_download:
+            break
+
         url = inv_df["url"][i]
         file = os.path.basename(url)
 
@@ -32,15 +89,153 @@ def download(inventory, dest_dir, max_download=4):
 
         expected = inv_df["size"][i]
         size_ok = correct_size(expected, output_file)
-        if not os.path.exists(output_file) or not size_ok:
-            with open(output_file, "wb") as out:
+        key = os.path.relpath(output_file, dest_dir)
+        source = dict(url=url, mtime=inv_df["mtime"][i], size=expected)
+        changed = key in manifest.artifacts and not manifest.artifact_current(key, VERSION, source)
+        if not os.path.exists(output_file) or not size_ok or changed:
+            pending.append((url, output_file, key, source))
+        else:
+            skipped += 1
+
+    mrms_metrics.add(files=len(pending), skipped=skipped)
+
+    def job(url, output_file, key, source):
+        manifest.record(key, fetch(url, output_file), source)
+        mrms_metrics.add(bytes=os.path.getsize(output_file))
+
+    try:
+        if concurrency <= 1:
+            for args in pending:
+                job(*args)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                # list() forces any exception from a worker to surface here
+                list(pool.map(lambda args: job(*args), pending))
+    finally:
+        close_connections()
+        if pending:
+            manifest.save(manifest_file)
+    return len(pending)
+
+
+def fetch(url, output_file, chunk_size=CHUNK_SIZE):
+    """Copies the content of `url` into `output_file` a chunk at a time.
+
+    The data is written to a temporary file next to `output_file` which is
+    only renamed to `output_file` after the whole response has been read.
+    Returns the sha256 hash of the content.
+    """
+    print(f"downloading to {output_file} from {url}")
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output_file), prefix=".", suffix=".part")
+    try:
+        # mkstemp makes the file private, but later stages may run as
+        # another user, so it gets the mode open() would have given it
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with _HashingWriter(os.fdopen(fd, "wb")) as out:
+            parts = urlsplit(url)
+            if parts.scheme not in ("http", "https") or not _fetch_pooled(parts, url, out, chunk_size):
+                # other schemes and redirects go through urlopen
                 with urlopen(url) as input:
-                    print(f"downloading to {output_file} from {url}")
-                    out.write(input.read())
-                    print(f"  got {os.stat(output_file).st_size/1024} k bytes")
-                    downloads += 1
-                    if downloads >= max_download:
-                        return
+                    for chunk in iter(lambda: input.read(chunk_size), b""):
+                        out.write(chunk)
+        os.replace(tmp, output_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    print(f"  got {os.stat(output_file).st_size/1024} k bytes")
+    return out.hash.hexdigest()
+
+
+class _HashingWriter:
+    """Wraps an output file so that everything written is also hashed"""
+
+    def __init__(self, out):
+        self.out = out
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.out.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.out.close()
+
+
+def _fetch_pooled(parts, url, out, chunk_size):
+    """Copies the content of `url` to `out` over a pooled connection.
+    Returns False without writing anything if the server redirects."""
+    path = parts.path or "/"
+    if parts.query:
+        path = path + "?" + parts.query
+
+    # a server may drop an idle keep-alive connection at any time, so a
+    # reused connection gets one retry on a fresh socket
+    for attempt in range(2):
+        conn, reused = _connection(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path, headers={"Connection": "keep-alive"})
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            _drop_connection(parts.scheme, parts.netloc)
+            if reused and attempt == 0:
+                continue
+            raise
+        break
+
+    if response.status != 200:
+        response.read()
+        if response.will_close:
+            _drop_connection(parts.scheme, parts.netloc)
+        if response.status in REDIRECTS:
+            return False
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+
+    try:
+        for chunk in iter(lambda: response.read(chunk_size), b""):
+            out.write(chunk)
+    except BaseException:
+        _drop_connection(parts.scheme, parts.netloc)
+        raise
+    if response.will_close:
+        _drop_connection(parts.scheme, parts.netloc)
+    return True
+
+
+def _connection(scheme, netloc):
+    pool = getattr(_connections, "pool", None)
+    if pool is None:
+        pool = _connections.pool = {}
+    conn = pool.get((scheme, netloc))
+    if conn is not None:
+        return conn, True
+    with _pools_lock:
+        _pools[id(pool)] = pool
+    if scheme == "https":
+        conn = http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+    else:
+        conn = http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+    pool[(scheme, netloc)] = conn
+    return conn, False
+
+
+def _drop_connection(scheme, netloc):
+    conn = getattr(_connections, "pool", {}).pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+def close_connections():
+    """Closes the pooled connections of every thread. Only call this when
+    no fetch is in progress."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while pool:
+            pool.popitem()[1].close()
 
 
 def correct_size(expected, file):
@@ -74,10 +269,15 @@ def correct_size(expected, file):
 if __name__ == "__main__":
     # execute only if run as a script
     parser = argparse.ArgumentParser(description='Download MRMS file inventories')
-    parser.add_argument("--inventory", nargs='?', default="inv", 
+    parser.add_argument("--inventory", nargs='?', default="inv",
                         help="Inventory file describing files to download. Default is 'inv'")
     parser.add_argument("--out", help="Root of output tree. Date in yyyy/mm/dd form will be appended")
     parser.add_argument("--max", default=4, help="Maximum number of files to download in this step")
+    parser.add_argument("--concurrency", default=1,
+                        help="Number of files to download at the same time. Default is 1")
+
+    mrms_metrics.add_arguments(parser)
 
     args = parser.parse_args()
-    inv = download(args.inventory, args.out, max_download=int(args.max))
+    with mrms_metrics.run("download", args.metrics, args.profile):
+        download(args.inventory, args.out, max_download=int(args.max), concurrency=int(args.concurrency))
@@ -0,0 +1,87 @@
+"""A persistent cache of the H3 ids of the points of a fixed grid.
+
+The MRMS and CPC grids never change, but turning millions of grid points
+into H3 ids is the most expensive step of splitting each hour. The cache
+computes the fine H3 id of every point once, derives coarser levels from
+it by truncation (see `mrms_h3.parents`) and keeps each level as a `.npy`
+file in a directory named after the grid definition so that later runs
+just memory map the arrays.
+
+A grid is identified by its shape, origin, far corner and spacing plus a
+checksum of a sample of its coordinates, which tells apart grids that
+agree in those but not elsewhere without hashing every point.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import mrms_h3
+
+# every SAMPLE-th coordinate goes into the grid key
+SAMPLE = 997
+
+
+def definition(lats, lons):
+    """Returns a description of a grid from the coordinates of its points"""
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    flat_lats, flat_lons = lats.reshape(-1), lons.reshape(-1)
+    sample = hashlib.sha256()
+    sample.update(np.ascontiguousarray(flat_lats[::SAMPLE], dtype=np.float64).tobytes())
+    sample.update(np.ascontiguousarray(flat_lons[::SAMPLE], dtype=np.float64).tobytes())
+    spacing = [float(flat_lats[1] - flat_lats[0]), float(flat_lons[1] - flat_lons[0])] if flat_lats.size > 1 else [0, 0]
+    return dict(shape=list(lats.shape),
+                origin=[float(flat_lats[0]), float(flat_lons[0])],
+                end=[float(flat_lats[-1]), float(flat_lons[-1])],
+                spacing=spacing,
+                sample=sample.hexdigest()[:16])
+
+
+def grid_key(grid):
+    """Returns a short name for a grid definition"""
+    return hashlib.sha256(json.dumps(grid, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class GridGeometry:
+    """The H3 ids of the points of one grid, backed by a cache directory.
+
+    `cells(level)` returns the ids at any level up to `res`, in the same
+    order as the coordinates the geometry was made from. The arrays are
+    read-only memory maps once they have been cached.
+    """
+
+    def __init__(self, lats, lons, cache_dir, res=mrms_h3.MAX_RES):
+        self.res = res
+        self.grid = definition(lats, lons)
+        self.dir = os.path.join(cache_dir, f"grid-{grid_key(self.grid)}")
+        self._cells = {}
+        if not os.path.exists(self._file(res)):
+            os.makedirs(self.dir, exist_ok=True)
+            with open(os.path.join(self.dir, "grid.json"), "w") as out:
+                json.dump(self.grid, out, indent=1)
+            self._save(res, mrms_h3.cells(np.asarray(lats).reshape(-1), np.asarray(lons).reshape(-1), res))
+
+    def cells(self, level=None):
+        level = self.res if level is None else level
+        if level not in self._cells:
+            if not os.path.exists(self._file(level)):
+                if level > self.res:
+                    raise ValueError(f"Can't derive level {level} from level {self.res} cells")
+                self._save(level, mrms_h3.parents(self.cells(self.res), level))
+            self._cells[level] = np.load(self._file(level), mmap_mode="r")
+        return self._cells[level]
+
+    def _file(self, level):
+        return os.path.join(self.dir, f"cells-{level}.npy")
+
+    def _save(self, level, cells):
+        # several processes may fill the cache at once, so each writes a
+        # private file and renames it into place
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".", suffix=".npy")
+        with os.fdopen(fd, "wb") as out:
+            np.save(out, np.asarray(cells, dtype=np.int64))
+        os.replace(tmp, self._file(level))
@@ -0,0 +1,86 @@
+import numpy as np
+import h3.api.basic_int as h3api
+
+# h3 4.x renamed geo_to_h3 to latlng_to_cell
+_to_cell = getattr(h3api, "latlng_to_cell", None) or h3api.geo_to_h3
+_to_latlng = getattr(h3api, "cell_to_latlng", None) or getattr(h3api, "h3_to_geo", None)
+_disk = getattr(h3api, "grid_disk", None) or getattr(h3api, "k_ring", None)
+
+RES_SHIFT = 52
+RES_MASK = 0xF << RES_SHIFT
+DIGIT_BITS = 3
+MAX_RES = 15
+
+
+def cells(lats, lons, res=MAX_RES):
+    """Returns the H3 cell at resolution `res` for each latitude/longitude
+    pair as a vector of signed 64-bit integers.
+
+    The h3 bindings have no vectorized lookup, so this makes one call per
+    point, several seconds for the millions of points of the MRMS grid.
+    Fixed grids should go through the cache of `mrms_grid`, which does
+    this once per grid; everything coarser comes from `parents`.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    return np.fromiter((_to_cell(a, b, res) for a, b in zip(lats.tolist(), lons.tolist())),
+                       dtype=np.int64, count=len(lats))
+
+
+def cell(lat, lon, res=MAX_RES):
+    """Returns the H3 cell at resolution `res` for a single point"""
+    return _to_cell(float(lat), float(lon), res)
+
+
+def centers(cells):
+    """Returns vectors of the latitudes and longitudes of the centers of a
+    vector of H3 cells."""
+    cells = np.asarray(cells, dtype=np.int64)
+    result = np.array([_to_latlng(c) for c in cells.tolist()], dtype=np.float64).reshape(-1, 2)
+    return result[:, 0], result[:, 1]
+
+
+def disk(cell, k):
+    """Returns the cells within grid distance `k` of a cell"""
+    return np.array(list(_disk(int(cell), k)), dtype=np.int64)
+
+
+def cover(geometry, res):
+    """Returns the cells at resolution `res` whose centers lie in a GeoJSON
+    Polygon or MultiPolygon (coordinates in longitude, latitude order)."""
+    if hasattr(h3api, "geo_to_h3shape"):
+        cells = h3api.h3shape_to_cells(h3api.geo_to_h3shape(geometry), res)
+    else:
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        cells = set()
+        for p in polygons:
+            cells |= h3api.polyfill(dict(type="Polygon", coordinates=p), res, geo_json_conformant=True)
+    return np.array(sorted(cells), dtype=np.int64)
+
+
+def child_range(cells):
+    """Returns the smallest and largest level 15 descendant of each of a
+    vector of H3 cells. All level 15 ids in between are descendants too,
+    so a cell covers a contiguous range of sorted level 15 ids."""
+    cells = np.asarray(cells, dtype=np.int64)
+    unused = (np.int64(1) << (DIGIT_BITS * (MAX_RES - resolution(cells)))) - 1
+    lo = (cells & ~RES_MASK & ~unused) | (MAX_RES << RES_SHIFT)
+    # digit 7 is never used, so the last descendant has all digits 6
+    return lo, lo | (unused & 0o666666666666666)
+
+
+def parents(cells, res):
+    """Returns the ancestor at resolution `res` of each of a vector of H3
+    cells. This only rewrites bits in the index so it works on millions of
+    cells at once, far faster than computing each parent from scratch.
+
+    The cells must all have a resolution of at least `res`.
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    unused = (1 << (DIGIT_BITS * (MAX_RES - res))) - 1
+    return (cells & ~RES_MASK) | (res << RES_SHIFT) | unused
+
+
+def resolution(cells):
+    """Returns the resolution of each of a vector of H3 cells."""
+    return (np.asarray(cells, dtype=np.int64) & RES_MASK) >> RES_SHIFT
@@ -0,0 +1,126 @@
+"""An index of the grid points in the tile store for finding the grid
+points nearest to a latitude and longitude without reading any tiles.
+
+The index holds every grid point (as its level 15 h3 id) together with the
+latitude and longitude of its center, sorted by the ancestor of the point
+at a coarse `level` (6 by default, a cell about 3.2 km across, so that a
+1 km MRMS grid puts a few dozen points in each). To find the nearest point
+to a location, only the points under the coarse cell holding the location
+and its immediate neighbors need to be compared.
+
+The index is stored as an uncompressed Arrow file with a single record
+batch so it can be memory mapped and used without being parsed.
+"""
+
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+
+import mrms_h3
+import mrms_metrics
+import mrms_tiles
+
+SCHEMA = pa.schema([("key", pa.int64()), ("h3", pa.int64()),
+                    ("latitude", pa.float64()), ("longitude", pa.float64())])
+
+
+def grid_points(dirs):
+    """Returns the sorted h3 ids of all grid points in the tile files in
+    `dirs`. Sparse tiles list all of their grid points in their manifest,
+    so only the h3 column of dense tiles has to be read."""
+    points = []
+    for d in dirs:
+        for f in mrms_tiles.list_tiles(d):
+            fname = os.path.join(d, f)
+            m = mrms_tiles.read_manifest(fname)
+            if m is not None:
+                points.append(m[0])
+            else:
+                points.append(np.unique(mrms_tiles.read_tile(fname, columns=["h3"])["h3"].to_numpy()))
+    return np.unique(np.concatenate(points + [np.zeros(0, np.int64)]))
+
+
+def build_index(dirs, output, level=6):
+    """Builds an index of the grid points found in the tiles in `dirs` and
+    writes it to `output`. Since every hour of data has the same grid, the
+    tiles of a single hour are enough. Returns the number of points."""
+    t0 = time.time()
+    points = grid_points(dirs)
+    keys = mrms_h3.parents(points, level)
+    order = np.argsort(keys, kind="stable")
+    points, keys = points[order], keys[order]
+    lats, lons = mrms_h3.centers(points)
+    table = pa.Table.from_arrays([pa.array(keys), pa.array(points), pa.array(lats), pa.array(lons)], schema=SCHEMA)
+    table = table.replace_schema_metadata({b"level": str(level).encode()})
+
+    tmp = output + ".tmp"
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(1, len(points)))
+    os.replace(tmp, output)
+    mrms_metrics.add(points=len(points))
+    print(f"indexed {len(points)} grid points into {output} in {time.time() - t0:.1f}s")
+    return len(points)
+
+
+class GridIndex:
+    """A memory mapped grid point index"""
+
+    def __init__(self, fname):
+        self.source = pa.memory_map(fname)
+        table = pa.ipc.open_file(self.source).read_all()
+        self.level = int(table.schema.metadata[b"level"])
+        # a single chunk without nulls converts without copying
+        self.key, self.h3, self.latitude, self.longitude = [table[c].combine_chunks().to_numpy()
+                                                            for c in SCHEMA.names]
+
+    def __len__(self):
+        return len(self.h3)
+
+    def candidates(self, latitude, longitude):
+        """Returns the rows of the index for the coarse cell containing a
+        location and its neighbors"""
+        keys = mrms_h3.disk(mrms_h3.cell(latitude, longitude, self.level), 1)
+        lo = np.searchsorted(self.key, keys, "left")
+        hi = np.searchsorted(self.key, keys, "right")
+        return np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])
+
+    def nearest(self, latitude, longitude, k=1):
+        """Returns the h3 ids of the `k` grid points nearest to a location,
+        nearest first. Points that are as close as the k-th are included
+        as well, so ties are all returned. The result is empty if there
+        are no grid points near the location."""
+        rows = self.candidates(latitude, longitude)
+        if len(rows) == 0:
+            return np.zeros(0, np.int64)
+        d = self.distances(rows, latitude, longitude)
+        order = np.argsort(d, kind="stable")
+        cutoff = d[order[min(k, len(order)) - 1]]
+        order = order[d[order] <= cutoff * (1 + 1e-9)]
+        return self.h3[rows[order]]
+
+    def distances(self, rows, latitude, longitude):
+        """Returns the approximate distance in km from a location to the
+        grid points in `rows`. Over a few km, an equirectangular projection
+        is plenty accurate."""
+        dy = np.radians(self.latitude[rows] - latitude)
+        dx = np.radians((self.longitude[rows] - longitude + 180) % 360 - 180) * math.cos(math.radians(latitude))
+        return 6371.0 * np.hypot(dx, dy)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Build an index of the nearest MRMS grid points')
+    parser.add_argument("--tiles", nargs="+", help="Directories of tile files, such as one split hour")
+    parser.add_argument("--output", help="File to write the index to")
+    parser.add_argument("--level", default=6, help="H3 resolution of the index keys. Default is 6")
+
+    mrms_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    with mrms_metrics.run("index", args.metrics, args.profile):
+        build_index(args.tiles, args.output, level=int(args.level))
@@ -2,14 +2,34 @@ import argparse
 from urllib.request import urlopen
 from urllib.error import HTTPError
 from urllib.error import URLError
+from urllib.parse import urlsplit
 
+import os
 import re
+import http.client
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import timedelta
+from datetime import timezone
 from datetime import date
 from datetime import datetime
 import pandas
 import pyarrow.feather
 
+import mrms_metrics
+
+COLUMNS = ["date", "url", "mtime", "size"]
+CATALOG_COLUMNS = COLUMNS + ["dir", "crawled"]
+
+# Pass 2 files for an hour show up about two hours after the hour ends
+PASS2_LATENCY = timedelta(hours=2)
+
+# HTTP status codes that are worth asking about again
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+
 def inventory(start=-200, end=date.today(),
               url="https://mtarchive.geol.iastate.edu/{year:4d}/{month:02d}/{day:02d}/mrms/ncep/{dir:s}",
               file_prefix="",
@@ -17,7 +37,13 @@ def inventory(start=-200, end=date.today(),
               anchor_pattern='<a href={quote_char}({file_prefix}.*?){quote_char}.*?</a>.*?{date_pattern}.*?{size_pattern}',
               quote_char='"',
               mtime_pattern=r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2})",
-              size_pattern=r"(\d+[KM])"):
+              size_pattern=r"(\d+[KM])",
+              catalog=None,
+              latency=PASS2_LATENCY,
+              workers=1,
+              per_host=4,
+              retries=3,
+              backoff=1.0):
     """Reads file inventories from a website for dates ranging from
     `start` to `end` (inclusive). The result is a dataframe containing
     the date for file, the URL for a file, the last-modified time and
@@ -53,6 +79,23 @@ def inventory(start=-200, end=date.today(),
     values. If you set these, make sure you surround the pattern with
     "()" so that the matched string will be captured and returned.
 
+    If `catalog` names a file, the inventory of each day is kept there
+    between calls. Days that were crawled after they were sealed (the end
+    of the day plus the Pass 2 `latency`) are read from the catalog instead
+    of the web. All other days are crawled and the catalog is updated. The
+    catalog assumes that the url and patterns don't change between calls.
+
+    Days after today (UTC) have no data yet and are never requested.
+
+    With `workers` greater than one, all days that need crawling are read
+    in parallel (see `crawl_days`). No more than `per_host` requests are
+    in flight against any one host. Either way, the result is in date
+    order.
+
+    Transient failures (connection errors and 5xx responses) are retried
+    up to `retries` times, waiting `backoff` seconds and doubling that
+    wait after each attempt.
+
     """
 
     dt = timedelta(days=1)
@@ -68,47 +111,216 @@ def inventory(start=-200, end=date.today(),
                                                date_pattern=mtime_pattern,
                                                size_pattern=size_pattern))
 
-    results = pandas.DataFrame({}, [], ["date", "url", "mtime", "size"])
+    cached = read_catalog(catalog) if catalog else None
+    crawled = []
+    days = []
 
+    dates = []
+    today = utcnow().date()
     t = start
-    while (t <= end):
-        soup = None
+    while t <= min(end, today):
+        dates.append(t)
+        t = t + dt
+
+    known = {t: sealed_day(cached, t, latency) if cached is not None else None for t in dates}
+    limiter = HostLimiter(per_host)
+    if workers > 1:
+        missing = [t for t in dates if known[t] is None]
+        fresh = dict(zip(missing, crawl_days(missing, url, search_path, pattern, workers=workers,
+                                             limiter=limiter, retries=retries, backoff=backoff, latency=latency)))
+
+    for t in dates:
+        day = known[t]
+        if day is None:
+            if workers > 1:
+                day = fresh[t]
+            else:
+                day = crawl_day(t, url, search_path, pattern, limiter=limiter, retries=retries, backoff=backoff)
+            if day is None:
+                # today's directory may not be there yet
+                if t < today:
+                    attempted_url = url.format(year=t.year, month=t.month, day=t.day, dir="DIR_IN_PATH")
+                    raise ValueError(f"Cannot find appropriate data directory under {attempted_url}")
+                else:
+                    break
+            crawled.append(day)
+        days.append(day)
+
+    if catalog and crawled:
+        write_catalog(catalog, cached, crawled)
+    mrms_metrics.add(days=len(days), crawled=len(crawled), skipped=len(days) - len(crawled),
+                     files=sum(day.shape[0] for day in days))
+
+    if not days:
+        return pandas.DataFrame(columns=COLUMNS)
+    return pandas.concat(days, ignore_index=True)[COLUMNS]
+
+
+def crawl_day(t, url, search_path, pattern, limiter=None, retries=3, backoff=1.0):
+    """Reads the inventory page for a single day, trying each directory
+    in `search_path` in turn. Returns a dataframe with one row per file
+    plus the directory that was found and the time of the crawl, or None
+    if none of the directories exist.
+    """
+    for dir in search_path:
+        actual_url = url.format(year=t.year, month=t.month, day=t.day, dir=dir)
+        soup = read_page(actual_url, limiter, retries, backoff)
+        if soup:
+            return parse_day(t, dir, actual_url, soup, pattern)
+    return None
+
+
+def crawl_days(dates, url, search_path, pattern, workers=8, limiter=None, retries=3, backoff=1.0,
+               latency=PASS2_LATENCY):
+    """Reads the inventory pages for many days using a pool of `workers`
+    threads. For each day, the first directory in `search_path` order
+    that exists is used. Returns a list of dataframes (or None for days
+    with no data) in the same order as `dates`.
+
+    The first directory of `search_path` is requested for every day. The
+    others are requested along with it for days that aren't sealed yet
+    (see `sealed_day`), whose Pass 2 files may not be there yet, and
+    only once it turns out to be missing for days that are.
+    """
+    now = utcnow()
+    pages = {}
+
+    def fetch(pool, wanted):
+        urls = [url.format(year=t.year, month=t.month, day=t.day, dir=dir) for t, dir in wanted]
+        pages.update(zip(wanted, pool.map(lambda u: (u, read_page(u, limiter, retries, backoff)), urls)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetch(pool, [(t, dir) for t in dates for k, dir in enumerate(search_path)
+                     if k == 0 or sealed_time(t, latency) > now])
+        fetch(pool, [(t, dir) for t in dates for dir in search_path[1:]
+                     if (t, dir) not in pages and not pages[t, search_path[0]][1]])
+
+    results = []
+    for t in dates:
+        day = None
         for dir in search_path:
-            actual_url = url.format(year=t.year, month=t.month, day=t.day, dir=dir)
-            try:
+            actual_url, page = pages.get((t, dir), (None, None))
+            if day is None and page:
+                day = parse_day(t, dir, actual_url, page, pattern)
+        results.append(day)
+    return results
+
+
+def read_page(actual_url, limiter=None, retries=3, backoff=1.0):
+    """Returns the content of a page as a string or None if the server
+    says there is no such page. Transient errors are retried with an
+    exponentially increasing delay before giving up.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with limiter(actual_url) if limiter else nullcontext():
                 with urlopen(actual_url) as input:
-                    soup = input.read().decode('utf-8')
-                    break
-            
-            except HTTPError:
-                pass
+                    content = input.read()
+                    mrms_metrics.add(pages=1, bytes=len(content))
+                    return content.decode('utf-8')
 
-            except URLError as e:
+        except HTTPError as e:
+            if e.code not in TRANSIENT_STATUS or attempt == retries:
+                return None
+            print(f"Retrying {actual_url} after {e.code}")
+
+        except (URLError, ConnectionError, TimeoutError, http.client.HTTPException) as e:
+            if attempt == retries:
                 print(f"Unable to download {actual_url}")
                 raise e
+            print(f"Retrying {actual_url} after {e}")
 
-            except Error as e:
-                print(f"Unable to download {actual_url} due to {e}")
-                raise e
+        except Exception as e:
+            print(f"Unable to download {actual_url} due to {e}")
+            raise e
 
+        time.sleep(backoff * 2 ** attempt)
 
-        if not soup:
-            if t <= date.today():
-                attempted_url = url.format(year=t.year, month=t.month, day=t.day, dir="DIR_IN_PATH")
-                raise ValueError(f"Cannot find appropriate data directory under {attempted_url}")
-            else:
-                break
 
-        for m in re.finditer(pattern, soup):
-            file = actual_url + "/" + m.group(1)
-            extras = [m.group(i) for i in range(2, len(m.groups()) + 1)]
-            while len(extras) < 2:
-                extras.append(None)
-            results = results.append(dict(date=t, url=file, mtime=extras[0], size=extras[1]), ignore_index=True)
+def parse_day(t, dir, actual_url, soup, pattern):
+    """Extracts the files listed on the inventory page for day `t`."""
+    # collect each column in one pass and build the frame in one go
+    urls, mtimes, sizes = [], [], []
+    for m in re.finditer(pattern, soup):
+        urls.append(actual_url + "/" + m.group(1))
+        extras = [m.group(i) for i in range(2, len(m.groups()) + 1)]
+        while len(extras) < 2:
+            extras.append(None)
+        mtimes.append(extras[0])
+        sizes.append(extras[1])
 
-        t = t + dt
+    n = len(urls)
+    return pandas.DataFrame(dict(date=[t] * n, url=urls, mtime=mtimes, size=sizes,
+                                 dir=[dir] * n, crawled=[utcnow()] * n),
+                            columns=CATALOG_COLUMNS)
 
-    return results
+
+def sealed_day(cached, t, latency=PASS2_LATENCY):
+    """Returns the catalog rows for day `t` if that day was crawled after
+    it was sealed, that is, after the last hour of the day plus `latency`
+    had passed. Returns None if the day has to be crawled (again).
+    """
+    rows = cached[cached["date"] == t]
+    if rows.shape[0] == 0:
+        return None
+    sealed = sealed_time(t, latency)
+    if sealed > utcnow() or rows["crawled"].min() < sealed:
+        return None
+    return rows
+
+
+def sealed_time(t, latency=PASS2_LATENCY):
+    """Returns the time in UTC after which the files of day `t` no longer
+    change, the end of its last hour plus `latency`"""
+    return datetime.combine(t + timedelta(days=1), datetime.min.time()) + latency
+
+
+def read_catalog(catalog):
+    """Reads a catalog of previous inventory crawls. A missing catalog is
+    the same as an empty one.
+    """
+    if not os.path.exists(catalog):
+        return pandas.DataFrame(columns=CATALOG_COLUMNS)
+    cached = pyarrow.feather.read_feather(catalog)
+    cached["crawled"] = pandas.to_datetime(cached["crawled"])
+    return cached
+
+
+def write_catalog(catalog, cached, crawled):
+    """Replaces the days in `cached` that were just crawled and writes the
+    combined catalog sorted by date and url. The catalog is written to a
+    temporary file and renamed so that readers never see a partial file.
+    """
+    fresh = set(day["date"].iloc[0] for day in crawled if day.shape[0] > 0)
+    kept = cached[~cached["date"].isin(fresh)]
+    result = pandas.concat([kept] + crawled, ignore_index=True)
+    result = result.sort_values(["date", "url"], kind="stable", ignore_index=True)
+    tmp = catalog + ".tmp"
+    with open(tmp, "wb") as output:
+        pyarrow.feather.write_feather(result, output)
+    os.replace(tmp, catalog)
+
+
+class HostLimiter:
+    """Bounds the number of requests in flight to each host. Calling the
+    limiter with a url returns a semaphore to hold during the request.
+    """
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 def force_date(t, base=date.today()):
@@ -139,7 +351,7 @@ def parse_date(s):
     if mx.match(s):
         return int(s)
     else:
-        return datetime.strptime(s, "%Y-%m-%d")
+        return datetime.strptime(s, "%Y-%m-%d").date()
 
 
 if __name__ == "__main__":
@@ -149,9 +361,18 @@ if __name__ == "__main__":
                         help="Starting date in yyyy-mm-dd form or the number of days before the ending date")
     parser.add_argument("--end", nargs='?', default="0",
                         help="Ending date in yyyy-mm-dd form or as number of days offset today. Default is today")
+    parser.add_argument("--catalog", nargs='?', default=None,
+                        help="File that keeps inventories of sealed days between runs")
+    parser.add_argument("--workers", default=1,
+                        help="Number of days to crawl in parallel. Default is 1")
+    parser.add_argument("--per-host", default=4,
+                        help="Maximum number of concurrent requests to one host. Default is 4")
     parser.add_argument("out", help="Output file name")
+    mrms_metrics.add_arguments(parser)
 
     args = parser.parse_args()
-    inv = inventory(parse_date(args.start), parse_date(args.end))
-    with open(args.out, "wb") as output:
-        pyarrow.feather.write_feather(inv, output)
+    with mrms_metrics.run("inventory", args.metrics, args.profile):
+        inv = inventory(parse_date(args.start), parse_date(args.end), catalog=args.catalog,
+                        workers=int(args.workers), per_host=int(args.per_host))
+        with open(args.out, "wb") as output:
+            pyarrow.feather.write_feather(inv, output)
@@ -0,0 +1,93 @@
+"""Manifests record what went into the artifacts that a pipeline stage
+produced so that the stage can tell what it needs to redo.
+
+A manifest is a small JSON file kept next to the artifacts. It holds the
+version of the stage that wrote it (including any options that change
+the output), the inputs of the stage as a dictionary of names to content
+hashes (or other fingerprints such as a size and modification time) and,
+for each artifact, the hash of its content and the inputs that it was
+built from. An artifact only needs to be rebuilt if the stage version or
+any of its inputs differ from what the manifest recorded.
+
+Since manifests hold the content hash of every artifact, the next stage
+can use them as its own input hashes without reading the artifacts.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST = "manifest.json"
+
+
+def stage_version(stage, version, **options):
+    """Returns a version string for a stage that changes whenever the code
+    version or any option affecting the output changes.
+    """
+    settings = ",".join(f"{k}={options[k]}" for k in sorted(options) if options[k] is not None)
+    return f"{stage}-{version}" + (f"({settings})" if settings else "")
+
+
+def file_hash(fname, chunk_size=1 << 20):
+    """Returns the sha256 hash of a file's content"""
+    h = hashlib.sha256()
+    with open(fname, "rb") as input:
+        for chunk in iter(lambda: input.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """The recorded inputs and artifacts of one run of a stage"""
+
+    def __init__(self, version=None, inputs=None, artifacts=None):
+        self.version = version
+        self.inputs = inputs or {}
+        self.artifacts = artifacts or {}
+
+    @classmethod
+    def load(cls, fname):
+        """Reads a manifest. A missing file gives an empty manifest."""
+        if not os.path.exists(fname):
+            return cls()
+        with open(fname) as input:
+            m = json.load(input)
+        return cls(m.get("version"), m.get("inputs"), m.get("artifacts"))
+
+    def save(self, fname):
+        """Writes the manifest via a temporary file so it is never partial"""
+        tmp = fname + ".tmp"
+        with open(tmp, "w") as out:
+            json.dump(dict(version=self.version, inputs=self.inputs, artifacts=self.artifacts), out,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, fname)
+
+    def exists(self):
+        return self.version is not None
+
+    def current(self, version, inputs):
+        """True if this manifest was written by `version` from `inputs`"""
+        return self.version == version and self.inputs == inputs
+
+    def artifact_current(self, name, version, inputs):
+        """True if artifact `name` was built by `version` from `inputs`"""
+        entry = self.artifacts.get(name)
+        return self.version == version and entry is not None and entry.get("inputs") == inputs
+
+    def record(self, name, hash, inputs=None):
+        self.artifacts[name] = dict(hash=hash, inputs=inputs or {})
+
+    def hash(self, name):
+        entry = self.artifacts.get(name)
+        return entry["hash"] if entry else None
+
+    def hashes(self):
+        return {name: entry["hash"] for name, entry in self.artifacts.items()}
+
+
+def dir_hashes(dir, names):
+    """Returns the content hashes of the files `names` in `dir`, taken from
+    the manifest in `dir` where possible and computed otherwise.
+    """
+    recorded = Manifest.load(os.path.join(dir, MANIFEST)).hashes()
+    return {name: recorded.get(name) or file_hash(os.path.join(dir, name)) for name in names}
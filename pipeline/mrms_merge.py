@@ -0,0 +1,237 @@
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import numpy as np
+
+import mrms_catalog
+import mrms_manifest
+import mrms_metrics
+import mrms_tiles
+from mrms_inventory import force_date, parse_date
+
+VERSION = 1
+
+# rows read from each input at a time
+BATCH_SIZE = 65536
+
+
+def merge_tile(output, inputs, batch_size=BATCH_SIZE, compact=False, quantum=None):
+    """Merges copies of one tile from several files into `output` and
+    returns the hash of the result. Each input must be sorted by h3 and
+    time, which makes a streaming k-way merge possible: only one batch of
+    at most `batch_size` rows per input is held in memory at a time and
+    the output stays sorted by h3 and time.
+
+    If the same h3 and time appears in more than one input, the row from
+    the last such input wins. The result is sparse if the inputs are
+    sparse, in which case the manifests of the inputs are combined. A
+    sparse input holds a zero for every grid point and time of its
+    manifest that it has no row for, so such a missing row also wins over
+    the rows of earlier inputs.
+    """
+    manifests = [mrms_tiles.read_manifest(f) for f in inputs]
+    sparse = [m is not None for m in manifests]
+    if any(sparse) and not all(sparse):
+        raise ValueError(f"Can't merge sparse and dense copies of {os.path.basename(output)}")
+
+    points = times = None
+    if all(sparse):
+        points = np.unique(np.concatenate([m[0] for m in manifests]))
+        times = np.unique(np.concatenate([m[1] for m in manifests]))
+    t0, t_step = 0, 0
+    if compact:
+        t0, t_step = mrms_tiles.combine_time_bases([mrms_tiles.read_time_base(f, batch_size) for f in inputs])
+
+    streams = [_Stream(f, i, batch_size) for i, f in enumerate(inputs)]
+    with mrms_tiles.TileWriter(output, points=points, times=times, compact=compact, quantum=quantum,
+                               t0=t0, t_step=t_step) as out:
+        active = [s for s in streams if not s.done]
+        while active:
+            # every row at or below the smallest buffered maximum is ready
+            bound = min(s.last() for s in active)
+            parts = [s.take_through(bound) for s in active]
+            h3, t, precipitation, source = [np.concatenate(x) for x in zip(*parts)]
+            if all(sparse):
+                # rows that a later input says are dry
+                stale = np.zeros(len(h3), bool)
+                for j, (points_j, times_j) in enumerate(manifests[1:], 1):
+                    stale |= (source < j) & _member(h3, points_j) & _member(t, times_j)
+                h3, t, precipitation, source = h3[~stale], t[~stale], precipitation[~stale], source[~stale]
+            order = np.lexsort((source, t, h3))
+            h3, t, precipitation = h3[order], t[order], precipitation[order]
+            last = np.r_[(h3[1:] != h3[:-1]) | (t[1:] != t[:-1]), True][:len(h3)]
+            out.write(h3[last], t[last], precipitation[last])
+            active = [s for s in streams if not s.done]
+    return out.digest
+
+
+def _member(x, values):
+    """Tells which of `x` are in the sorted `values`"""
+    i = np.minimum(np.searchsorted(values, x), max(len(values) - 1, 0))
+    return (values[i] == x) if len(values) else np.zeros(len(x), bool)
+
+
+class _Stream:
+    """One sorted input to the merge with its current batch"""
+
+    def __init__(self, fname, index, batch_size):
+        self.index = index
+        self.batches = mrms_tiles.iter_tile(fname, batch_size)
+        self.done = False
+        self._next()
+
+    def _next(self):
+        for batch in self.batches:
+            if batch.num_rows > 0:
+                self.h3 = batch["h3"].to_numpy()
+                self.t = batch["t"].to_numpy()
+                self.precipitation = batch["precipitation"].to_numpy()
+                return
+        self.done = True
+
+    def last(self):
+        return self.h3[-1], self.t[-1]
+
+    def take_through(self, bound):
+        """Removes and returns all buffered rows with (h3, t) <= bound"""
+        h3, t = bound
+        lo = np.searchsorted(self.h3, h3, "left")
+        hi = np.searchsorted(self.h3, h3, "right")
+        k = lo + np.searchsorted(self.t[lo:hi], t, "right")
+        result = (self.h3[:k], self.t[:k], self.precipitation[:k], np.full(k, self.index))
+        if k == len(self.h3):
+            self._next()
+        else:
+            self.h3, self.t, self.precipitation = self.h3[k:], self.t[k:], self.precipitation[k:]
+        return result
+
+
+def merge_data(output, dirs, hash_dir=None, workers=2, batch_size=BATCH_SIZE, update=False, **options):
+    """Merges the tile files with the same name across `dirs` into one file
+    by that name in `output`, tiles being processed in parallel by a pool
+    of `workers` processes. Hashes of the merged files go into `hash_dir`
+    if one is given.
+
+    A manifest in `output` records the hashes of the inputs of every
+    merged tile. Only tiles whose inputs (or the options) changed since
+    the last merge are merged again, the others are linked from the
+    previous output. Nothing is written at all if no tile changed.
+
+    With `update`, `dirs` are merged into the previous content of `output`
+    rather than replacing it: each tile of `output` is merged with the
+    copies in `dirs`, which win, and keeps the inputs it was made from in
+    its manifest.
+
+    Everything is written into staging directories first which are then
+    swapped into place, so nobody ever sees a half merged `output`. Any
+    `options` (`compact`, `quantum`) are passed to `merge_tile`. Returns
+    the number of tiles that were merged.
+    """
+    dirs = sorted(dirs)
+    if not dirs:
+        return 0
+    base = os.path.commonpath(dirs) if len(dirs) > 1 else os.path.dirname(dirs[0])
+    inputs = {}
+    for d in dirs:
+        names = mrms_tiles.list_tiles(d)
+        for f, digest in mrms_manifest.dir_hashes(d, names).items():
+            inputs.setdefault(f, {})[os.path.join(os.path.relpath(d, base), f)] = digest
+    version = mrms_manifest.stage_version("merge", VERSION, **options)
+    previous = mrms_manifest.Manifest.load(os.path.join(output, mrms_manifest.MANIFEST))
+    if update:
+        for f, entry in previous.artifacts.items():
+            inputs[f] = dict(entry["inputs"], **inputs.get(f, {}))
+    files = sorted(inputs)
+    changed = set(f for f in files if not previous.artifact_current(f, version, inputs[f]))
+    mrms_metrics.add(tiles=len(changed), skipped=len(files) - len(changed))
+    if not changed and sorted(previous.artifacts) == files:
+        return 0
+
+    staging = output + ".partial"
+    staging_hash = hash_dir + ".partial" if hash_dir else None
+    for d in [staging, staging_hash]:
+        if d:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.makedirs(d)
+
+    manifest = mrms_manifest.Manifest(version)
+    for f in files:
+        if f not in changed:
+            mrms_tiles.link(os.path.join(output, f), os.path.join(staging, f))
+            manifest.record(f, previous.hash(f), inputs[f])
+            if staging_hash:
+                mrms_tiles.write_hash(os.path.join(staging_hash, f), previous.hash(f))
+
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for f in sorted(changed):
+            sources = [os.path.join(d, f) for d in ([output] if update else []) + dirs
+                       if os.path.exists(os.path.join(d, f))]
+            futures[pool.submit(merge_tile, os.path.join(staging, f), sources, batch_size, **options)] = f
+        for k, future in enumerate(as_completed(futures)):
+            f = futures[future]
+            digest = future.result()
+            manifest.record(f, digest, inputs[f])
+            if staging_hash:
+                mrms_tiles.write_hash(os.path.join(staging_hash, f), digest)
+            if (k + 1) % 100 == 0 or ((k + 1) < 100 and (k + 1) % 10 == 0):
+                print(f"merged {k + 1} of {len(changed)} tiles in {time.time() - t0:.1f}s")
+    manifest.save(os.path.join(staging, mrms_manifest.MANIFEST))
+
+    if staging_hash:
+        mrms_tiles.swap_dir(staging_hash, hash_dir)
+    mrms_tiles.swap_dir(staging, output)
+    return len(changed)
+
+
+def merge_days(dest, first, last, workers=2, **options):
+    """Merges the hourly tiles under `dest`/hourly/data into daily tiles
+    under `dest`/daily/data for each day from `first` to `last`. Only the
+    tiles with hours that changed since the last merge are merged again.
+    The merged days are recorded in the catalog of `dest`.
+    """
+    catalog = mrms_catalog.Catalog(dest)
+    date = first
+    while date <= last:
+        day = date.strftime("%Y/%m/%d")
+        hourly = os.path.join(dest, "hourly/data", day)
+        daily = os.path.join(dest, "daily/data", day)
+        if os.path.isdir(hourly):
+            hours = [os.path.join(hourly, h) for h in sorted(os.listdir(hourly)) if h.isdigit()]
+            if hours:
+                os.makedirs(os.path.dirname(daily), exist_ok=True)
+                with mrms_metrics.span("day", day=day):
+                    n = merge_data(daily, hours, hash_dir=os.path.join(dest, "daily/hash", day), workers=workers,
+                                   **options)
+                print(f"merged {n} tiles from {len(hours)} hours into {daily}")
+                catalog.update_dir(daily)
+        date += timedelta(days=1)
+    catalog.close()
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Merge hourly MRMS tile files into daily tile files')
+    parser.add_argument("--dest", help="Root of the tile tree. Reads hourly/data/yyyy/mm/dd/hh, writes daily/data/yyyy/mm/dd")
+    parser.add_argument("--start", nargs='?', default="-1",
+                        help="Starting date in yyyy-mm-dd form or the number of days before the ending date")
+    parser.add_argument("--end", nargs='?', default="0",
+                        help="Ending date in yyyy-mm-dd form or as number of days offset today. Default is today")
+    parser.add_argument("--workers", default=2, help="Number of tiles to merge in parallel. Default is 2")
+    parser.add_argument("--compact", action="store_true", help="Use the compact tile encoding")
+    parser.add_argument("--quantum", default=None,
+                        help="Store precipitation as multiples of this amount (compact tiles only), e.g. 0.1")
+
+    mrms_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    end = force_date(parse_date(args.end))
+    with mrms_metrics.run("merge", args.metrics, args.profile):
+        merge_days(args.dest, force_date(parse_date(args.start), end), end, workers=int(args.workers),
+                   compact=args.compact, quantum=float(args.quantum) if args.quantum else None)
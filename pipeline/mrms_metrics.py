@@ -0,0 +1,248 @@
+"""Per-stage instrumentation for the pipeline.
+
+Each stage runs inside a span that measures wall and CPU time (including
+worker processes that have finished) and the peak memory of the process
+and its workers, and holds counters such as bytes fetched, rows decoded,
+tiles written and files skipped:
+
+    with mrms_metrics.span("split", day="2021/08/21") as s:
+        ...
+        s.add(tiles=12, rows=24500000)
+
+Code deeper down, on any thread, adds to the innermost open span with
+`mrms_metrics.add`.
+
+Where the spans go is set by `configure` or by the MRMS_METRICS
+environment variable, which worker processes inherit. A file ending in
+.prom gets the totals of each stage in the Prometheus text format (for
+the node exporter's textfile collector) when the run ends. Any other file
+gets every finished span as a line of JSON, appended as it finishes, so
+worker processes can write to the same file.
+
+A run can also be profiled by sampling the stack of the main thread every
+few milliseconds (see `Sampler`). The samples are written as folded stacks,
+which flamegraph tools read directly.
+"""
+
+import json
+import os
+import resource
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+ENV_METRICS = "MRMS_METRICS"
+ENV_PROFILE = "MRMS_PROFILE"
+
+_lock = threading.Lock()
+_open = []
+_finished = []
+_output = os.environ.get(ENV_METRICS)
+
+
+class Span:
+    """The measurements of one run of a stage"""
+
+    def __init__(self, name, parent=None, **labels):
+        self.name = name
+        self.parent = parent
+        self.labels = labels
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = _cpu()
+        self.wall = self.cpu = None
+        self.peak_rss = None
+
+    def add(self, **counts):
+        with self.lock:
+            self.counters.update(counts)
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.wall0
+        self.cpu = _cpu() - self.cpu0
+        self.peak_rss = _peak_rss()
+
+    def path(self):
+        return self.name if self.parent is None else self.parent.path() + "/" + self.name
+
+    def record(self):
+        return dict(stage=self.path(), start=self.start, seconds=self.wall, cpu_seconds=self.cpu,
+                    peak_rss=self.peak_rss, pid=os.getpid(), **self.labels, **self.counters)
+
+
+class _NoSpan:
+    def add(self, **counts):
+        pass
+
+
+def _cpu():
+    """CPU time of this process and of the worker processes that ended"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss():
+    """The largest resident set size in bytes of this process, or of any
+    worker process that ended, so far"""
+    kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return kb if sys.platform == "darwin" else kb * 1024
+
+
+@contextmanager
+def span(name, **labels):
+    """Measures the code in a `with` block as a stage called `name`.
+    Spans opened inside another span are nested and named after the path
+    to them. Spans are opened by the main thread of a stage, while any
+    thread may add to them."""
+    with _lock:
+        s = Span(name, _open[-1] if _open else None, **labels)
+        _open.append(s)
+    try:
+        yield s
+    finally:
+        with _lock:
+            _open.remove(s)
+        s.finish()
+        _record(s)
+
+
+def current():
+    """Returns the innermost open span, or one that ignores counts when
+    there is none"""
+    with _lock:
+        return _open[-1] if _open else _NoSpan()
+
+
+def add(**counts):
+    """Adds counts to the innermost open span"""
+    current().add(**counts)
+
+
+def _record(s):
+    with _lock:
+        _finished.append(s)
+        if _output and not _output.endswith(".prom"):
+            with open(_output, "a") as out:
+                out.write(json.dumps(s.record(), default=str) + "\n")
+
+
+def finished():
+    """Returns the records of the spans finished in this process"""
+    with _lock:
+        return [s.record() for s in _finished]
+
+
+def configure(metrics=None):
+    """Sends spans to the file `metrics` in this process and any worker
+    processes started from now on"""
+    global _output
+    _output = metrics
+    if metrics:
+        os.environ[ENV_METRICS] = metrics
+    else:
+        os.environ.pop(ENV_METRICS, None)
+
+
+def prometheus(records, prefix="mrms_stage"):
+    """Formats the totals of each stage of a list of span records in the
+    Prometheus text format"""
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r["stage"], Counter())
+        t["runs"] += 1
+        t["seconds"] += r["seconds"]
+        t["cpu_seconds"] += r["cpu_seconds"]
+        t["peak_rss_bytes"] = max(t["peak_rss_bytes"], r["peak_rss"])
+        for k, v in r.items():
+            if k not in ("stage", "start", "seconds", "cpu_seconds", "peak_rss", "pid") and isinstance(v, (int, float)):
+                t[k] += v
+    names = sorted(set(k for t in totals.values() for k in t))
+    lines = []
+    for k in names:
+        metric = f"{prefix}_{k}" if k == "peak_rss_bytes" else f"{prefix}_{k}_total"
+        lines.append(f"# TYPE {metric} {'gauge' if k == 'peak_rss_bytes' else 'counter'}")
+        for stage, t in sorted(totals.items()):
+            if k in t:
+                lines.append(f'{metric}{{stage="{stage}"}} {t[k]:g}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(fname, records):
+    """Writes records to `fname` in the Prometheus text format, replacing
+    the file in one step so that a collector never reads half of it"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), prefix=".", suffix=".prom")
+    with os.fdopen(fd, "w") as out:
+        out.write(prometheus(records))
+    os.replace(tmp, fname)
+
+
+class Sampler:
+    """A sampling profiler for the main thread. Every `interval` seconds of
+    CPU time the stack of the main thread is recorded, which costs little
+    enough to leave on under real load. Needs SIGPROF, so it does nothing
+    on platforms without it."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.enabled = hasattr(signal, "SIGPROF") and threading.current_thread() is threading.main_thread()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        if self.enabled:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def stop(self):
+        if self.enabled:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, fname):
+        """Writes the samples as folded stacks, the most frequent first"""
+        with open(fname, "w") as out:
+            for stack, n in self.samples.most_common():
+                out.write(f"{stack} {n}\n")
+
+
+@contextmanager
+def run(stage, metrics=None, profile=None, **labels):
+    """Wraps the entry point of a stage. Spans go to `metrics` (or the file
+    named by MRMS_METRICS) and, with `profile` (or MRMS_PROFILE) set, the
+    run is profiled into that file."""
+    metrics = metrics or os.environ.get(ENV_METRICS)
+    profile = profile or os.environ.get(ENV_PROFILE)
+    configure(metrics)
+    sampler = Sampler().start() if profile else None
+    try:
+        with span(stage, **labels) as s:
+            yield s
+    finally:
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(profile)
+        if metrics and metrics.endswith(".prom"):
+            write_prometheus(metrics, finished())
+
+
+def add_arguments(parser):
+    """Adds the --metrics and --profile options to a command line parser"""
+    parser.add_argument("--metrics", default=None,
+                        help="File for stage metrics, in Prometheus text format if it ends in .prom, else JSON lines")
+    parser.add_argument("--profile", default=None, help="Sample the stack while running and write folded stacks here")
@@ -0,0 +1,728 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import resource
+import socket
+import struct
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import mrms_catalog
+import mrms_h3
+import mrms_index
+import mrms_region
+import mrms_rollup
+import mrms_tiles
+
+# the record batches of a batch query, one row per request, grid point and
+# time. request is the position of the request in the batch
+BATCH_SCHEMA = pa.schema([("request", pa.int64()), ("h3", pa.int64()), ("t", pa.int64()),
+                          ("precipitation", pa.float32())])
+
+
+class TileStore:
+    """Answers history queries from directories of tile files.
+
+    Finding the history for a point involves computing the fine-grained
+    H3 reference (typically at level 15) as well as the H3 tile. The tile
+    is used to form the file name from which to read the data and the
+    reference is used to select the data read from the file. There may be
+    multiple files to read, each with the same name, but in different
+    directories.
+
+    The store keeps up to `max_open` tile files open (by default half as
+    many as the process may have open at once) along with the h3 range of
+    each of their row groups, so a query only reads the row
+    groups that can hold the requested grid points and then bisects the
+    sorted rows instead of filtering them. A file that is replaced on disk
+    is noticed by its modification time and opened again.
+
+    Decoded row groups are kept in a `BlockCache` of up to `cache_bytes`
+    bytes shared by all tiles, so hot regions are answered from memory
+    without reading or decoding anything. A value of 0 turns it off.
+
+    With a `root`, `dirs` finds the tile directories for a range of days
+    in the layout written by `mrms_split` and `mrms_merge`. With a grid
+    point `index` (see `mrms_index`), locations are resolved to the
+    nearest grid points instead of their own level 15 cell.
+
+    With a `catalog` of the tree (see `mrms_catalog`), the directories of
+    a range of days and the files and row groups of a tile within them
+    are looked up in memory instead of on disk, and row groups outside
+    the times asked for are skipped as well.
+    """
+
+    def __init__(self, root=None, tile_level=3, ref_level=15, max_open=None, index=None, cache_bytes=256 << 20,
+                 catalog=None):
+        self.root = root
+        self.catalog = catalog
+        self.cache = BlockCache(cache_bytes) if cache_bytes else None
+        self.index = index
+        self.tile_level = tile_level
+        self.ref_level = ref_level
+        self.max_open = max_open or default_max_open()
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+
+    def history(self, latitude, longitude, dirs, start=None, end=None):
+        """Returns the history of the grid point at a latitude and longitude"""
+        return self.query(self.refs(latitude, longitude), dirs, start, end)
+
+    def refs(self, latitude, longitude):
+        """Returns the h3 ids to query for a location"""
+        if self.index is not None:
+            return self.index.nearest(latitude, longitude)
+        return mrms_h3.cells([latitude], [longitude], self.ref_level)
+
+    def query(self, refs, dirs, start=None, end=None):
+        """Returns the history of each of the h3 ids in `refs` found in the
+        tile files in `dirs` as a data frame with columns h3, t,
+        precipitation and time, ordered by h3 and then time. Only times
+        from `start` to `end` (inclusive) are returned if these are given.
+        """
+        refs = np.unique(np.asarray(refs, dtype=np.int64))
+        start, end = millis(start), millis(end)
+        parts = []
+        for tile in np.unique(mrms_h3.parents(refs, self.tile_level)):
+            wanted = refs[mrms_h3.parents(refs, self.tile_level) == tile]
+            for fname, entry in self.tile_files(tile, dirs, wanted, wanted, start, end):
+                x = self.read(fname, wanted, start, end, entry)
+                if x is not None:
+                    parts.append(x)
+        return to_frame(parts)
+
+    def query_ranges(self, lo, hi, dirs, start=None, end=None):
+        """Like `query`, but returns the histories of all grid points with
+        h3 ids from `lo` to `hi` (inclusive) for each pair of the sorted,
+        disjoint ranges. A range must not span more than one tile."""
+        lo, hi = np.asarray(lo, dtype=np.int64), np.asarray(hi, dtype=np.int64)
+        start, end = millis(start), millis(end)
+        tiles = mrms_h3.parents(lo, self.tile_level)
+        parts = []
+        for tile in np.unique(tiles):
+            tile_lo, tile_hi = lo[tiles == tile], hi[tiles == tile]
+            for fname, entry in self.tile_files(tile, dirs, tile_lo, tile_hi, start, end):
+                x = self.open(fname, acquire=True)
+                if x is not None:
+                    try:
+                        groups = self.groups(x, entry, tile_lo, tile_hi, start, end)
+                        parts.append(x.read_ranges(tile_lo, tile_hi, start, end, groups))
+                    finally:
+                        x.release()
+        return to_frame(parts)
+
+    def tile_files(self, tile, dirs, lo, hi, start=None, end=None):
+        """Returns (file name, catalog entry) for the files of `tile` in
+        `dirs` that may hold the h3 ranges from `lo` to `hi` at times from
+        `start` to `end`. Without a catalog, that is the file of the tile
+        in every directory, with no entry."""
+        if self.catalog is not None:
+            return self.catalog.files(self.tile_level, tile, dirs, lo, hi, start, end)
+        fname = mrms_tiles.tile_name(self.tile_level, tile)
+        return [(os.path.join(d, fname), None) for d in dirs]
+
+    def groups(self, tile, entry, lo, hi, start=None, end=None):
+        """Returns the row groups of an open tile to read according to its
+        catalog entry, or None to find them from the file itself"""
+        if entry is None or entry.version != tile.version:
+            # not catalogued, or replaced since
+            return None
+        return entry.row_groups(lo, hi, start, end)
+
+    def read(self, fname, refs, start=None, end=None, entry=None):
+        """Reads the rows for the sorted h3 ids `refs` from one tile file
+        with times between `start` and `end` in milliseconds. Returns None
+        if the file doesn't exist. Row groups are chosen using the catalog
+        `entry` of the file if there is one.
+        """
+        tile = self.open(fname, acquire=True)
+        if tile is None:
+            return None
+        try:
+            return tile.read(refs, start, end, self.groups(tile, entry, refs, refs, start, end))
+        finally:
+            tile.release()
+
+    def open(self, fname, acquire=False):
+        """Returns the open tile for a file name, opening it if necessary.
+        With `acquire`, the tile is kept open until it is released even if
+        it is evicted meanwhile."""
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            tile = self.tiles.get(fname)
+            if tile is not None and tile.version == (st.st_mtime_ns, st.st_size, st.st_ino):
+                self.tiles.move_to_end(fname)
+                if acquire:
+                    tile.acquire()
+                return tile
+        tile = OpenTile(fname, (st.st_mtime_ns, st.st_size, st.st_ino), self.cache)
+        if acquire:
+            tile.acquire()
+        with self.lock:
+            replaced = self.tiles.get(fname)
+            self.tiles[fname] = tile
+            self.tiles.move_to_end(fname)
+            evicted = [self.tiles.popitem(last=False)[1] for _ in range(len(self.tiles) - self.max_open)]
+        if replaced is not None:
+            evicted.append(replaced)
+            if replaced.version != tile.version and self.cache is not None:
+                # the file was swapped for a new one, so its blocks are stale
+                self.cache.discard(fname, replaced.version)
+        # evicted files are closed now rather than whenever they are collected
+        for x in evicted:
+            x.close()
+        return tile
+
+    def dirs(self, first, last):
+        """Lists the tile directories under `root` covering the days from
+        `first` to `last`. A month compacted by `mrms_compact` is read from
+        its monthly directory, which holds the whole month, so times should
+        be given to limit what is read from it. Otherwise merged daily
+        directories are used where they exist and hourly directories
+        otherwise. With a catalog, only the days it doesn't know are looked
+        up on disk.
+        """
+        if self.catalog is not None:
+            return self.catalog.dirs(first, last)
+        result = []
+        day = first
+        while day <= last:
+            result.extend(d for d in mrms_catalog.tree_dirs(self.root, day) if d not in result[-1:])
+            day += timedelta(days=1)
+        return result
+
+    def totals(self, refs, start, end):
+        """Returns the total precipitation, largest hourly value, number of
+        wet hours and number of hours with data for each of `refs` over the
+        hours from `start` up to but not including `end`.
+
+        Whole months and days are answered from the monthly and daily
+        rollups written by `mrms_rollup` where these exist, so only the
+        ragged ends of the range are read hour by hour.
+        """
+        refs = np.unique(np.asarray(refs, dtype=np.int64))
+        parts = []
+        for period, dirs, t0, t1 in self.plan(millis(start), millis(end)):
+            if period == "hourly":
+                df = self.query(refs, dirs, t0, t1 - 1)
+                p = df["precipitation"]
+                parts.append(pandas.DataFrame(dict(h3=df["h3"], precipitation=p.fillna(0), max=p,
+                                                   wet_hours=(p > 0).astype(np.int32),
+                                                   hours=p.notna().astype(np.int32))))
+            else:
+                parts.append(self.read_all(refs, dirs).to_pandas().drop(columns="t"))
+        df = pandas.concat(parts + [pandas.DataFrame(dict(h3=refs[:0]))], ignore_index=True)
+        return df.groupby("h3", as_index=False).agg(precipitation=("precipitation", "sum"), max=("max", "max"),
+                                                    wet_hours=("wet_hours", "sum"), hours=("hours", "sum"))
+
+    def locate(self, latitudes, longitudes):
+        """Returns the h3 id to query for each of many locations, the
+        nearest grid point with an index. Locations without a grid point
+        near them get -1."""
+        if self.index is None:
+            return mrms_h3.cells(latitudes, longitudes, self.ref_level)
+        result = np.full(len(latitudes), -1, np.int64)
+        for i, (lat, lon) in enumerate(zip(latitudes, longitudes)):
+            nearest = self.index.nearest(lat, lon)
+            if len(nearest):
+                result[i] = nearest[0]
+        return result
+
+    def batch(self, refs, starts, ends, workers=8):
+        """Answers many history requests at once. Request i asks for the
+        grid point `refs[i]` from `starts[i]` to `ends[i]` (inclusive,
+        dates, datetimes or milliseconds). The requests are grouped by
+        tile and each tile file is read once for all of the requests in
+        it, with a pool of `workers` threads reading tiles in parallel.
+
+        Yields record batches with BATCH_SCHEMA as tiles are done, so the
+        results can be streamed. Rows are ordered by request and time
+        within a batch, but batches come in no particular order.
+        """
+        refs = np.asarray(refs, dtype=np.int64)
+        starts = np.array([millis(t) for t in starts], dtype=np.int64)
+        ends = np.array([millis(t) for t in ends], dtype=np.int64)
+        requests = np.flatnonzero(refs >= 0)
+        tiles = mrms_h3.parents(refs[requests], self.tile_level)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.read_batch, t, requests[tiles == t], refs, starts, ends)
+                       for t in np.unique(tiles)]
+            for future in as_completed(futures):
+                result = future.result()
+                if result.num_rows:
+                    yield result
+
+    def read_batch(self, tile, requests, refs, starts, ends):
+        """Reads the rows of the `requests` in one tile as a record batch.
+        Every file of the tile is read once, for all of the requests, so a
+        monthly directory isn't read again for each day of the month."""
+        t0, t1 = starts[requests].min(), ends[requests].max()
+        first = datetime.fromtimestamp(t0 / 1000, timezone.utc).date()
+        last = datetime.fromtimestamp(t1 / 1000, timezone.utc).date()
+        # the directories of the days with any request, each once
+        dirs = {}
+        day = first
+        while day <= last:
+            if np.any((starts[requests] < millis(day + timedelta(days=1))) & (ends[requests] >= millis(day))):
+                dirs.update(dict.fromkeys(self.dirs(day, day)))
+            day += timedelta(days=1)
+        wanted = np.unique(refs[requests])
+        parts = []
+        for fname, entry in self.tile_files(tile, list(dirs), wanted, wanted, t0, t1):
+            x = self.read(fname, wanted, t0, t1, entry)
+            if x is not None and x.num_rows:
+                parts.append(x.replace_schema_metadata(None))
+        if not parts:
+            return pa.RecordBatch.from_pylist([], BATCH_SCHEMA)
+
+        rows = pa.concat_tables(parts).to_pandas()
+        asked = pandas.DataFrame(dict(request=requests, h3=refs[requests], start=starts[requests], end=ends[requests]))
+        df = rows.merge(asked, on="h3")
+        df = df[(df["t"] >= df["start"]) & (df["t"] <= df["end"])].sort_values(["request", "t"], kind="stable")
+        return pa.RecordBatch.from_pandas(df[BATCH_SCHEMA.names], schema=BATCH_SCHEMA, preserve_index=False)
+
+    def read_all(self, refs, dirs):
+        """Reads the rows for `refs` from the tiles in `dirs` as one table"""
+        parts = []
+        for tile in np.unique(mrms_h3.parents(refs, self.tile_level)):
+            fname = mrms_tiles.tile_name(self.tile_level, tile)
+            wanted = refs[mrms_h3.parents(refs, self.tile_level) == tile]
+            for d in dirs:
+                x = self.read(os.path.join(d, fname), wanted)
+                if x is not None:
+                    parts.append(x.replace_schema_metadata(None))
+        return pa.concat_tables(parts) if parts else mrms_rollup.SCHEMA.empty_table()
+
+    def plan(self, start, end):
+        """Splits the hours from `start` up to `end` (in milliseconds) into
+        the coarsest periods that can be read, yielding (period, dirs, t0,
+        t1) with period one of monthly, daily or hourly. A monthly rollup
+        is only used if it covers every day of the month with data."""
+        t = start
+        while t < end:
+            now = datetime.fromtimestamp(t / 1000, timezone.utc)
+            day = now.date()
+            next_day = millis(day + timedelta(days=1))
+            next_month = millis((day.replace(day=1) + timedelta(days=32)).replace(day=1))
+            at_day = now.hour == 0 and now.minute == 0 and now.second == 0
+            monthly = mrms_rollup.rollup_dir(self.root, "monthly", day)
+            daily = mrms_rollup.rollup_dir(self.root, "daily", day)
+            if (at_day and day.day == 1 and next_month <= end and os.path.isdir(monthly)
+                    and mrms_rollup.month_complete(self.root, day)):
+                yield "monthly", [monthly], t, next_month
+                t = next_month
+            elif at_day and next_day <= end and os.path.isdir(daily):
+                yield "daily", [daily], t, next_day
+                t = next_day
+            else:
+                t1 = min(next_day, end)
+                yield "hourly", self.dirs(day, day), t, t1
+                t = t1
+
+
+class BlockCache:
+    """A least recently used cache of decoded row groups holding at most
+    `max_bytes` bytes. Entries are keyed by file name, file version and
+    row group, and hold the columns of the row group as numpy arrays.
+    `hits` and `misses` count lookups."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return block[0]
+
+    def put(self, key, columns):
+        size = sum(x.nbytes for x in columns.values())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = (columns, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, n) = self.blocks.popitem(last=False)
+                self.bytes -= n
+                self.evictions += 1
+
+    def discard(self, fname, version):
+        """Drops the blocks of one version of a file"""
+        with self.lock:
+            for key in [k for k in self.blocks if k[0] == fname and k[1] == version]:
+                self.bytes -= self.blocks.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, blocks=len(self.blocks),
+                        bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+class OpenTile:
+    """An open tile file with the h3 range of each of its row groups"""
+
+    def __init__(self, fname, version, cache=None):
+        self.fname = fname
+        self.version = version
+        self.cache = cache
+        self.file = pq.ParquetFile(fname, memory_map=True)
+        self.metadata = self.file.schema_arrow.metadata
+        self.manifest = mrms_tiles.manifest(self.file.schema_arrow)
+        self.schema = mrms_tiles.decode(self.file.schema_arrow.empty_table()).schema.remove_metadata()
+        self.lock = threading.Lock()
+        self.users = 0
+        self.closing = False
+
+        md = self.file.metadata
+        column = self.file.schema_arrow.get_field_index("h3")
+        n = md.num_row_groups
+        self.h3_min = np.full(n, np.iinfo(np.int64).min)
+        self.h3_max = np.full(n, np.iinfo(np.int64).max)
+        for i in range(n):
+            stats = md.row_group(i).column(column).statistics
+            if stats is not None and stats.has_min_max:
+                self.h3_min[i] = stats.min
+                self.h3_max[i] = stats.max
+
+    def acquire(self):
+        """Keeps the file open until `release` is called"""
+        with self.lock:
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.closing and self.users == 0:
+                self.file.close()
+
+    def close(self):
+        """Closes the file, or has the last reader still using it close it"""
+        with self.lock:
+            self.closing = True
+            if self.users == 0:
+                self.file.close()
+
+    def row_groups(self, lo, hi=None):
+        """Returns the row groups whose h3 range overlaps any of the sorted
+        ranges from `lo` to `hi`, or holds any of `lo` if there is no `hi`"""
+        hi = lo if hi is None else hi
+        i = np.searchsorted(hi, self.h3_min, "left")
+        return np.flatnonzero((i < len(lo)) & (lo[np.minimum(i, len(lo) - 1)] <= self.h3_max))
+
+    def read(self, refs, start=None, end=None, groups=None):
+        return self.read_ranges(refs, refs, start, end, groups)
+
+    def read_ranges(self, lo, hi, start=None, end=None, groups=None):
+        """Reads the rows in the sorted h3 ranges from `lo` to `hi` with
+        times from `start` to `end`, looking only at the row groups in
+        `groups` if these are known"""
+        if groups is None:
+            groups = self.row_groups(lo, hi) if len(lo) else np.zeros(0, np.int64)
+        blocks = [self.block(g) for g in groups]
+        columns = {f.name: np.concatenate([b[f.name] for b in blocks] + [np.zeros(0, f.type.to_pandas_dtype())])
+                   for f in self.schema}
+        h3 = columns["h3"]
+        t = columns["t"]
+
+        # rows are ordered by h3 and then time so each range is a slice
+        first, last = np.searchsorted(h3, lo, "left"), np.searchsorted(h3, hi, "right")
+        rows = np.concatenate([np.arange(a, b) for a, b in zip(first, last)] + [np.zeros(0, np.int64)])
+        if start is not None:
+            rows = rows[t[rows] >= start]
+        if end is not None:
+            rows = rows[t[rows] <= end]
+        table = pa.Table.from_arrays([pa.array(columns[f.name][rows], f.type) for f in self.schema], schema=self.schema)
+
+        if self.manifest is None:
+            return table
+        points, times = self.manifest
+        points = points[_within(points, lo, hi)]
+        if start is not None:
+            times = times[times >= start]
+        if end is not None:
+            times = times[times <= end]
+        return mrms_tiles.densify(table, points, times)
+
+    def block(self, group):
+        """Returns the decoded columns of a row group, from the cache if
+        it is there"""
+        key = (self.fname, self.version, group)
+        columns = self.cache.get(key) if self.cache is not None else None
+        if columns is None:
+            with self.lock:
+                table = self.file.read_row_group(group)
+            table = mrms_tiles.decode(table.replace_schema_metadata(self.metadata))
+            columns = {name: table[name].to_numpy() for name in table.column_names}
+            if self.cache is not None:
+                self.cache.put(key, columns)
+        return columns
+
+
+def default_max_open(limit=4096):
+    """Returns the number of tile files to keep open: half the limit on
+    open files of the process, so there is room left for everything else,
+    and at most `limit`"""
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return limit
+    return max(16, min(limit, soft // 2))
+
+
+def _within(x, lo, hi):
+    """Tells which of `x` fall in any of the sorted ranges from `lo` to `hi`"""
+    if len(lo) == 0:
+        return np.zeros(len(x), bool)
+    i = np.searchsorted(hi, x, "left")
+    return (i < len(lo)) & (lo[np.minimum(i, len(lo) - 1)] <= x)
+
+
+def to_frame(parts):
+    """Combines tables of query results into a data frame with a time column"""
+    if parts:
+        table = pa.concat_tables([p.replace_schema_metadata(None) for p in parts])
+    else:
+        table = mrms_tiles.SCHEMA.empty_table()
+    df = table.to_pandas()
+    if len(parts) > 1:
+        df = df.sort_values(["h3", "t"], kind="stable", ignore_index=True)
+    df["time"] = pandas.to_datetime(df["t"], unit="ms", utc=True)
+    return df
+
+
+def millis(t):
+    """Converts a date, datetime or number of milliseconds since 1970 into
+    milliseconds since 1970. Dates and naive datetimes are taken as UTC.
+    """
+    if t is None or isinstance(t, (int, np.integer)):
+        return t
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return int(t.timestamp() * 1000)
+    if isinstance(t, date):
+        return millis(datetime(t.year, t.month, t.day))
+    raise ValueError(f"Expected date, datetime or milliseconds, got {type(t)}")
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Serves histories and totals as JSON. For example
+
+        /history?lat=41.6&lon=-93.6&start=2021-08-01&end=2021-08-21
+        /history?h3=644733797632264874,644733797632264875&start=2021-08-01
+        /totals?lat=41.6&lon=-93.6&start=2021-04-01&end=2021-08-21
+
+    and area weighted series for the polygons in a GeoJSON body POSTed to
+
+        /region?start=2021-08-01&end=2021-08-21
+
+    Many points at once can be POSTed to /batch, which streams the
+    results back as Arrow IPC. /stats reports the cache counters.
+
+    Dates select the days to read and, as with times given in
+    milliseconds, limit the times returned. The end date is inclusive.
+    """
+    store = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        handler = {"/history": self.history, "/totals": self.totals, "/stats": self.stats}.get(url.path)
+        try:
+            if handler is None:
+                self.reply(404, dict(error=f"unknown path {url.path}"))
+                return
+            t0 = time.time()
+            result = handler(args)
+            self.reply(200, dict(result, elapsed=time.time() - t0))
+        except (KeyError, ValueError) as e:
+            self.reply(400, dict(error=str(e)))
+        except Exception:
+            self.fail(url.path)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        handler = {"/region": self.region, "/batch": self.batch}.get(url.path)
+        try:
+            if handler is None:
+                self.reply(404, dict(error=f"unknown path {url.path}"))
+                return
+            t0 = time.time()
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            result = handler(args, body)
+            if result is not None:
+                self.reply(200, dict(result, elapsed=time.time() - t0))
+        except (KeyError, ValueError) as e:
+            self.reply(400, dict(error=str(e)))
+        except Exception:
+            self.fail(url.path)
+
+    def fail(self, path):
+        """Logs an unexpected error and answers with a 500, so a failing
+        read doesn't leave the client without a reply"""
+        print(f"{path} failed")
+        traceback.print_exc()
+        self.reply(500, dict(error="internal error"))
+
+    def history(self, args):
+        start, end = self.time_range(args)
+        df = self.store.query(self.refs(args), self.store.dirs(start.date(), end.date()), millis(start), millis(end))
+        return dict(h3=[int(x) for x in df["h3"]], t=[int(x) for x in df["t"]],
+                    precipitation=[None if math.isnan(x) else float(x) for x in df["precipitation"]])
+
+    def totals(self, args):
+        start, end = self.time_range(args)
+        df = self.store.totals(self.refs(args), start, millis(end) + 1)
+        return {c: [None if isinstance(x, float) and math.isnan(x) else x for x in df[c].tolist()] for c in df.columns}
+
+    def region(self, args, geojson):
+        start, end = self.time_range(args)
+        regions = mrms_region.geometries(geojson)
+        df = mrms_region.query_regions(self.store, regions, self.store.dirs(start.date(), end.date()),
+                                       millis(start), millis(end))
+        return dict(regions=[dict(region=name, t=[int(x) for x in part["t"]],
+                                  precipitation=[None if math.isnan(x) else float(x) for x in part["precipitation"]])
+                             for name, part in df.groupby("region", sort=False)])
+
+    def batch(self, args, body):
+        """Streams the histories of a list of points as Arrow IPC. The body
+        is {"points": [{"lat": 41.6, "lon": -93.6}, {"h3": 644733797632264874,
+        "start": "2021-08-01"}, ...]} with optional start and end for each
+        point defaulting to those of the query string. Bad points get a 400
+        before anything is streamed; a failure after that resets the
+        connection, so a client never takes a partial result as complete."""
+        points = body["points"]
+        refs = np.full(len(points), -1, np.int64)
+        located = [i for i, p in enumerate(points) if "h3" not in p]
+        refs[located] = self.store.locate([float(points[i]["lat"]) for i in located],
+                                          [float(points[i]["lon"]) for i in located])
+        starts, ends = np.zeros(len(points), np.int64), np.zeros(len(points), np.int64)
+        for i, p in enumerate(points):
+            if "h3" in p:
+                refs[i] = int(p["h3"])
+            start, end = self.time_range(dict(args, **{k: p[k] for k in ["start", "end"] if k in p}))
+            starts[i], ends[i] = millis(start), millis(end)
+        if np.any(mrms_h3.resolution(refs[refs >= 0]) < self.store.tile_level):
+            raise ValueError(f"h3 ids must be at resolution {self.store.tile_level} or finer")
+
+        batches = self.store.batch(refs, starts, ends)
+        try:
+            # a bad request fails here, while an error can still be sent
+            first = next(batches, None)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.apache.arrow.stream")
+            self.end_headers()
+            # without a length, the response ends when the connection closes
+            self.close_connection = True
+            try:
+                writer = pa.ipc.new_stream(self.wfile, BATCH_SCHEMA)
+                for batch in itertools.chain([first] if first is not None else [], batches):
+                    writer.write_batch(batch)
+                writer.close()
+            except Exception as e:
+                # the status is out, so the client can only be told by
+                # resetting the connection rather than closing it cleanly
+                print(f"batch failed while streaming: {e!r}")
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.connection.close()
+        finally:
+            batches.close()
+
+    def stats(self, args):
+        cache = self.store.cache.stats() if self.store.cache is not None else None
+        return dict(open_tiles=len(self.store.tiles), cache=cache)
+
+    def time_range(self, args):
+        """Returns the start and (inclusive) end of a request as datetimes.
+        An end given as a date covers that whole day."""
+        start, end = parse_time(args.get("start")), parse_time(args.get("end"))
+        if end is None:
+            end = datetime.now(timezone.utc).replace(tzinfo=None)
+        elif "T" not in args["end"]:
+            end += timedelta(days=1, milliseconds=-1)
+        if start is None:
+            start = end - timedelta(days=7)
+        return start, end
+
+    def refs(self, args):
+        if "h3" in args:
+            return [int(x) for x in args["h3"].split(",")]
+        return self.store.refs(float(args["lat"]), float(args["lon"]))
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def parse_time(s):
+    """Parses yyyy-mm-dd or yyyy-mm-ddThh:mm[:ss] as a naive UTC datetime"""
+    if s is None:
+        return None
+    return datetime.fromisoformat(s)
+
+
+def serve(store, host="0.0.0.0", port=8080):
+    """Returns an HTTP server answering queries from `store`. Call
+    `serve_forever` on the result to start it."""
+    handler = type("Handler", (QueryHandler,), dict(store=store))
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Serve MRMS precipitation histories over HTTP')
+    parser.add_argument("--root", help="Root of the tile tree written by mrms_split and mrms_merge")
+    parser.add_argument("--tile-level", default=3, help="H3 resolution of the tiles. Default is 3")
+    parser.add_argument("--port", default=8080, help="Port to listen on. Default is 8080")
+    parser.add_argument("--index", default=None, help="Grid point index built by mrms_index.py")
+    parser.add_argument("--cache-mb", default=256, help="Memory for decoded tile data in MB, 0 for none. Default is 256")
+    parser.add_argument("--catalog", nargs="?", const=True, default=None,
+                        help="Find tiles with the catalog written by mrms_split and mrms_merge, by default the "
+                             "catalog.sqlite under the root")
+
+    args = parser.parse_args()
+    index = mrms_index.GridIndex(args.index) if args.index else None
+    catalog = None
+    if args.catalog:
+        catalog = mrms_catalog.Catalog(args.root, None if args.catalog is True else args.catalog)
+    store = TileStore(args.root, tile_level=int(args.tile_level), index=index, cache_bytes=int(args.cache_mb) << 20,
+                      catalog=catalog)
+    server = serve(store, port=int(args.port))
+    print(f"serving {args.root} on port {args.port}")
+    server.serve_forever()
@@ -0,0 +1,190 @@
+"""Area weighted precipitation over polygons such as field boundaries.
+
+A polygon is covered with small H3 cells (level 10, about 0.015 km2, by
+default) and each cell is given to the grid point nearest its center, so a
+grid point's weight is the share of the polygon closest to it. Cells of
+one level have nearly the same area, so counting them is enough. The
+series of a polygon is then the weighted mean of the series of its grid
+points, skipping points without data at a time.
+
+Grid points are looked for under the coarse cells (`search_level`, the
+level of the grid point index if there is one) holding the covering and
+their neighbors. Any H3 cell covers a contiguous range of level 15 ids, so
+without an index these cells are read as h3 ranges, which prunes row
+groups just like a point query. Many polygons are answered together so
+that each tile is read once however many polygons fall in it.
+"""
+
+import numpy as np
+import pandas
+
+import mrms_h3
+
+# level of the cells covering a polygon
+COVER_LEVEL = 10
+
+# level of the cells searched for grid points without an index
+SEARCH_LEVEL = 6
+
+# largest number of distances computed at once when assigning cells
+CHUNK = 1 << 22
+
+
+def geometries(geojson):
+    """Returns a dict of the polygons in a GeoJSON Polygon, MultiPolygon,
+    Feature or FeatureCollection by name. Features are named by their id,
+    or else their position in the collection."""
+    if geojson["type"] == "FeatureCollection":
+        result = {}
+        for i, feature in enumerate(geojson["features"]):
+            result[feature.get("id", i)] = feature["geometry"]
+        return result
+    if geojson["type"] == "Feature":
+        return {geojson.get("id", 0): geojson["geometry"]}
+    if geojson["type"] in ("Polygon", "MultiPolygon"):
+        return {0: geojson}
+    raise ValueError(f"Expected a Polygon, MultiPolygon, Feature or FeatureCollection, got {geojson['type']}")
+
+
+def cover(geometry, res=COVER_LEVEL):
+    """Returns the cells at level `res` covering a polygon. A polygon too
+    small to hold the center of any cell gets the cell at its middle."""
+    cells = mrms_h3.cover(geometry, res)
+    if len(cells) == 0:
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        ring = np.array(polygons[0][0], dtype=np.float64)
+        cells = np.array([mrms_h3.cell(ring[:, 1].mean(), ring[:, 0].mean(), res)], dtype=np.int64)
+    return cells
+
+
+def nearest(lats, lons, point_lats, point_lons):
+    """Returns the position of the point nearest to each location, using
+    the same equirectangular distance as `mrms_index.GridIndex`"""
+    result = np.zeros(len(lats), np.int64)
+    step = max(1, CHUNK // max(1, len(point_lats)))
+    for i in range(0, len(lats), step):
+        lat, lon = lats[i:i + step, None], lons[i:i + step, None]
+        # squared distances in degrees of latitude rank the same as km
+        dx = point_lons[None, :] - lon
+        dx -= 360 * np.round(dx / 360)
+        dx *= np.cos(np.radians(lat))
+        dy = point_lats[None, :] - lat
+        result[i:i + step] = np.argmin(dx * dx + dy * dy, axis=1)
+    return result
+
+
+def distance(lat, lon, lats, lons):
+    """Returns the approximate distance in km between locations"""
+    dy = np.radians(lats - lat)
+    dx = np.radians((lons - lon + 180) % 360 - 180) * np.cos(np.radians(lat))
+    return 6371.0 * np.hypot(dx, dy)
+
+
+def nearby(lats, lons, point_lats, point_lons):
+    """Tells which points can be the nearest to any of the locations. The
+    point nearest the middle of the locations is no farther than `r` from
+    any of them, so points more than `r` outside their bounding box never
+    are, which saves comparing every location with every point."""
+    if len(point_lats) == 0:
+        return np.zeros(0, bool)
+    middle = nearest(np.array([lats.mean()]), np.array([lons.mean()]), point_lats, point_lons)[0]
+    r = distance(point_lats[middle], point_lons[middle], lats, lons).max()
+    dy = np.maximum(0, np.maximum(lats.min() - point_lats, point_lats - lats.max()))
+    dx = np.maximum(0, np.maximum(lons.min() - point_lons, point_lons - lons.max()))
+    # the widest part of the box gives the smallest km per degree of longitude
+    cos = np.cos(np.radians(max(abs(lats.min()), abs(lats.max()))))
+    return 6371.0 * np.hypot(np.radians(dx) * cos, np.radians(dy)) <= r * (1 + 1e-9)
+
+
+def weights(covers, points, search_level, point_lats=None, point_lons=None):
+    """Returns the weight of each grid point in each region as a data
+    frame with columns region (the position in `covers`), h3 and weight.
+    `covers` holds the covering cells of each region and `points` the h3
+    ids of the grid points to choose from, which must include all points
+    within a `search_level` cell of each covering. The locations of the
+    points are their cell centers unless given."""
+    if point_lats is None:
+        point_lats, point_lons = mrms_h3.centers(points)
+    point_keys = mrms_h3.parents(points, search_level)
+    order = np.argsort(point_keys, kind="stable")
+    point_keys = point_keys[order]
+    parts = []
+    for region, cells in enumerate(covers):
+        keys = search_keys(cells, search_level)
+        lo, hi = np.searchsorted(point_keys, keys, "left"), np.searchsorted(point_keys, keys, "right")
+        near = order[np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)] + [np.zeros(0, np.int64)])]
+        if len(near) == 0:
+            continue
+        lats, lons = mrms_h3.centers(cells)
+        near = near[nearby(lats, lons, point_lats[near], point_lons[near])]
+        counts = np.bincount(nearest(lats, lons, point_lats[near], point_lons[near]), minlength=len(near))
+        used = counts > 0
+        parts.append(pandas.DataFrame(dict(region=region, h3=points[near][used],
+                                           weight=counts[used] / len(cells))))
+    if not parts:
+        return pandas.DataFrame(dict(region=np.zeros(0, np.int64), h3=np.zeros(0, np.int64), weight=np.zeros(0)))
+    return pandas.concat(parts, ignore_index=True)
+
+
+def search_keys(cells, search_level):
+    """Returns the `search_level` cells holding `cells` and their neighbors"""
+    keys = np.unique(mrms_h3.parents(cells, search_level))
+    return np.unique(np.concatenate([mrms_h3.disk(k, 1) for k in keys]))
+
+
+def aggregate(w, df, n):
+    """Returns the weighted mean series of `n` regions given the weights
+    `w` of their grid points and the histories `df` of the grid points as
+    returned by `TileStore.query`. The result has columns region, t and
+    precipitation and a row for each region and each time in `df`."""
+    points, p_index = np.unique(df["h3"].to_numpy(), return_inverse=True)
+    times, t_index = np.unique(df["t"].to_numpy(), return_inverse=True)
+    values = np.full((len(points), len(times)), np.nan)
+    values[p_index, t_index] = df["precipitation"].to_numpy()
+
+    w = w[w["h3"].isin(points)]
+    rows = np.searchsorted(points, w["h3"].to_numpy())
+    region = w["region"].to_numpy()
+    weight = w["weight"].to_numpy()[:, None]
+    total = np.zeros((n, len(times)))
+    covered = np.zeros((n, len(times)))
+    np.add.at(total, region, weight * np.nan_to_num(values[rows]))
+    np.add.at(covered, region, weight * ~np.isnan(values[rows]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(covered > 0, total / covered, np.nan)
+    return pandas.DataFrame(dict(region=np.repeat(np.arange(n), len(times)), t=np.tile(times, n),
+                                 precipitation=mean.reshape(-1)))
+
+
+def query_regions(store, regions, dirs, start=None, end=None, res=COVER_LEVEL, search_level=None):
+    """Returns the area weighted precipitation series of each polygon in
+    the dict `regions` from the tiles in `dirs`, as a data frame with
+    columns region, t, precipitation and time ordered by region and time.
+    Times are limited to `start` to `end` (inclusive) if these are given.
+    """
+    names = list(regions)
+    covers = [cover(regions[name], res) for name in names]
+    index = store.index
+    if search_level is None:
+        search_level = index.level if index is not None else SEARCH_LEVEL
+    keys = np.unique(np.concatenate([search_keys(c, search_level) for c in covers] + [np.zeros(0, np.int64)]))
+
+    if index is not None and index.level == search_level:
+        # the index lists the grid points, so only the weighted ones are read
+        lo = np.searchsorted(index.key, keys, "left")
+        hi = np.searchsorted(index.key, keys, "right")
+        rows = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)] + [np.zeros(0, np.int64)])
+        w = weights(covers, index.h3[rows], search_level, index.latitude[rows], index.longitude[rows])
+        df = store.query(np.unique(w["h3"]), dirs, start, end)
+    else:
+        if search_level < store.tile_level:
+            raise ValueError(f"Can't search level {search_level} cells in level {store.tile_level} tiles")
+        lo, hi = mrms_h3.child_range(keys)
+        df = store.query_ranges(lo, hi, dirs, start, end)
+        w = weights(covers, np.unique(df["h3"].to_numpy()), search_level)
+        df = df[df["h3"].isin(w["h3"])]
+
+    result = aggregate(w, df, len(names))
+    result["region"] = np.array(names, dtype=object)[result["region"].to_numpy()] if names else []
+    result["time"] = pandas.to_datetime(result["t"], unit="ms", utc=True)
+    return result
@@ -0,0 +1,235 @@
+"""Daily and monthly precipitation rollups of the merged tiles.
+
+Long range totals read from the hourly data touch every hour of every day.
+The rollups keep one row per grid point and period instead, laid out in
+tiles like the merged data, so a season is a handful of monthly reads.
+"""
+
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import mrms_manifest
+import mrms_metrics
+import mrms_tiles
+from mrms_inventory import force_date, parse_date
+
+VERSION = 1
+
+# one row per grid point and period. precipitation is the total, max the
+# largest hourly value, wet_hours the number of hours with precipitation
+# and hours the number of hours with data
+SCHEMA = pa.schema([("h3", pa.int64()), ("t", pa.int64()), ("precipitation", pa.float32()),
+                    ("max", pa.float32()), ("wet_hours", pa.int32()), ("hours", pa.int32())])
+
+# rollups are small, so small row groups keep point lookups cheap
+ROW_GROUP_SIZE = 4096
+
+
+def rollup_dir(dest, period, day):
+    """Returns the directory of the daily or monthly rollup holding `day`"""
+    if period == "monthly":
+        return os.path.join(dest, "rollup/monthly", day.strftime("%Y/%m"))
+    return os.path.join(dest, "rollup/daily", day.strftime("%Y/%m/%d"))
+
+
+def summarize_hours(fname):
+    """Returns the h3 ids, totals, maxima, wet hours and hours of data of
+    each grid point in a tile of hourly data. Grid points that a sparse
+    tile leaves out had no precipitation in any of its hours.
+    """
+    table = mrms_tiles.read_tile(fname)
+    h3 = table["h3"].to_numpy()
+    p = table["precipitation"].to_numpy().astype(np.float64)
+    ids, total, peak, wet, hours = _reduce(h3, np.nan_to_num(p), p, (p > 0).astype(np.int32),
+                                           (~np.isnan(p)).astype(np.int32))
+    m = mrms_tiles.manifest(table.schema)
+    if m is None:
+        return ids, total, peak, wet, hours
+    points, times = m
+    i = np.searchsorted(points, ids)
+    result = [points, np.zeros(len(points)), np.zeros(len(points)), np.zeros(len(points), np.int32),
+              np.full(len(points), len(times), np.int32)]
+    result[1][i] = total
+    result[2][i] = np.fmax(peak, 0)
+    result[3][i] = wet
+    # every hour of a sparse tile has data except where a row holds NaN
+    rows = np.diff(np.r_[_starts(h3), len(h3)]) if len(h3) else np.zeros(0, np.int32)
+    result[4][i] -= (rows - hours).astype(np.int32)
+    return tuple(result)
+
+
+def summarize_rollups(fnames):
+    """Combines the rollups of shorter periods of the same tile"""
+    table = pa.concat_tables([pq.read_table(f) for f in fnames])
+    h3 = table["h3"].to_numpy()
+    order = np.argsort(h3, kind="stable")
+    columns = [table[c].to_numpy()[order] for c in ["precipitation", "max", "wet_hours", "hours"]]
+    return _reduce(h3[order], columns[0].astype(np.float64), columns[1].astype(np.float64), columns[2], columns[3])
+
+
+def _starts(h3):
+    return np.flatnonzero(np.r_[True, h3[1:] != h3[:-1]])
+
+
+def _reduce(h3, total, peak, wet, hours):
+    """Sums (or for `peak` takes the maximum of) each column over runs of
+    the same h3 id, which must be sorted"""
+    if len(h3) == 0:
+        return h3, total, peak, wet, hours
+    starts = _starts(h3)
+    return (h3[starts], np.add.reduceat(total, starts), np.fmax.reduceat(peak, starts),
+            np.add.reduceat(wet, starts), np.add.reduceat(hours, starts))
+
+
+def write_rollup(fname, t0, summary):
+    """Writes a rollup for the period starting at `t0` and returns its hash"""
+    h3, total, peak, wet, hours = summary
+    table = pa.Table.from_arrays([pa.array(h3, pa.int64()), pa.array(np.full(len(h3), t0, np.int64)),
+                                  pa.array(total, pa.float32()), pa.array(peak, pa.float32()),
+                                  pa.array(wet, pa.int32()), pa.array(hours, pa.int32())], schema=SCHEMA)
+    pq.write_table(table, fname, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+    return mrms_manifest.file_hash(fname)
+
+
+def build_day(output, sources, t0):
+    return write_rollup(output, t0, summarize_hours(sources[0]))
+
+
+def build_month(output, sources, t0):
+    return write_rollup(output, t0, summarize_rollups(sources))
+
+
+def update(output, sources, inputs, version, build, t0, workers=2):
+    """Brings the rollup tiles in `output` up to date. `sources` maps each
+    tile name to the files it is built from and `inputs` to their hashes.
+    Like `mrms_merge.merge_data`, only tiles whose inputs changed are
+    rebuilt, the rest are linked from the previous output, and the new
+    output is swapped into place when complete. Returns the number of
+    tiles built.
+    """
+    files = sorted(sources)
+    previous = mrms_manifest.Manifest.load(os.path.join(output, mrms_manifest.MANIFEST))
+    changed = set(f for f in files if not previous.artifact_current(f, version, inputs[f]))
+    mrms_metrics.add(tiles=len(changed), skipped=len(files) - len(changed))
+    if not changed and sorted(previous.artifacts) == files:
+        return 0
+
+    staging = output + ".partial"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    manifest = mrms_manifest.Manifest(version)
+    for f in files:
+        if f not in changed:
+            mrms_tiles.link(os.path.join(output, f), os.path.join(staging, f))
+            manifest.record(f, previous.hash(f), inputs[f])
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(build, os.path.join(staging, f), sources[f], t0): f for f in sorted(changed)}
+        for future in as_completed(futures):
+            f = futures[future]
+            manifest.record(f, future.result(), inputs[f])
+    manifest.save(os.path.join(staging, mrms_manifest.MANIFEST))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    mrms_tiles.swap_dir(staging, output)
+    return len(changed)
+
+
+def rollup_day(dest, day, workers=2):
+    """Rolls the merged tiles of one day up into one row per grid point"""
+    path = day.strftime("%Y/%m/%d")
+    daily = os.path.join(dest, "daily/data", path)
+    if not os.path.isdir(daily):
+        return 0
+    names = mrms_tiles.list_tiles(daily)
+    hashes = mrms_manifest.dir_hashes(daily, names)
+    sources = {f: [os.path.join(daily, f)] for f in names}
+    inputs = {f: {os.path.join(path, f): hashes[f]} for f in names}
+    return update(rollup_dir(dest, "daily", day), sources, inputs, mrms_manifest.stage_version("rollup-day", VERSION),
+                  build_day, millis(day), workers)
+
+
+def rollup_month(dest, year, month, workers=2):
+    """Rolls the daily rollups of one month up into one row per grid point"""
+    first = date(year, month, 1)
+    root = os.path.dirname(rollup_dir(dest, "daily", first))
+    sources, inputs = {}, {}
+    for d in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        if not d.isdigit():
+            continue
+        names = mrms_tiles.list_tiles(os.path.join(root, d))
+        for f, digest in mrms_manifest.dir_hashes(os.path.join(root, d), names).items():
+            sources.setdefault(f, []).append(os.path.join(root, d, f))
+            inputs.setdefault(f, {})[os.path.join(d, f)] = digest
+    if not sources:
+        return 0
+    return update(rollup_dir(dest, "monthly", first), sources, inputs,
+                  mrms_manifest.stage_version("rollup-month", VERSION), build_month, millis(first), workers)
+
+
+def month_complete(dest, day):
+    """True if the monthly rollup of the month of `day` was built from
+    every day of the month with data, that is with a daily rollup or
+    merged or hourly tiles. Otherwise some days are missing from it, or
+    arrived after it was built, and it can't stand in for them."""
+    first = day.replace(day=1)
+    output = rollup_dir(dest, "monthly", first)
+    manifest = mrms_manifest.Manifest.load(os.path.join(output, mrms_manifest.MANIFEST))
+    # inputs are named day/tile
+    built = {name.split("/")[0] for entry in manifest.artifacts.values() for name in entry["inputs"]}
+    days = set()
+    month = first.strftime("%Y/%m")
+    for d in [os.path.dirname(rollup_dir(dest, "daily", first)), os.path.join(dest, "daily/data", month),
+              os.path.join(dest, "hourly/data", month)]:
+        if os.path.isdir(d):
+            days.update(x for x in os.listdir(d) if x.isdigit())
+    return bool(built) and days <= built
+
+
+def rollup_days(dest, first, last, workers=2):
+    """Updates the daily rollups of the days from `first` to `last` and
+    the monthly rollups of their months. Only tiles whose inputs changed
+    since the last run are recomputed."""
+    months = set()
+    day = first
+    while day <= last:
+        with mrms_metrics.span("day", day=str(day)):
+            n = rollup_day(dest, day, workers)
+        print(f"rolled up {n} tiles for {day}")
+        months.add((day.year, day.month))
+        day += timedelta(days=1)
+    for year, month in sorted(months):
+        t0 = time.time()
+        with mrms_metrics.span("month", month=f"{year}-{month:02d}"):
+            n = rollup_month(dest, year, month, workers)
+        print(f"rolled up {n} tiles for {year}-{month:02d} in {time.time() - t0:.1f}s")
+
+
+def millis(day):
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()) * 1000
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Roll merged MRMS tiles up into daily and monthly totals')
+    parser.add_argument("--dest", help="Root of the tile tree. Reads daily/data, writes rollup/daily and rollup/monthly")
+    parser.add_argument("--start", nargs='?', default="-1",
+                        help="Starting date in yyyy-mm-dd form or the number of days before the ending date")
+    parser.add_argument("--end", nargs='?', default="0",
+                        help="Ending date in yyyy-mm-dd form or as number of days offset today. Default is today")
+    parser.add_argument("--workers", default=2, help="Number of tiles to roll up in parallel. Default is 2")
+
+    mrms_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    end = force_date(parse_date(args.end))
+    with mrms_metrics.run("rollup", args.metrics, args.profile):
+        rollup_days(args.dest, force_date(parse_date(args.start), end), end, workers=int(args.workers))
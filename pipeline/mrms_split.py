@@ -0,0 +1,246 @@
+import argparse
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import mrms_catalog
+import mrms_grid
+import mrms_h3
+import mrms_manifest
+import mrms_metrics
+import mrms_tiles
+from mrms_inventory import force_date, parse_date
+
+VERSION = 1
+# the default grid cache, under the root of the output tree
+GRID_CACHE = "grid-cache"
+HOUR_PATTERN = re.compile(r"\d{8}-(\d{2})\d{4}\.grib2")
+
+
+def read_data(input_file, tile_level, ref_level=15, grid_cache=None):
+    """Reads downloaded MRMS weather data and returns a dictionary of
+    NumPy vectors for longitude, latitude, tile id, h3 id, time and
+    precipitation with one entry per grid point.
+
+    Time is milliseconds since 1970 and the H3 ids are signed integers,
+    just as in `mrms_split.jl`. The level `ref_level` h3 id is computed
+    for each point and the tile id is derived from it by truncation, so
+    the expensive lookup is done only once per point. With a `grid_cache`
+    directory, the ids are computed once per grid and reused from there
+    by every later hour (see `mrms_grid`).
+    """
+    import pygrib
+
+    t0 = time.time()
+    if input_file.endswith(".gz"):
+        with tempfile.NamedTemporaryFile(suffix=".grib2") as tmp:
+            with gzip.open(input_file, "rb") as input:
+                shutil.copyfileobj(input, tmp)
+            tmp.flush()
+            lats, lons, v, t = _read_grib(pygrib, tmp.name)
+    else:
+        lats, lons, v, t = _read_grib(pygrib, input_file)
+    print(f"read {input_file} with {len(v)} points in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    lons[lons > 180.0] -= 360.0
+    if grid_cache:
+        grid = mrms_grid.GridGeometry(lats, lons, grid_cache, ref_level)
+        h3, tile = grid.cells(ref_level), grid.cells(tile_level)
+    else:
+        h3 = mrms_h3.cells(lats, lons, ref_level)
+        tile = mrms_h3.parents(h3, tile_level)
+    print(f"  geo time {time.time() - t0:.1f}s")
+
+    return dict(longitude=lons, latitude=lats, tile=tile, h3=h3,
+                t=np.full(len(v), t, dtype=np.int64), precipitation=v)
+
+
+def _read_grib(pygrib, fname):
+    with pygrib.open(fname) as grbs:
+        m = grbs.message(1)
+        lats, lons = m.latlons()
+        v = np.ma.filled(m.values, np.nan)
+        t0 = datetime(m.year, m.month, m.day, m.hour, m.minute, m.second, tzinfo=timezone.utc)
+    t = int(t0.timestamp()) * 1000
+    return (lats.astype(np.float32).reshape(-1), lons.astype(np.float32).reshape(-1),
+            v.astype(np.float32).reshape(-1), t)
+
+
+def split_data(data, output_dir, hash_dir, tile_level, **options):
+    """Writes the data for each tile into a file of its own in
+    `output_dir` and a hash of each such file into `hash_dir`. Only h3,
+    time and precipitation are retained. The rows are sorted once by tile,
+    h3 and time and each tile file is written straight from its slice of
+    the sorted data. Returns a dictionary of tile file names to hashes.
+
+    Any `options` such as `sparse`, `compact` or `quantum` are passed to
+    `mrms_tiles.write_tile` to choose the format of the tile files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(hash_dir, exist_ok=True)
+
+    order = np.lexsort((data["t"], data["h3"], data["tile"]))
+    tile = data["tile"][order]
+    h3 = data["h3"][order]
+    t = data["t"][order]
+    precipitation = data["precipitation"][order]
+
+    starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+    ends = np.r_[starts[1:], len(tile)]
+    hashes = {}
+    for start, end in zip(starts, ends):
+        fname = mrms_tiles.tile_name(tile_level, tile[start])
+        digest = mrms_tiles.write_tile(os.path.join(output_dir, fname),
+                                       h3[start:end], t[start:end], precipitation[start:end], **options)
+        mrms_tiles.write_hash(os.path.join(hash_dir, fname), digest)
+        hashes[fname] = digest
+    return hashes
+
+
+def split_file(input_file, data_dir, hash_dir, tile_level, input_hash=None, grid_cache=None, **options):
+    """Splits one hourly file into tiles. The tiles are written into
+    staging directories that are renamed into place when complete, so the
+    existence of `data_dir` means that the hour has been fully split.
+
+    A manifest in `data_dir` records the hash of the input file, the
+    version of this stage and the hash of every tile.
+    """
+    with mrms_metrics.span("hour", file=os.path.basename(input_file)) as span:
+        return _split_file(span, input_file, data_dir, hash_dir, tile_level, input_hash, grid_cache, **options)
+
+
+def _split_file(span, input_file, data_dir, hash_dir, tile_level, input_hash, grid_cache, **options):
+    t0 = time.time()
+    data = read_data(input_file, tile_level, grid_cache=grid_cache)
+    span.add(rows=len(data["h3"]), bytes=os.path.getsize(input_file))
+    staging_data = data_dir + ".partial"
+    staging_hash = hash_dir + ".partial"
+    for d in [staging_data, staging_hash]:
+        if os.path.exists(d):
+            shutil.rmtree(d)
+    hashes = split_data(data, staging_data, staging_hash, tile_level, **options)
+
+    inputs = {os.path.basename(input_file): input_hash or mrms_manifest.file_hash(input_file)}
+    manifest = mrms_manifest.Manifest(split_version(tile_level, **options), inputs)
+    for fname, digest in hashes.items():
+        manifest.record(fname, digest, inputs)
+    manifest.save(os.path.join(staging_data, mrms_manifest.MANIFEST))
+
+    mrms_tiles.swap_dir(staging_hash, hash_dir)
+    mrms_tiles.swap_dir(staging_data, data_dir)
+    print(f"split {input_file} into {len(hashes)} tiles in {time.time() - t0:.1f}s")
+    span.add(tiles=len(hashes))
+    return len(hashes)
+
+
+def split_version(tile_level, **options):
+    return mrms_manifest.stage_version("split", VERSION, tile_level=tile_level, **options)
+
+
+def find_hours(source, dest, first, last, version=None):
+    """Scans `source` for daily directories of MRMS files between `first`
+    and `last` and returns (file, day, hour, hash) for each hour that needs
+    to be split into `dest`.
+
+    An hour needs splitting if it hasn't been split yet or, when `version`
+    is given, if the manifest of the split hour shows that it was made by
+    another version of this stage or from different content. Hashes of the
+    source files come from the download manifest where possible. Hours
+    split without a manifest are left alone.
+    """
+    downloaded = mrms_manifest.Manifest.load(os.path.join(source, mrms_manifest.MANIFEST))
+    files = []
+    date = first
+    while date <= last:
+        day = date.strftime("%Y/%m/%d")
+        daily_dir = os.path.join(source, day)
+        if os.path.isdir(daily_dir):
+            for hour, f in enumerate(sorted(os.listdir(daily_dir))):
+                if f.startswith("."):
+                    continue
+                m = HOUR_PATTERN.search(f)
+                if m:
+                    hour = int(m.group(1))
+                fname = os.path.join(daily_dir, f)
+                data = os.path.join(dest, "hourly/data", day, f"{hour:02d}")
+                if not os.path.isdir(data):
+                    files.append((fname, day, hour, downloaded.hash(os.path.join(day, f))))
+                    continue
+                split = mrms_manifest.Manifest.load(os.path.join(data, mrms_manifest.MANIFEST))
+                if version and split.exists():
+                    digest = downloaded.hash(os.path.join(day, f)) or mrms_manifest.file_hash(fname)
+                    if not split.current(version, {f: digest}):
+                        files.append((fname, day, hour, digest))
+        date += timedelta(days=1)
+    return files
+
+
+def process_days(source, dest, first, last, tile_level, workers=2, grid_cache=None, **options):
+    """Splits every hourly file under `source` between `first` and `last`
+    that hasn't already been split. Hours are processed in parallel by a
+    pool of `workers` processes. Each worker holds a full hour of data in
+    memory, so the pool size is limited more by memory than by cores.
+
+    Hours whose input has changed or that were split by a different
+    version or with different options are split again. H3 ids of the
+    grid are kept in `grid_cache`, by default GRID_CACHE under `dest`,
+    since computing them point by point (see `mrms_h3.cells`) would take
+    longer than the rest of the split. A `grid_cache` of "" turns the
+    cache off. Each hour is added to the catalog of `dest` (see
+    `mrms_catalog`) once it is in place.
+    """
+    if grid_cache is None:
+        grid_cache = os.path.join(dest, GRID_CACHE)
+    files = find_hours(source, dest, first, last, split_version(tile_level, **options))
+    print(f"Starting {len(files)} files")
+    catalog = mrms_catalog.Catalog(dest)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for fname, day, hour, digest in files:
+            data = os.path.join(dest, "hourly/data", day, f"{hour:02d}")
+            hash = os.path.join(dest, "hourly/hash", day, f"{hour:02d}")
+            os.makedirs(os.path.dirname(data), exist_ok=True)
+            os.makedirs(os.path.dirname(hash), exist_ok=True)
+            futures[pool.submit(split_file, fname, data, hash, tile_level, digest, grid_cache, **options)] = data
+        for f in as_completed(futures):
+            mrms_metrics.add(files=1, tiles=f.result())
+            catalog.update_dir(futures[f])
+    catalog.close()
+    return len(files)
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Split hourly MRMS files into H3 tile files')
+    parser.add_argument("--source", help="Root of the downloaded MRMS tree in yyyy/mm/dd form")
+    parser.add_argument("--dest", help="Root of the output tree. Tiles go into hourly/data/yyyy/mm/dd/hh")
+    parser.add_argument("--start", nargs='?', default="-1",
+                        help="Starting date in yyyy-mm-dd form or the number of days before the ending date")
+    parser.add_argument("--end", nargs='?', default="0",
+                        help="Ending date in yyyy-mm-dd form or as number of days offset today. Default is today")
+    parser.add_argument("--tile-level", default=3, help="H3 resolution of the tiles. Default is 3")
+    parser.add_argument("--workers", default=2, help="Number of hours to split in parallel. Default is 2")
+    parser.add_argument("--sparse", action="store_true", help="Only store grid points with non-zero precipitation")
+    parser.add_argument("--compact", action="store_true", help="Use the compact tile encoding")
+    parser.add_argument("--quantum", default=None,
+                        help="Store precipitation as multiples of this amount (compact tiles only), e.g. 0.1")
+    parser.add_argument("--grid-cache", default=None,
+                        help="Directory to cache the H3 ids of the grid in. Default is grid-cache under --dest")
+    parser.add_argument("--no-grid-cache", action="store_true", help="Compute the H3 ids of every hour from scratch")
+    mrms_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    end = force_date(parse_date(args.end))
+    with mrms_metrics.run("split", args.metrics, args.profile):
+        process_days(args.source, args.dest, force_date(parse_date(args.start), end), end,
+                     int(args.tile_level), workers=int(args.workers),
+                     grid_cache="" if args.no_grid_cache else args.grid_cache,
+                     sparse=args.sparse, compact=args.compact, quantum=float(args.quantum) if args.quantum else None)
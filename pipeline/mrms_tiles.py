@@ -0,0 +1,442 @@
+"""Tile files hold the history of every grid point inside one H3 tile. Each
+row has the level 15 h3 id of a grid point, the time in milliseconds since
+1970 and the precipitation for the hour ending at that time. Rows are
+ordered by h3 and then by time.
+
+Most grid points are dry in any given hour, so tile files can also be
+written in sparse form. A sparse tile keeps only the rows with non-zero
+precipitation together with a manifest of every grid point and every time
+that the file covers. Any row that is missing from a sparse tile but is
+covered by the manifest had zero precipitation.
+
+Tiles can also be written in a compact encoding. The h3 column is
+dictionary encoded, times are stored as small integer offsets from a base
+time recorded in the file metadata and precipitation can be quantized to
+a fixed step such as the 0.1 mm resolution of MRMS. Row groups are kept
+small enough that the min/max statistics on h3 let a reader skip most of
+a file when looking for a few grid points. `read_tile` undoes all of this
+so that callers always see the plain schema.
+"""
+
+import ctypes
+import errno
+import hashlib
+import math
+import os
+import shutil
+import zlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema([("h3", pa.int64()), ("t", pa.int64()), ("precipitation", pa.float32())])
+
+# rows per row group in compact tiles, about 80 days of history for 30 points
+ROW_GROUP_SIZE = 65536
+
+# quantized precipitation that was NaN in the original data
+MISSING = np.iinfo(np.int32).min
+
+# metadata keys that describe the compact encoding
+ENCODING_KEYS = [b"encoding", b"t0", b"t_step", b"quantum"]
+
+
+def tile_name(tile_level, tile):
+    """Returns the file name used for `tile`, the same as the Julia code uses"""
+    return f"x-{tile_level}-{tile}"
+
+
+def write_tile(fname, h3, t, precipitation, sparse=False, points=None, times=None,
+               compact=False, quantum=None, row_group_size=ROW_GROUP_SIZE):
+    """Writes the columns for one tile to `fname` and returns a hash of the
+    file content. The hash is computed from the bytes as they are written,
+    so the file never needs to be read back.
+
+    With `sparse`, only rows with non-zero precipitation are written. The
+    grid points and times covered by the file are recorded in the file
+    metadata. These default to the distinct values of `h3` and `t`, but
+    can be given explicitly when the input is already sparse.
+
+    With `compact`, the file uses the compact encoding described above. If
+    `quantum` is also given, precipitation is stored as an integer multiple
+    of `quantum`.
+    """
+    h3 = np.asarray(h3, dtype=np.int64)
+    t = np.asarray(t, dtype=np.int64)
+    if sparse:
+        points = np.unique(h3) if points is None else points
+        times = np.unique(t) if times is None else times
+    else:
+        points = times = None
+    t0, t_step = time_base(t)
+    with TileWriter(fname, points=points, times=times, compact=compact, quantum=quantum,
+                    t0=t0, t_step=t_step, row_group_size=row_group_size) as out:
+        out.write(h3, t, precipitation)
+    return out.digest
+
+
+def write_hash(fname, digest):
+    with open(fname, "w") as out:
+        print(digest, file=out)
+
+
+class TileWriter:
+    """Writes a tile file a batch at a time so that arbitrarily large tiles
+    can be written with bounded memory. Batches must arrive in h3 and time
+    order. The file is sparse if `points` and `times` are given. Compact
+    files need the base time `t0` and a step `t_step` that divides every
+    time offset up front because these are recorded in the file schema. A
+    step of zero means that every time is `t0`.
+    Rows are buffered and written in row groups of `row_group_size` rows
+    however the batches are cut, so the row groups of a merged tile are as
+    large as those of a tile written at once.
+    The hash of the content is available as `digest` after `close`.
+    """
+
+    def __init__(self, fname, points=None, times=None, compact=False, quantum=None,
+                 t0=0, t_step=1, row_group_size=ROW_GROUP_SIZE):
+        self.sparse = points is not None
+        self.compact = compact
+        self.quantum = quantum if compact else None
+        self.t0 = t0
+        self.t_step = t_step
+        self.row_group_size = row_group_size
+        self.digest = None
+
+        metadata = {}
+        if self.sparse:
+            metadata.update({b"points": _pack(points), b"times": _pack(times)})
+        if compact:
+            metadata.update({b"encoding": b"compact", b"t0": str(t0).encode(), b"t_step": str(self.t_step).encode()})
+            p_type = pa.float32()
+            if self.quantum:
+                metadata[b"quantum"] = repr(float(self.quantum)).encode()
+                p_type = pa.int32()
+            schema = pa.schema([("h3", pa.int64()), ("t", pa.int32()), ("precipitation", p_type)], metadata=metadata)
+            options = dict(compression="zstd", use_dictionary=["h3", "precipitation"],
+                           column_encoding={"t": "DELTA_BINARY_PACKED"})
+        else:
+            schema = SCHEMA.with_metadata(metadata or None)
+            options = {}
+        self.schema = schema
+        self.file = _HashingFile(fname)
+        self.writer = pq.ParquetWriter(self.file, schema, **options)
+        self.rows = 0
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, h3, t, precipitation):
+        h3 = np.asarray(h3, dtype=np.int64)
+        t = np.asarray(t, dtype=np.int64)
+        precipitation = np.asarray(precipitation, dtype=np.float32)
+        if self.sparse:
+            wet = precipitation != 0
+            h3, t, precipitation = h3[wet], t[wet], precipitation[wet]
+        if self.compact:
+            if np.any((t - self.t0) % max(self.t_step, 1)) or (self.t_step == 0 and np.any(t != self.t0)):
+                raise ValueError(f"Times must be multiples of {self.t_step} ms after {self.t0}")
+            columns = encode(h3, t, precipitation, self.quantum, self.t0, self.t_step)
+        else:
+            columns = [h3, t, precipitation]
+        table = pa.Table.from_arrays([pa.array(x) for x in columns], schema=self.schema)
+        if table.num_rows > 0:
+            self.pending.append(table)
+            self.pending_rows += table.num_rows
+            if self.pending_rows >= self.row_group_size:
+                self._flush()
+        self.rows += table.num_rows
+
+    def _flush(self, all=False):
+        """Writes the whole row groups buffered, or everything with `all`"""
+        table = pa.concat_tables(self.pending)
+        n = table.num_rows if all else table.num_rows - table.num_rows % self.row_group_size
+        if n > 0:
+            self.writer.write_table(table.slice(0, n), row_group_size=self.row_group_size)
+        rest = table.slice(n)
+        self.pending = [rest] if rest.num_rows else []
+        self.pending_rows = rest.num_rows
+
+    def close(self):
+        if self.pending:
+            self._flush(all=True)
+        self.writer.close()
+        self.file.close()
+        self.digest = self.file.hash.hexdigest()
+        return self.digest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _HashingFile:
+    """A write-only file that hashes everything written to it"""
+
+    def __init__(self, fname):
+        self.out = open(fname, "wb")
+        self.hash = hashlib.sha256()
+        self.closed = False
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.out.write(data)
+
+    def tell(self):
+        return self.out.tell()
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        if not self.closed:
+            self.out.close()
+            self.closed = True
+
+
+def time_base(t):
+    """Returns the earliest of a vector of times and the largest step that
+    divides the offset of every time from it (an hour for MRMS data). The
+    step is zero if all of the times are the same.
+    """
+    if len(t) == 0:
+        return 0, 0
+    t0 = int(np.min(t))
+    return t0, int(np.gcd.reduce(np.asarray(t, dtype=np.int64) - t0))
+
+
+def encode(h3, t, precipitation, quantum, t0, t_step):
+    """Converts tile columns into the compact encoding. Times become
+    offsets from `t0` in units of `t_step`.
+    """
+    offsets = (t - t0) // max(t_step, 1)
+    if len(offsets) > 0 and offsets.max() > np.iinfo(np.int32).max:
+        raise ValueError(f"Times span too many steps of {t_step} ms to encode")
+    columns = [h3, offsets.astype(np.int32)]
+    if quantum:
+        q = np.round(precipitation / quantum)
+        q[np.isnan(q)] = MISSING
+        columns.append(q.astype(np.int32))
+    else:
+        columns.append(precipitation)
+    return columns
+
+
+def decode(table):
+    """Converts a table read from a compact tile file back into the plain
+    schema. Tables that aren't compact are returned as they are. Any of
+    the columns may be missing from `table`.
+    """
+    metadata = table.schema.metadata or {}
+    if metadata.get(b"encoding") != b"compact":
+        return table
+    columns = []
+    fields = []
+    for field in SCHEMA:
+        if field.name not in table.column_names:
+            continue
+        x = table[field.name]
+        if field.name == "t":
+            x = x.to_numpy().astype(np.int64) * int(metadata[b"t_step"]) + int(metadata[b"t0"])
+        elif field.name == "precipitation" and b"quantum" in metadata:
+            q = x.to_numpy()
+            x = (q * float(metadata[b"quantum"])).astype(np.float32)
+            x[q == MISSING] = np.nan
+        columns.append(pa.array(x, field.type) if isinstance(x, np.ndarray) else x)
+        fields.append(field)
+    kept = {k: v for k, v in metadata.items() if k not in ENCODING_KEYS}
+    return pa.Table.from_arrays(columns, schema=pa.schema(fields, metadata=kept or None))
+
+
+def read_tile(fname, columns=None, h3=None):
+    """Reads a tile file as a pyarrow table with the plain schema. Sparse
+    tiles are not densified. If `h3` is given, only rows for those grid
+    points are returned and row groups that can't contain them are
+    skipped using the h3 statistics.
+    """
+    filters = [("h3", "in", [int(x) for x in h3])] if h3 is not None else None
+    return decode(pq.read_table(fname, columns=columns, filters=filters))
+
+
+def iter_tile(fname, batch_size=ROW_GROUP_SIZE):
+    """Reads a tile file a batch at a time, yielding plain tables of at
+    most `batch_size` rows in file order.
+    """
+    pf = pq.ParquetFile(fname)
+    metadata = pf.schema_arrow.metadata
+    for batch in pf.iter_batches(batch_size=batch_size):
+        yield decode(pa.Table.from_batches([batch]).replace_schema_metadata(metadata))
+
+
+def read_time_base(fname, batch_size=ROW_GROUP_SIZE):
+    """Returns the earliest time in a tile file and the largest step that
+    divides all time offsets from it, as in `time_base`. Compact files
+    record this in their metadata. Other files are scanned a batch at a
+    time.
+    """
+    pf = pq.ParquetFile(fname)
+    metadata = pf.schema_arrow.metadata or {}
+    if metadata.get(b"encoding") == b"compact":
+        return int(metadata[b"t0"]), int(metadata[b"t_step"])
+    bases = [time_base(batch["t"].to_numpy()) for batch in pf.iter_batches(batch_size=batch_size, columns=["t"])]
+    return combine_time_bases(bases)
+
+
+def combine_time_bases(bases):
+    """Combines (t0, t_step) pairs into one that works for all of them"""
+    bases = [b for b in bases if b is not None]
+    if not bases:
+        return 0, 1
+    t0 = min(b[0] for b in bases)
+    step = 0
+    for b0, b_step in bases:
+        step = math.gcd(step, b0 - t0, b_step)
+    return t0, step
+
+
+def read_manifest(fname):
+    """Returns the grid points and times covered by a sparse tile file, or
+    None if the file is not sparse.
+    """
+    return manifest(pq.read_schema(fname))
+
+
+def manifest(schema):
+    """Returns the manifest (points, times) recorded in a tile schema, or
+    None for a dense tile."""
+    metadata = schema.metadata or {}
+    if b"points" not in metadata:
+        return None
+    return _unpack(metadata[b"points"]), _unpack(metadata[b"times"])
+
+
+def read_dense(fname, h3=None):
+    """Reads a tile file, filling in the zero rows left out of a sparse
+    tile. If `h3` is given, only the histories of those grid points are
+    returned. Dense tiles are returned as they are, apart from the
+    selection.
+    """
+    table = read_tile(fname, h3=h3)
+    m = manifest(table.schema)
+    if m is None:
+        return table.replace_schema_metadata(None)
+    points, times = m
+    if h3 is not None:
+        points = points[np.isin(points, np.asarray(h3, dtype=np.int64))]
+    return densify(table, points, times)
+
+
+def densify(table, points, times):
+    """Expands the sparse rows in `table` to one row for every combination
+    of `points` and `times`, both of which must be sorted. The result is
+    ordered by h3 and then by time.
+    """
+    n = len(times)
+    precipitation = np.zeros(len(points) * n, dtype=np.float32)
+    if table.num_rows > 0:
+        i = np.searchsorted(points, table["h3"].to_numpy())
+        j = np.searchsorted(times, table["t"].to_numpy())
+        precipitation[i * n + j] = table["precipitation"].to_numpy()
+    return pa.Table.from_arrays([pa.array(np.repeat(points, n)), pa.array(np.tile(times, len(points))),
+                                 pa.array(precipitation)], schema=SCHEMA)
+
+
+def _pack(values):
+    return zlib.compress(np.asarray(values, dtype="<i8").tobytes())
+
+
+def _unpack(content):
+    return np.frombuffer(zlib.decompress(content), dtype="<i8").astype(np.int64)
+
+
+def list_tiles(dir):
+    """Lists the tile files in a directory"""
+    return sorted(f for f in os.listdir(dir) if f.startswith("x-"))
+
+
+def link(source, target):
+    """Hard links an unchanged file into a staging directory, copying it
+    if links aren't possible"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def swap_dir(staging, target):
+    """Moves a completely written `staging` directory to `target`. If
+    `target` doesn't exist yet, this is a single atomic rename. Otherwise
+    the two are exchanged atomically where the system can (Linux 3.15 and
+    later on most file systems) and the old content is deleted, so readers
+    see either the old or the new content and `target` always exists.
+
+    Elsewhere the old directory is moved aside first, leaving a moment in
+    which `target` is missing. What a crash in that moment leaves behind
+    is put back in place by `recover_dirs`, which runs here first.
+    """
+    parent = os.path.dirname(os.path.abspath(target))
+    recover_dirs(parent)
+    if not os.path.exists(target):
+        os.rename(staging, target)
+        return
+    if _exchange(staging, target):
+        shutil.rmtree(staging)
+        return
+    old = f"{target}{OLD}{os.getpid()}"
+    os.rename(target, old)
+    os.rename(staging, target)
+    shutil.rmtree(old)
+
+
+# suffix of a directory moved aside by swap_dir, followed by the process id
+OLD = ".old-"
+
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+_renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+
+
+def _exchange(a, b):
+    """Atomically exchanges two paths. Returns False if the system can't."""
+    if _renameat2 is None:
+        return False
+    if _renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(err, os.strerror(err), b)
+
+
+def recover_dirs(parent, names=None):
+    """Cleans up after swaps in `parent` that were interrupted, given the
+    `names` in it if these are known. A directory moved aside by a process
+    that is gone is moved back if nothing took its place, and deleted
+    otherwise. Returns the number of directories cleaned up."""
+    if names is None:
+        if not os.path.isdir(parent):
+            return 0
+        names = os.listdir(parent)
+    n = 0
+    for name in names:
+        target, sep, pid = name.rpartition(OLD)
+        if not sep or not pid.isdigit() or _alive(int(pid)):
+            continue
+        old, target = os.path.join(parent, name), os.path.join(parent, target)
+        if os.path.exists(target):
+            shutil.rmtree(old)
+        else:
+            os.rename(old, target)
+        n += 1
+    return n
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
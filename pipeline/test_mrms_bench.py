@@ -0,0 +1,50 @@
+import datetime
+import os
+import tempfile
+
+import numpy as np
+
+import mrms_bench
+import mrms_inventory
+import mrms_split
+
+
+def test_grib():
+    rng = np.random.default_rng(2)
+    values = mrms_bench.synthetic_field((40, 70), 0.8, rng)
+    assert abs((values == 0).mean() - 0.8) < 0.01
+    fname = os.path.join(tempfile.mkdtemp(), "x.grib2.gz")
+    t = datetime.datetime(2021, 8, 21, 5, tzinfo=datetime.timezone.utc)
+    first = mrms_bench.grid((40, 70))
+    mrms_bench.write_grib(fname, values, first, t)
+
+    data = mrms_split.read_data(fname, 3)
+    assert np.allclose(data["precipitation"], values.reshape(-1), atol=0.051)
+    assert data["t"][0] == int(t.timestamp()) * 1000
+    assert np.isclose(data["latitude"][0], first[0]) and np.isclose(data["longitude"][0], first[1])
+    assert np.isclose(data["latitude"][-1], first[0] - 0.39) and np.isclose(data["longitude"][-1], first[1] + 0.69)
+
+
+def test_archive():
+    root = tempfile.mkdtemp()
+    day = datetime.date(2021, 8, 21)
+    mrms_bench.build_archive(root, day, 3, (20, 30), 0.9)
+    server = mrms_bench.serve_archive(root)
+    try:
+        url = mrms_bench.URL.format(host="127.0.0.1", port=server.server_port)
+        inv = mrms_inventory.inventory(day, day, url=url, search_path=[mrms_bench.DIR])
+        assert len(inv) == 3
+        assert inv["url"][0].endswith("20210821-000000.grib2.gz")
+        assert inv["size"].str.match(r"\d+K").all()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_benchmark():
+    results = mrms_bench.benchmark(tempfile.mkdtemp(), [(30, 50)], levels=[3, 4], hours=2, points=10, fields=3)
+    stages = [r["stage"] for r in results]
+    assert stages[:3] == ["generate", "inventory", "download"]
+    assert stages.count("split") == 2 and stages.count("nearest") == 2 and stages.count("region") == 2
+    assert all(r["seconds"] >= 0 and r["machine"]["cpus"] for r in results)
+    assert [r["rows_found"] for r in results if r["stage"] == "batch"] == [20, 20]
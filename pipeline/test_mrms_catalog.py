@@ -0,0 +1,140 @@
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+import mrms_bench
+import mrms_catalog
+import mrms_h3
+import mrms_query
+import mrms_split
+import mrms_tiles
+from test_mrms_query import DAY, check, expected, tile_tree
+
+
+def test_catalog():
+    for merge, options in [(False, {}), (True, {}), (True, dict(sparse=True, compact=True))]:
+        root, data = tile_tree(hours=3, merge=merge, **options)
+        catalog = mrms_catalog.Catalog(root)
+        catalog.rebuild()
+        plain = mrms_query.TileStore(root)
+        store = mrms_query.TileStore(root, catalog=catalog)
+        dirs = store.dirs(DAY, DAY)
+        assert dirs == plain.dirs(DAY, DAY)
+
+        rows = catalog.db.execute("SELECT sum(rows) FROM files WHERE dir LIKE ?",
+                                  ("daily%" if merge else "hourly%",)).fetchone()[0]
+        assert rows == sum(mrms_tiles.read_tile(os.path.join(d, f)).num_rows
+                           for d in dirs for f in mrms_tiles.list_tiles(d))
+
+        refs = np.unique(data["h3"])[[3, 200, 201, 850]]
+        times = np.unique(data["t"])
+        check(store.query(refs, dirs), data, refs)
+        check(store.query(refs, dirs, times[1], times[1]), data, refs, times[1], times[1])
+        lo, hi = mrms_h3.child_range(mrms_h3.parents(refs[:1], 5))
+        assert store.query_ranges(lo, hi, dirs).equals(plain.query_ranges(lo, hi, dirs))
+        rows = [sum(b.num_rows for b in s.batch(refs, [times[0]] * 4, [times[-1]] * 4)) for s in [store, plain]]
+        assert rows[0] == rows[1] > 0
+
+        # unknown directories are read as they are
+        other = tempfile.mkdtemp()
+        shutil.copytree(dirs[0], os.path.join(other, "copy"))
+        check(store.query(refs[:1], [os.path.join(other, "copy")]), data, refs[:1], times[0], times[0] if not merge
+              else times[-1])
+
+
+def test_time_pruning():
+    root, data = tile_tree(hours=4, n=40, merge=True, compact=True)
+    dirs = mrms_query.TileStore(root).dirs(DAY, DAY)
+    refs = np.unique(data["h3"])[[10]]
+    tile = mrms_h3.parents(refs, 3)[0]
+    fname = os.path.join(dirs[0], mrms_tiles.tile_name(3, tile))
+    table = mrms_tiles.read_tile(fname)
+    mrms_tiles.write_tile(fname, table["h3"].to_numpy(), table["t"].to_numpy(),
+                          table["precipitation"].to_numpy(), compact=True, row_group_size=2)
+
+    # the merge recorded the day, but the file has changed since
+    catalog = mrms_catalog.Catalog(root)
+    store = mrms_query.TileStore(root, catalog=catalog)
+    check(store.query(refs, dirs), data, refs)
+    (_, entry), = catalog.files(3, tile, dirs, refs, refs)
+    assert entry.version != store.open(fname).version
+
+    assert catalog.update_dir(dirs[0]) == 1
+    assert catalog.update_dir(dirs[0]) == 0
+    times = np.unique(data["t"])
+    (_, entry), = catalog.files(3, tile, dirs, refs, refs)
+    assert len(entry.row_groups(refs, refs)) == 2
+    assert len(entry.row_groups(refs, refs, times[2], times[2])) == 1
+    assert len(catalog.files(3, tile, dirs, refs, refs, times[-1] + 1)) == 0
+    check(store.query(refs, dirs, times[2], times[2]), data, refs, times[2], times[2])
+
+    group = catalog.db.execute("SELECT offset, bytes, rows FROM row_groups ORDER BY offset DESC").fetchone()
+    assert group[0] > 0 and group[1] > 0 and group[2] == 2
+
+
+def test_removed_dirs():
+    root, data = tile_tree(hours=2, merge=True)
+    catalog = mrms_catalog.Catalog(root)
+    catalog.rebuild()
+    assert len(catalog.dirs(DAY, DAY)) == 1
+    daily = os.path.join(root, "daily/data/2021/08/21")
+    shutil.rmtree(daily)
+    assert catalog.rebuild() == 0
+    dirs = catalog.dirs(DAY, DAY)
+    assert dirs == mrms_query.TileStore(root).dirs(DAY, DAY) and len(dirs) == 2
+
+    # another connection sees the change
+    reader = mrms_catalog.Catalog(root)
+    assert reader.dirs(DAY, DAY) == dirs
+    catalog.remove_dir(dirs[0])
+    assert reader.dirs(DAY, DAY) == dirs[1:]
+
+
+def test_unknown_days():
+    root, data = tile_tree(hours=2, merge=True)
+    refs = np.unique(data["h3"])[[3, 200]]
+    # the day was merged before there was a catalog
+    os.remove(os.path.join(root, mrms_catalog.CATALOG))
+    catalog = mrms_catalog.Catalog(root)
+    store = mrms_query.TileStore(root, catalog=catalog)
+    dirs = store.dirs(DAY - datetime.timedelta(days=1), DAY)
+    assert dirs == mrms_query.TileStore(root).dirs(DAY, DAY) == [os.path.join(root, "daily/data/2021/08/21")]
+    check(store.query(refs, dirs), data, refs)
+    times = np.unique(data["t"])
+    rows = sum(b.num_rows for b in store.batch(refs, [times[0]] * 2, [times[-1]] * 2))
+    assert rows == len(expected(data, refs)[0])
+
+
+def test_split_catalog():
+    source, dest = tempfile.mkdtemp(), tempfile.mkdtemp()
+    folder = os.path.join(source, "2021/08/21")
+    os.makedirs(folder)
+    rng = np.random.default_rng(5)
+    for h in range(2):
+        t = datetime.datetime(2021, 8, 21, h, tzinfo=datetime.timezone.utc)
+        mrms_bench.write_grib(os.path.join(folder, mrms_bench.file_name(t)), mrms_bench.synthetic_field((20, 30), 0.5, rng),
+                              mrms_bench.grid((20, 30)), t)
+    mrms_split.process_days(source, dest, DAY, DAY, 3, workers=1)
+    catalog = mrms_catalog.Catalog(dest)
+    assert [os.path.basename(d) for d in catalog.dirs(DAY, DAY)] == ["00", "01"]
+    t_min, t_max, rows = catalog.db.execute("SELECT min(t_min), max(t_max), sum(rows) FROM files").fetchone()
+    assert t_max - t_min == 3600 * 1000 and rows == 2 * 600
+    # the h3 ids of the grid are cached under dest by default
+    assert len(os.listdir(os.path.join(dest, mrms_split.GRID_CACHE))) == 1
+
+
+def test_script():
+    root, data = tile_tree(hours=2, merge=True)
+    os.remove(os.path.join(root, mrms_catalog.CATALOG))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mrms_catalog.py")
+    result = subprocess.run([sys.executable, script, "--root", root], capture_output=True, text=True, check=True)
+    dirs = [os.path.join(root, period, "data/2021/08/21", h) for period, h in
+            [("daily", ""), ("hourly", "00"), ("hourly", "01")]]
+    files = sum(len(mrms_tiles.list_tiles(d)) for d in dirs)
+    assert result.stdout.split()[:2] == ["described", str(files)]
+    assert mrms_catalog.Catalog(root).dirs(DAY, DAY) == mrms_query.TileStore(root).dirs(DAY, DAY)
@@ -0,0 +1,139 @@
+import datetime
+import os
+import tempfile
+
+import numpy as np
+
+import mrms_catalog
+import mrms_compact
+import mrms_merge
+import mrms_query
+import mrms_split
+import mrms_tiles
+from test_mrms_query import check
+from test_mrms_split import synthetic_hours
+
+FIRST = datetime.date(2021, 8, 21)
+LAST = datetime.date(2021, 8, 22)
+
+
+def tile_tree(days=2, hours=3, **options):
+    """Splits a few hours on each of a few days into a tile tree and merges
+    them into days"""
+    hour = synthetic_hours(hours=1, n=30)
+    root = tempfile.mkdtemp()
+    parts = []
+    for k in range(days):
+        day = FIRST + datetime.timedelta(days=k)
+        for h in range(hours):
+            data = dict(hour, t=hour["t"] + (k * 24 + h) * 3600_000)
+            path = os.path.join(day.strftime("%Y/%m/%d"), f"{h:02d}")
+            mrms_split.split_data(data, os.path.join(root, "hourly/data", path), os.path.join(root, "hourly/hash", path), 3,
+                                  **options)
+            parts.append(data)
+    mrms_merge.merge_days(root, FIRST, FIRST + datetime.timedelta(days=days - 1), workers=1)
+    return root, {name: np.concatenate([p[name] for p in parts]) for name in hour}
+
+
+def test_compact():
+    root, data = tile_tree()
+    refs = np.unique(data["h3"])[[3, 200, 850]]
+    times = np.unique(data["t"])
+
+    def check_stores(periods):
+        catalog = mrms_catalog.Catalog(root)
+        for store in [mrms_query.TileStore(root), mrms_query.TileStore(root, catalog=catalog)]:
+            dirs = store.dirs(FIRST, LAST)
+            assert [os.path.relpath(d, root).split("/")[0] for d in dirs] == periods
+            check(store.query(refs, dirs, times[0], times[-1]), data, refs)
+            check(store.query(refs, store.dirs(LAST, LAST), times[3], times[4]), data, refs, times[3], times[4])
+
+    catalog = mrms_catalog.Catalog(root)
+    catalog.rebuild()
+    tiles = len(mrms_tiles.list_tiles(os.path.join(root, "daily/data/2021/08/21")))
+    assert mrms_compact.count_files(root) == dict(hourly=6 * tiles, daily=2 * tiles, monthly=0)
+
+    # the hours of the first day are old enough to go
+    counts = mrms_compact.compact(root, datetime.date(2021, 8, 24), hourly_days=2, daily_days=10)
+    assert counts == dict(hourly=3 * tiles, daily=2 * tiles, monthly=0)
+    assert not os.path.exists(os.path.join(root, "hourly/data/2021/08/21"))
+    assert not os.path.exists(os.path.join(root, "hourly/hash/2021/08/21"))
+    check_stores(["daily", "daily"])
+
+    # the month can't be folded while it has hours
+    assert mrms_compact.compact_month(root, 2021, 8, catalog) == 0
+    counts = mrms_compact.compact(root, datetime.date(2021, 9, 11), hourly_days=2, daily_days=10)
+    assert counts == dict(hourly=0, daily=0, monthly=tiles)
+    assert os.listdir(os.path.join(root, "daily/data/2021/08")) == []
+    check_stores(["monthly"])
+
+    # a batch reads the monthly tile once, not once a day
+    store = mrms_query.TileStore(root)
+    reads = []
+    read = store.read
+    store.read = lambda fname, *args: reads.append(fname) or read(fname, *args)
+    rows = sum(b.num_rows for b in store.batch(refs[:1], [FIRST], [LAST + datetime.timedelta(days=1)]))
+    assert rows == np.sum(data["h3"] == refs[0]) and len(reads) == 1
+
+    # running again changes nothing
+    before = os.stat(os.path.join(root, "monthly/data/2021/08", mrms_tiles.list_tiles(
+        os.path.join(root, "monthly/data/2021/08"))[0]))
+    assert mrms_compact.compact(root, datetime.date(2021, 12, 1)) == counts
+    after = os.stat(os.path.join(root, "monthly/data/2021/08", mrms_tiles.list_tiles(
+        os.path.join(root, "monthly/data/2021/08"))[0]))
+    assert before.st_ino == after.st_ino
+
+
+def test_interrupted():
+    root, data = tile_tree(hours=2)
+    refs = np.unique(data["h3"])[[5, 500]]
+    catalog = mrms_catalog.Catalog(root)
+    mrms_compact.compact(root, datetime.date(2021, 8, 30), hourly_days=2)
+
+    # the month was swapped in, but only one day was removed
+    days = [os.path.join(root, "daily/data/2021/08", d) for d in ["21", "22"]]
+    mrms_merge.merge_data(os.path.join(root, "monthly/data/2021/08"), days)
+    mrms_compact.remove_dir(days[0])
+    catalog.rebuild()
+    store = mrms_query.TileStore(root, catalog=catalog)
+    assert store.dirs(FIRST, LAST) == [os.path.join(root, "monthly/data/2021/08")]
+    check(store.query(refs, store.dirs(FIRST, LAST), FIRST, LAST + datetime.timedelta(days=1)), data, refs)
+
+    # a day that changed after its month was folded goes into it
+    reissued = {name: v[data["t"] >= mrms_query.millis(LAST)] for name, v in data.items()}
+    reissued["precipitation"] = reissued["precipitation"] * 2
+    scratch = tempfile.mkdtemp()
+    mrms_split.split_data(reissued, os.path.join(scratch, "data"), os.path.join(scratch, "hash"), 3)
+    mrms_compact.remove_dir(days[1])
+    mrms_merge.merge_data(days[1], [os.path.join(scratch, "data")])
+    assert not mrms_compact.folded(os.path.join(root, "monthly/data/2021/08"), days[1])
+    assert mrms_compact.compact_month(root, 2021, 8, catalog) == 1
+    assert os.listdir(os.path.join(root, "daily/data/2021/08")) == []
+    data["precipitation"] = np.where(data["t"] >= mrms_query.millis(LAST), data["precipitation"] * 2,
+                                     data["precipitation"])
+    for store in [store, mrms_query.TileStore(root)]:
+        check(store.query(refs, store.dirs(FIRST, LAST), FIRST, LAST + datetime.timedelta(days=1)), data, refs)
+
+
+def test_late_dry_day():
+    root, data = tile_tree(hours=2, sparse=True)
+    catalog = mrms_catalog.Catalog(root)
+    mrms_compact.compact(root, datetime.date(2021, 9, 30), hourly_days=2, daily_days=10)
+    monthly = os.path.join(root, "monthly/data/2021/08")
+    assert os.path.isdir(monthly)
+
+    # day 22 is issued again with its wettest hour at one point gone dry
+    day = data["t"] >= mrms_query.millis(LAST)
+    wet = np.flatnonzero(day & (data["precipitation"] > 0))[0]
+    data["precipitation"][wet] = 0
+    reissued = {name: v[day] for name, v in data.items()}
+    scratch = tempfile.mkdtemp()
+    mrms_split.split_data(reissued, os.path.join(scratch, "data"), os.path.join(scratch, "hash"), 3, sparse=True)
+    late = os.path.join(root, "daily/data/2021/08/22")
+    os.makedirs(os.path.dirname(late), exist_ok=True)
+    mrms_merge.merge_data(late, [os.path.join(scratch, "data")])
+    assert mrms_compact.compact_month(root, 2021, 8, catalog) == 1
+
+    refs = data["h3"][[wet]]
+    store = mrms_query.TileStore(root)
+    check(store.query(refs, store.dirs(FIRST, LAST)), data, refs)
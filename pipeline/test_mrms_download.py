@@ -4,6 +4,12 @@ import mrms_inventory
 import mrms_download
 import os
 import datetime
+import functools
+import http.server
+import threading
+import time
+import pandas
+import pytest
 
 target = tempfile.TemporaryDirectory()
 inv_dir = tempfile.TemporaryDirectory()
@@ -32,3 +38,130 @@ def test_download():
     assert len(more) == 7
     assert len(set(more).intersection(set(first_pass))) == 4
     assert len(set(more).difference(set(first_pass))) == 3
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files over keep-alive connections without logging requests"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(root, handler=QuietHandler):
+    """Serves the files under `root` over HTTP on a local port in a background thread."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_concurrent_download():
+    source = tempfile.TemporaryDirectory()
+    dest = tempfile.TemporaryDirectory()
+    for i in range(10):
+        with open(os.path.join(source.name, f"MultiSensor-{i:02d}.grib2.gz"), "wb") as out:
+            out.write(os.urandom((i + 1) * 1024))
+
+    server = serve(source.name)
+    try:
+        base = f"http://127.0.0.1:{server.server_port}"
+        day = datetime.date(2021, 8, 21)
+        inv = pandas.DataFrame(dict(
+            date=[day] * 10,
+            url=[f"{base}/MultiSensor-{i:02d}.grib2.gz" for i in range(10)],
+            mtime=["2021-08-21 01:00"] * 10,
+            size=[f"{i + 1}K" for i in range(10)]))
+        inventory_file = os.path.join(inv_dir.name, "local.feather")
+        pyarrow.feather.write_feather(inv, inventory_file)
+
+        assert mrms_download.download(inventory_file, dest.name, max_download=6, concurrency=3) == 6
+        # the workers' keep-alive connections don't outlive the download
+        assert not mrms_download._pools
+        day_dir = os.path.join(dest.name, "2021", "08", "21")
+        assert sorted(os.listdir(day_dir)) == [f"MultiSensor-{i:02d}.grib2.gz" for i in range(6)]
+
+        # files with the right size are skipped, so only the rest are fetched
+        assert mrms_download.download(inventory_file, dest.name, max_download=20, concurrency=3) == 4
+        assert mrms_download.download(inventory_file, dest.name, max_download=20, concurrency=3) == 0
+        for i in range(10):
+            with open(os.path.join(source.name, f"MultiSensor-{i:02d}.grib2.gz"), "rb") as expected:
+                with open(os.path.join(day_dir, f"MultiSensor-{i:02d}.grib2.gz"), "rb") as actual:
+                    assert expected.read() == actual.read()
+
+        # a re-issued file has a new mtime but the same size
+        with open(os.path.join(source.name, "MultiSensor-03.grib2.gz"), "wb") as out:
+            out.write(os.urandom(4 * 1024))
+        inv.loc[3, "mtime"] = "2021-08-21 04:00"
+        pyarrow.feather.write_feather(inv, inventory_file)
+        assert mrms_download.download(inventory_file, dest.name, max_download=20, concurrency=3) == 1
+        with open(os.path.join(source.name, "MultiSensor-03.grib2.gz"), "rb") as expected:
+            with open(os.path.join(day_dir, "MultiSensor-03.grib2.gz"), "rb") as actual:
+                assert expected.read() == actual.read()
+    finally:
+        server.shutdown()
+
+
+class RedirectingHandler(QuietHandler):
+    """Serves files, and redirects /old/<name> to /<name>"""
+
+    def do_GET(self):
+        if self.path.startswith("/old/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/old"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+def test_fetch():
+    source = tempfile.TemporaryDirectory()
+    dest = tempfile.TemporaryDirectory()
+    content = os.urandom(5000)
+    with open(os.path.join(source.name, "MultiSensor-00.grib2.gz"), "wb") as out:
+        out.write(content)
+    server = serve(source.name, RedirectingHandler)
+    try:
+        base = f"http://127.0.0.1:{server.server_port}"
+        for path in ["MultiSensor-00.grib2.gz", "old/MultiSensor-00.grib2.gz"]:
+            fname = os.path.join(dest.name, os.path.basename(path) + "-" + str(len(path)))
+            mrms_download.fetch(f"{base}/{path}", fname)
+            with open(fname, "rb") as input:
+                assert input.read() == content
+            # readable by others as if written with open()
+            assert os.stat(fname).st_mode & 0o777 == 0o666 & ~mrms_download.UMASK
+    finally:
+        mrms_download.close_connections()
+        server.shutdown()
+
+
+class SlowHandler(QuietHandler):
+    """Serves files, but takes a second to answer /slow/<name>"""
+
+    def do_GET(self):
+        if self.path.startswith("/slow/"):
+            time.sleep(1)
+            self.path = self.path[len("/slow"):]
+        super().do_GET()
+
+
+def test_fetch_timeout(monkeypatch):
+    source = tempfile.TemporaryDirectory()
+    dest = tempfile.TemporaryDirectory()
+    with open(os.path.join(source.name, "MultiSensor-00.grib2.gz"), "wb") as out:
+        out.write(os.urandom(5000))
+    monkeypatch.setattr(mrms_download, "TIMEOUT", 0.2)
+    server = serve(source.name, SlowHandler)
+    try:
+        base = f"http://127.0.0.1:{server.server_port}"
+        # a timeout is an OSError but not a ConnectionError. The connection
+        # is dropped rather than left waiting on the unread response
+        with pytest.raises(OSError):
+            mrms_download.fetch(f"{base}/slow/MultiSensor-00.grib2.gz", os.path.join(dest.name, "slow"))
+        assert ("http", f"127.0.0.1:{server.server_port}") not in mrms_download._connections.pool
+        assert os.listdir(dest.name) == []
+        mrms_download.fetch(f"{base}/MultiSensor-00.grib2.gz", os.path.join(dest.name, "fast"))
+        assert os.listdir(dest.name) == ["fast"]
+    finally:
+        mrms_download.close_connections()
+        server.shutdown()
@@ -0,0 +1,29 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+import mrms_grid
+import mrms_h3
+
+
+def test_grid_cache():
+    lats, lons = np.meshgrid(np.linspace(40.0, 43.0, 30), np.linspace(-96.0, -91.0, 40), indexing="ij")
+    cache = tempfile.mkdtemp()
+    grid = mrms_grid.GridGeometry(lats, lons, cache)
+    fine = mrms_h3.cells(lats.reshape(-1), lons.reshape(-1), 15)
+    assert np.array_equal(grid.cells(), fine)
+    assert np.array_equal(grid.cells(3), mrms_h3.parents(fine, 3))
+    with pytest.raises(ValueError):
+        grid.cells(16)
+
+    # a second run finds everything in the cache
+    again = mrms_grid.GridGeometry(lats, lons, cache)
+    assert again.dir == grid.dir
+    assert isinstance(again.cells(3), np.memmap)
+    assert np.array_equal(again.cells(3), grid.cells(3))
+    assert sorted(os.listdir(grid.dir)) == ["cells-15.npy", "cells-3.npy", "grid.json"]
+
+    # a shifted grid of the same shape gets its own entry
+    other = mrms_grid.GridGeometry(lats + 0.5, lons, cache)
+    assert other.dir != grid.dir
+    assert np.array_equal(other.cells(), mrms_h3.cells(lats.reshape(-1) + 0.5, lons.reshape(-1), 15))
@@ -0,0 +1,26 @@
+import numpy as np
+import h3
+import mrms_h3
+
+
+def test_parents():
+    lats = np.linspace(25.0, 49.0, 200)
+    lons = np.linspace(-125.0, -67.0, 200)
+    cells = mrms_h3.cells(lats, lons, 15)
+    assert cells.dtype == np.int64
+    assert np.all(mrms_h3.resolution(cells) == 15)
+    for res in [3, 5, 8, 12, 15]:
+        expected = [h3.str_to_int(h3.cell_to_parent(h3.int_to_str(int(c)), res)) for c in cells]
+        assert list(mrms_h3.parents(cells, res)) == expected
+        assert np.all(mrms_h3.resolution(mrms_h3.parents(cells, res)) == res)
+
+
+def test_child_range():
+    cells = mrms_h3.cells([41.6, -33.9], [-93.6, 151.2], 15)
+    for res in [3, 6, 10, 15]:
+        coarse = mrms_h3.parents(cells, res)
+        lo, hi = mrms_h3.child_range(coarse)
+        assert np.all(lo <= cells) and np.all(cells <= hi)
+        assert list(mrms_h3.parents(lo, res)) == list(coarse)
+        assert list(mrms_h3.parents(hi, res)) == list(coarse)
+        assert all(h3.is_valid_cell(h3.int_to_str(int(c))) for c in np.r_[lo, hi])
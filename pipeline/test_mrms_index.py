@@ -0,0 +1,44 @@
+import os
+import tempfile
+import numpy as np
+import mrms_h3
+import mrms_index
+import mrms_query
+from test_mrms_query import DAY, tile_tree
+
+
+def brute_force(index, latitude, longitude):
+    d = index.distances(np.arange(len(index)), latitude, longitude)
+    return index.h3[np.argmin(d)]
+
+
+def test_index():
+    for sparse in [False, True]:
+        root, data = tile_tree(hours=2, n=30, merge=False, sparse=sparse)
+        fname = os.path.join(root, "index.arrow")
+        # the synthetic grid is about 10 km apart so it needs coarser keys
+        n = mrms_index.build_index([os.path.join(root, "hourly/data/2021/08/21/00")], fname, level=4)
+        assert n == len(np.unique(data["h3"]))
+
+        index = mrms_index.GridIndex(fname)
+        assert index.h3.tolist() == sorted(index.h3.tolist(), key=lambda x: mrms_h3.parents([x], 4)[0])
+        rand = np.random.default_rng(3)
+        for lat, lon in zip(rand.uniform(40.2, 42.8, 50), rand.uniform(-95.8, -91.2, 50)):
+            nearest = index.nearest(lat, lon)
+            assert len(nearest) == 1
+            assert nearest[0] == brute_force(index, lat, lon)
+        assert len(index.nearest(41, -93, k=4)) >= 4
+        # far away from the grid there is nothing to find
+        assert len(index.nearest(10.0, 20.0)) == 0
+
+
+def test_query_with_index():
+    root, data = tile_tree(hours=2, n=30)
+    fname = os.path.join(tempfile.mkdtemp(), "index.arrow")
+    mrms_index.build_index([os.path.join(root, "hourly/data/2021/08/21/00")], fname, level=4)
+    store = mrms_query.TileStore(root, index=mrms_index.GridIndex(fname))
+    # slightly off a grid point still finds that grid point
+    i = 100
+    df = store.history(data["latitude"][i] + 0.001, data["longitude"][i] - 0.001, store.dirs(DAY, DAY))
+    assert set(df["h3"]) == {data["h3"][i]}
+    assert len(df) == 2
@@ -2,6 +2,10 @@ import mrms_inventory
 import datetime
 import re
 import os.path
+import os
+import tempfile
+import threading
+import http.server
 import pytz
 
 
@@ -63,3 +67,114 @@ def verify_day(expected, inv, has_mtime=True):
             actual = tz.localize(datetime.datetime.strptime(d, "%Y-%m-%d %H:%M")).astimezone(pytz.utc)
             delta = actual - pytz.utc.localize(expected)
             assert delta <= datetime.timedelta(hours=25)
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """Mimics the mtarchive listing pages. Each existing directory lists 24
+    hourly files. Before August 2021 only GaugeCorr directories exist, after
+    that only Pass 2 directories. Every request is counted in `requests` and
+    paths in `flaky` fail once with a 503 before working.
+    """
+    requests = []
+    flaky = set()
+
+    def do_GET(self):
+        ArchiveHandler.requests.append(self.path)
+        if self.path in ArchiveHandler.flaky:
+            ArchiveHandler.flaky.remove(self.path)
+            self.send_error(503)
+            return
+        m = re.match(r"^/(\d{4})/(\d{2})/(\d{2})/mrms/ncep/(MultiSensor_QPE_01H_Pass2|GaugeCorr_QPE_01H)$", self.path)
+        if not m or (m.group(4) == "GaugeCorr_QPE_01H") != (m.group(1, 2) < ("2021", "08")):
+            self.send_error(404)
+            return
+        day = "".join(m.group(1, 2, 3))
+        rows = [f'<tr><td><a href="{m.group(4)}_00.00_{day}-{h:02d}0000.grib2.gz">'
+                f'{m.group(4)}_00.00_{day}-{h:02d}0000.grib2.gz</a></td>'
+                f'<td align="right">{m.group(1)}-{m.group(2)}-{m.group(3)} {h:02d}:05  </td>'
+                f'<td align="right">{300 + h}K</td></tr>' for h in range(24)]
+        body = ("<html><body><table>" + "\n".join(rows) + "</table></body></html>").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_archive():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/{{year:4d}}/{{month:02d}}/{{day:02d}}/mrms/ncep/{{dir:s}}"
+    return server, url
+
+
+def test_catalog():
+    server, url = serve_archive()
+    catalog = os.path.join(tempfile.mkdtemp(), "catalog.feather")
+    try:
+        ArchiveHandler.requests = []
+        first = mrms_inventory.inventory(-2, datetime.date(2021, 8, 21), url=url, catalog=catalog)
+        assert first.shape == (3 * 24, 4)
+        assert len(ArchiveHandler.requests) == 3
+
+        # sealed days come from the catalog without touching the archive
+        ArchiveHandler.requests = []
+        second = mrms_inventory.inventory(-2, datetime.date(2021, 8, 21), url=url, catalog=catalog)
+        assert len(ArchiveHandler.requests) == 0
+        assert list(second["url"]) == list(first["url"])
+        assert list(second["date"]) == list(first["date"])
+        assert list(second["size"]) == list(first["size"])
+
+        # today is still open so it is crawled every time, older days are not
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        mrms_inventory.inventory(-3, today, url=url, catalog=catalog)
+        ArchiveHandler.requests = []
+        inv = mrms_inventory.inventory(-3, today, url=url, catalog=catalog)
+        assert inv.shape == (4 * 24, 4)
+        assert today.strftime("/%Y/%m/%d/") in " ".join(ArchiveHandler.requests)
+        # yesterday may still be inside the Pass 2 latency
+        assert len(ArchiveHandler.requests) <= 2
+    finally:
+        server.shutdown()
+
+
+def test_parallel():
+    server, url = serve_archive()
+    try:
+        ArchiveHandler.requests = []
+        serial = mrms_inventory.inventory(datetime.date(2021, 7, 20), datetime.date(2021, 8, 10), url=url)
+        assert serial.shape == (22 * 24, 4)
+        # July days miss on Pass 2 first
+        assert len(ArchiveHandler.requests) == 12 * 2 + 10
+
+        ArchiveHandler.requests = []
+        ArchiveHandler.flaky = {"/2021/07/25/mrms/ncep/GaugeCorr_QPE_01H", "/2021/08/05/mrms/ncep/MultiSensor_QPE_01H_Pass2"}
+        parallel = mrms_inventory.inventory(datetime.date(2021, 7, 20), datetime.date(2021, 8, 10), url=url,
+                                            workers=8, per_host=3, backoff=0.01)
+        assert not ArchiveHandler.flaky
+        # sealed days only ask for GaugeCorr where Pass 2 is missing, plus two retries
+        assert len(ArchiveHandler.requests) == 12 * 2 + 10 + 2
+        assert list(parallel["url"]) == list(serial["url"])
+        assert list(parallel["date"]) == list(serial["date"])
+        assert list(parallel["mtime"]) == list(serial["mtime"])
+        assert "GaugeCorr" in parallel["url"][0] and "Pass2" in parallel["url"][parallel.shape[0] - 1]
+    finally:
+        server.shutdown()
+
+
+def test_future_days():
+    server, url = serve_archive()
+    try:
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        tomorrow = today + datetime.timedelta(days=1)
+        for workers in [1, 4]:
+            ArchiveHandler.requests = []
+            inv = mrms_inventory.inventory(-3, today + datetime.timedelta(days=2), url=url, workers=workers)
+            assert sorted(set(inv["date"])) == [today - datetime.timedelta(days=1), today]
+            assert tomorrow.strftime("/%Y/%m/%d/") not in " ".join(ArchiveHandler.requests)
+            # today isn't sealed, so GaugeCorr is asked for along with Pass 2 when in parallel
+            assert len(ArchiveHandler.requests) <= (2 if workers == 1 else 4)
+    finally:
+        server.shutdown()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import numpy as np
+import mrms_manifest
+import mrms_merge
+import mrms_split
+import mrms_tiles
+from test_mrms_split import synthetic_hours
+from test_mrms_merge import split_hours
+
+
+def test_manifest():
+    fname = os.path.join(tempfile.mkdtemp(), mrms_manifest.MANIFEST)
+    assert not mrms_manifest.Manifest.load(fname).exists()
+
+    version = mrms_manifest.stage_version("merge", 1, compact=True, quantum=None)
+    assert version == "merge-1(compact=True)"
+    m = mrms_manifest.Manifest(version, {"a": "1"})
+    m.record("x-3-1", "abc", {"00/x-3-1": "1", "01/x-3-1": "2"})
+    m.save(fname)
+
+    m = mrms_manifest.Manifest.load(fname)
+    assert m.current(version, {"a": "1"})
+    assert not m.current("merge-2", {"a": "1"})
+    assert not m.current(version, {"a": "2"})
+    assert m.artifact_current("x-3-1", version, {"00/x-3-1": "1", "01/x-3-1": "2"})
+    assert not m.artifact_current("x-3-1", version, {"00/x-3-1": "1", "01/x-3-1": "3"})
+    assert not m.artifact_current("x-3-2", version, {})
+    assert m.hashes() == {"x-3-1": "abc"}
+
+
+def test_incremental_merge():
+    data = synthetic_hours(hours=3, n=40)
+    root = tempfile.mkdtemp()
+    dirs = split_hours(root, data)
+    output = os.path.join(root, "daily")
+    tiles = len(mrms_tiles.list_tiles(dirs[0]))
+    assert mrms_merge.merge_data(output, dirs, workers=1) == tiles
+    assert mrms_merge.merge_data(output, dirs, workers=1) == 0
+
+    # re-issue the last hour with a change that only touches one tile
+    hour = {k: v[data["t"] == data["t"].max()] for k, v in data.items()}
+    one = hour["tile"] == hour["tile"][0]
+    hour["precipitation"][one] += 1
+    mrms_split.split_data(hour, dirs[-1], dirs[-1] + "-hash", 3)
+    before = mrms_tiles.read_tile(os.path.join(output, mrms_tiles.tile_name(3, hour["tile"][1 + np.argmin(one[1:])])))
+    assert mrms_merge.merge_data(output, dirs, workers=1) == 1
+
+    changed = mrms_tiles.read_tile(os.path.join(output, mrms_tiles.tile_name(3, hour["tile"][0])))
+    assert changed["precipitation"].to_numpy().sum() > 0
+    after = mrms_tiles.read_tile(os.path.join(output, mrms_tiles.tile_name(3, hour["tile"][1 + np.argmin(one[1:])])))
+    assert after.equals(before)
+
+    # changing the options redoes everything
+    assert mrms_merge.merge_data(output, dirs, workers=1, compact=True) == tiles
@@ -0,0 +1,119 @@
+import datetime
+import os
+import tempfile
+import numpy as np
+import pandas
+import pyarrow.parquet as pq
+import mrms_merge
+import mrms_split
+import mrms_tiles
+from test_mrms_split import synthetic_hours
+
+
+def split_hours(root, data, **options):
+    """Splits each hour of `data` into its own directory under `root`"""
+    dirs = []
+    for k, t in enumerate(np.unique(data["t"])):
+        hour = {name: v[data["t"] == t] for name, v in data.items()}
+        d = os.path.join(root, f"{k:02d}")
+        mrms_split.split_data(hour, d, d + "-hash", 3, **options)
+        dirs.append(d)
+    return dirs
+
+
+def expected_tiles(data):
+    df = pandas.DataFrame({k: data[k] for k in ["tile", "h3", "t", "precipitation"]})
+    df = df.sort_values(["h3", "t"], ignore_index=True)
+    return {f"x-3-{tile}": g.drop(columns="tile").reset_index(drop=True) for tile, g in df.groupby("tile")}
+
+
+def test_merge():
+    data = synthetic_hours(hours=6, n=40)
+    root = tempfile.mkdtemp()
+    dirs = split_hours(root, data)
+    output = os.path.join(root, "daily")
+    n = mrms_merge.merge_data(output, dirs, hash_dir=os.path.join(root, "daily-hash"), workers=2, batch_size=50)
+
+    expected = expected_tiles(data)
+    assert n == len(expected)
+    assert mrms_tiles.list_tiles(output) == sorted(expected)
+    assert mrms_tiles.list_tiles(os.path.join(root, "daily-hash")) == sorted(expected)
+    assert not os.path.exists(output + ".partial")
+    for f, df in expected.items():
+        merged = mrms_tiles.read_tile(os.path.join(output, f)).to_pandas()
+        pandas.testing.assert_frame_equal(merged, df, check_dtype=False)
+
+
+def test_merge_replaces_duplicates():
+    data = synthetic_hours(hours=3, n=20)
+    root = tempfile.mkdtemp()
+    dirs = split_hours(root, data)
+    # a re-issued copy of the second hour sorts last and wins
+    reissued = {name: v[data["t"] == np.unique(data["t"])[1]] for name, v in data.items()}
+    reissued["precipitation"] = reissued["precipitation"] + 100
+    mrms_split.split_data(reissued, os.path.join(root, "99"), os.path.join(root, "99-hash"), 3)
+    dirs.append(os.path.join(root, "99"))
+
+    data["precipitation"][data["t"] == np.unique(data["t"])[1]] += 100
+    output = os.path.join(root, "daily")
+    mrms_merge.merge_data(output, dirs, workers=1, batch_size=7)
+    for f, df in expected_tiles(data).items():
+        merged = mrms_tiles.read_tile(os.path.join(output, f)).to_pandas()
+        pandas.testing.assert_frame_equal(merged, df, check_dtype=False)
+        # row groups don't follow the batches of the merge
+        assert pq.ParquetFile(os.path.join(output, f)).num_row_groups == 1
+
+
+def test_writer_row_groups():
+    fname = os.path.join(tempfile.mkdtemp(), "x-3-1")
+    with mrms_tiles.TileWriter(fname, row_group_size=10) as out:
+        for k in range(0, 25, 3):
+            out.write(np.arange(k, min(k + 3, 25)), np.zeros(min(3, 25 - k)), np.ones(min(3, 25 - k)))
+    md = pq.ParquetFile(fname).metadata
+    assert [md.row_group(i).num_rows for i in range(md.num_row_groups)] == [10, 10, 5]
+    assert mrms_tiles.read_tile(fname)["h3"].to_pylist() == list(range(25))
+
+
+def test_merge_sparse_dry():
+    root = tempfile.mkdtemp()
+    old, new, output = [os.path.join(root, name) for name in ["old", "new", "merged"]]
+    # the new copy covers (1, 200) but has no row for it, so it is dry now
+    mrms_tiles.write_tile(old, [1, 1, 2], [100, 200, 200], [3.0, 5.0, 4.0], sparse=True)
+    mrms_tiles.write_tile(new, [1, 3], [100, 200], [2.0, 6.0], sparse=True, points=[1, 3], times=[100, 200])
+    for compact in [False, True]:
+        mrms_merge.merge_tile(output, [old, new], batch_size=1, compact=compact)
+        df = mrms_tiles.read_dense(output).to_pandas()
+        assert list(zip(df["h3"], df["t"], df["precipitation"])) == [
+            (1, 100, 2.0), (1, 200, 0.0), (2, 100, 0.0), (2, 200, 4.0), (3, 100, 0.0), (3, 200, 6.0)]
+
+
+def test_merge_sparse_compact():
+    data = synthetic_hours(hours=5, n=30)
+    data["precipitation"] = np.round(data["precipitation"], 1)
+    data["precipitation"][data["precipitation"] < 1.5] = 0
+    root = tempfile.mkdtemp()
+    dirs = split_hours(root, data, sparse=True, compact=True, quantum=0.1)
+    output = os.path.join(root, "daily")
+    mrms_merge.merge_data(output, dirs, workers=2, batch_size=20, compact=True, quantum=0.1)
+
+    for f, df in expected_tiles(data).items():
+        points, times = mrms_tiles.read_manifest(os.path.join(output, f))
+        assert len(times) == 5 and len(points) == df["h3"].nunique()
+        merged = mrms_tiles.read_dense(os.path.join(output, f)).to_pandas()
+        assert (merged["h3"] == df["h3"]).all() and (merged["t"] == df["t"]).all()
+        assert np.allclose(merged["precipitation"], df["precipitation"], atol=0.05)
+
+
+def test_merge_days():
+    data = synthetic_hours(hours=2, n=10)
+    dest = tempfile.mkdtemp()
+    split_hours(os.path.join(dest, "hourly/data/2021/08/21"), data)
+    day = datetime.date(2021, 8, 21)
+    mrms_merge.merge_days(dest, day, day, workers=1)
+    daily = os.path.join(dest, "daily/data/2021/08/21")
+    assert mrms_tiles.list_tiles(daily) == sorted(expected_tiles(data))
+
+    # nothing new, so nothing is rewritten
+    before = os.path.getmtime(daily)
+    mrms_merge.merge_days(dest, day, day, workers=1)
+    assert os.path.getmtime(daily) == before
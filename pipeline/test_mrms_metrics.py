@@ -0,0 +1,82 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import mrms_bench
+import mrms_metrics
+import mrms_split
+
+
+def test_spans():
+    with mrms_metrics.span("stage", day="2021/08/21") as outer:
+        mrms_metrics.add(files=2)
+        with mrms_metrics.span("part") as inner:
+            mrms_metrics.add(rows=10)
+            inner.add(rows=5)
+            sum(range(100000))
+        outer.add(files=1, bytes=100)
+    mrms_metrics.add(ignored=1)
+    part, stage = mrms_metrics.finished()[-2:]
+    assert stage["stage"] == "stage" and stage["day"] == "2021/08/21"
+    assert stage["files"] == 3 and stage["bytes"] == 100 and "rows" not in stage
+    assert part["stage"] == "stage/part" and part["rows"] == 15
+    assert stage["seconds"] >= part["seconds"] > 0
+    assert stage["cpu_seconds"] >= 0 and stage["peak_rss"] > 1 << 20
+
+    text = mrms_metrics.prometheus([stage, part, stage])
+    assert 'mrms_stage_files_total{stage="stage"} 6' in text
+    assert 'mrms_stage_runs_total{stage="stage/part"} 1' in text
+    assert "# TYPE mrms_stage_peak_rss_bytes gauge" in text
+
+
+def test_outputs():
+    d = tempfile.mkdtemp()
+    try:
+        jsonl, prom, profile = [os.path.join(d, f) for f in ["m.jsonl", "m.prom", "p.folded"]]
+        with mrms_metrics.run("busy", jsonl, profile):
+            with mrms_metrics.span("loop"):
+                t0 = time.process_time()
+                while time.process_time() - t0 < 0.2:
+                    sum(range(1000))
+        records = [json.loads(line) for line in open(jsonl)]
+        assert [r["stage"] for r in records] == ["busy/loop", "busy"]
+        with open(profile) as input:
+            stacks = [line.rsplit(" ", 1) for line in input]
+        assert sum(int(n) for _, n in stacks) > 5
+        assert any("test_outputs" in s for s, _ in stacks)
+
+        with mrms_metrics.run("other", prom):
+            mrms_metrics.add(tiles=3)
+        with open(prom) as input:
+            assert 'mrms_stage_tiles_total{stage="other"} 3' in input.read()
+    finally:
+        mrms_metrics.configure(None)
+
+
+def test_split_metrics():
+    source, dest = tempfile.mkdtemp(), tempfile.mkdtemp()
+    day = datetime.date(2021, 8, 21)
+    folder = os.path.join(source, "2021/08/21")
+    os.makedirs(folder)
+    rng = np.random.default_rng(3)
+    for h in range(2):
+        t = datetime.datetime(2021, 8, 21, h, tzinfo=datetime.timezone.utc)
+        mrms_bench.write_grib(os.path.join(folder, mrms_bench.file_name(t)), mrms_bench.synthetic_field((20, 30), 0.5, rng),
+                              mrms_bench.grid((20, 30)), t)
+    jsonl = os.path.join(dest, "metrics.jsonl")
+    try:
+        with mrms_metrics.run("split", jsonl):
+            mrms_split.process_days(source, os.path.join(dest, "tiles"), day, day, 3, workers=1)
+    finally:
+        mrms_metrics.configure(None)
+    records = [json.loads(line) for line in open(jsonl)]
+    hours = [r for r in records if r["stage"] == "split/hour"]
+    # the hours are split by worker processes, which write their own spans
+    assert len(hours) == 2 and all(r["rows"] == 600 and r["tiles"] >= 1 for r in hours)
+    split = records[-1]
+    assert split["stage"] == "split" and split["files"] == 2
+    assert split["tiles"] == sum(r["tiles"] for r in hours)
@@ -0,0 +1,252 @@
+import datetime
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import numpy as np
+import pyarrow as pa
+import pytest
+import mrms_merge
+import mrms_query
+import mrms_split
+from test_mrms_split import synthetic_hours
+
+DAY = datetime.date(2021, 8, 21)
+
+
+def tile_tree(hours=4, n=30, merge=True, **options):
+    """Splits synthetic hours into a tile tree and optionally merges them"""
+    data = synthetic_hours(hours=hours, n=n)
+    root = tempfile.mkdtemp()
+    for k, t in enumerate(np.unique(data["t"])):
+        hour = {name: v[data["t"] == t] for name, v in data.items()}
+        d = os.path.join(root, "hourly/data/2021/08/21", f"{k:02d}")
+        mrms_split.split_data(hour, d, os.path.join(root, "hourly/hash/2021/08/21", f"{k:02d}"), 3, **options)
+    if merge:
+        # merged tiles are sparse whenever their inputs are
+        options.pop("sparse", None)
+        mrms_merge.merge_days(root, DAY, DAY, workers=1, **options)
+    return root, data
+
+
+def expected(data, refs, start=None, end=None):
+    keep = np.isin(data["h3"], refs)
+    if start is not None:
+        keep &= data["t"] >= start
+    if end is not None:
+        keep &= data["t"] <= end
+    order = np.lexsort((data["t"][keep], data["h3"][keep]))
+    return data["h3"][keep][order], data["t"][keep][order], data["precipitation"][keep][order]
+
+
+def check(df, data, refs, start=None, end=None):
+    h3, t, precipitation = expected(data, refs, start, end)
+    assert df["h3"].tolist() == h3.tolist()
+    assert df["t"].tolist() == t.tolist()
+    assert np.allclose(df["precipitation"], precipitation)
+
+
+def test_query():
+    for merge in [True, False]:
+        root, data = tile_tree(merge=merge)
+        store = mrms_query.TileStore(root)
+        dirs = store.dirs(DAY, DAY)
+        assert len(dirs) == (1 if merge else 4)
+
+        refs = np.unique(data["h3"])[[3, 200, 201, 850]]
+        check(store.query(refs, dirs), data, refs)
+        times = np.unique(data["t"])
+        check(store.query(refs, dirs, times[1], times[2]), data, refs, times[1], times[2])
+
+        df = store.history(data["latitude"][0], data["longitude"][0], dirs)
+        check(df, data, [data["h3"][0]])
+        assert (df["time"].dt.date == DAY).all()
+
+        # handles are kept open between queries
+        assert len(store.tiles) > 0
+        tile = next(iter(store.tiles.values()))
+        store.query(refs, dirs)
+        assert tile in store.tiles.values()
+
+
+def test_row_group_pruning():
+    root, data = tile_tree(hours=2, n=40, compact=True)
+    store = mrms_query.TileStore(root)
+    dirs = store.dirs(DAY, DAY)
+    refs = np.unique(data["h3"])[[10]]
+    fname = os.path.join(dirs[0], "x-3-" + str(mrms_query.mrms_h3.parents(refs, 3)[0]))
+    # rewrite with tiny row groups so that pruning matters
+    table = mrms_query.mrms_tiles.read_tile(fname)
+    mrms_query.mrms_tiles.write_tile(fname, table["h3"].to_numpy(), table["t"].to_numpy(),
+                                     table["precipitation"].to_numpy(), compact=True, row_group_size=4)
+    tile = store.open(fname)
+    assert len(tile.h3_min) > 10
+    assert len(tile.row_groups(refs)) == 1
+    check(store.query(refs, dirs), data, refs)
+
+
+def test_sparse_query():
+    root, data = tile_tree(hours=3, sparse=True, compact=True)
+    store = mrms_query.TileStore(root)
+    refs = np.unique(data["h3"])[[5, 6, 400]]
+    check(store.query(refs, store.dirs(DAY, DAY)), data, refs)
+
+
+def test_http():
+    root, data = tile_tree(hours=2)
+    store = mrms_query.TileStore(root)
+    server = mrms_query.serve(store, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        refs = np.unique(data["h3"])[[7, 8]]
+        url = f"http://127.0.0.1:{server.server_port}/history?h3={refs[0]},{refs[1]}&start=2021-08-21&end=2021-08-21"
+        with urlopen(url) as response:
+            result = json.load(response)
+        h3, t, precipitation = expected(data, refs)
+        assert result["h3"] == h3.tolist()
+        assert result["t"] == t.tolist()
+        assert np.allclose(result["precipitation"], precipitation)
+
+        # a read that fails is a 500, and the server carries on
+        read = store.read
+
+        def fail(*args, **kwargs):
+            raise OSError("unreadable tile")
+        store.read = fail
+        with pytest.raises(HTTPError) as error:
+            urlopen(url)
+        assert error.value.code == 500 and "error" in json.load(error.value)
+        store.read = read
+        with urlopen(url) as response:
+            assert json.load(response)["h3"] == h3.tolist()
+    finally:
+        server.shutdown()
+
+
+def test_batch():
+    for merge in [True, False]:
+        root, data = tile_tree(hours=4, merge=merge, sparse=not merge)
+        store = mrms_query.TileStore(root)
+        points = np.unique(data["h3"])
+        rand = np.random.default_rng(5)
+        refs = rand.choice(points, 300)
+        times = np.unique(data["t"])
+        starts = rand.choice(times[:2], len(refs))
+        ends = rand.choice(times[1:], len(refs))
+        refs[7] = -1
+        batches = list(store.batch(refs, starts, ends, workers=4))
+        # one batch per tile
+        assert len(batches) == len(np.unique(mrms_query.mrms_h3.parents(refs[refs >= 0], 3)))
+        df = pa.Table.from_batches(batches, mrms_query.BATCH_SCHEMA).to_pandas()
+        assert 7 not in df["request"].values
+        for i in [0, 1, 100, 299]:
+            got = df[df["request"] == i]
+            check(got, data, [refs[i]], starts[i], ends[i])
+
+
+def test_http_batch():
+    root, data = tile_tree(hours=2)
+    store = mrms_query.TileStore(root)
+    server = mrms_query.serve(store, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        refs = np.unique(data["h3"])[[7, 8]]
+        body = dict(points=[dict(h3=int(refs[0])), dict(h3=int(refs[1]), start="2021-08-21T01:00"),
+                            dict(lat=float(data["latitude"][0]), lon=float(data["longitude"][0]))])
+        url = f"http://127.0.0.1:{server.server_port}/batch?start=2021-08-21&end=2021-08-21"
+        with urlopen(Request(url, data=json.dumps(body).encode(), method="POST")) as response:
+            assert response.headers["Content-Type"] == "application/vnd.apache.arrow.stream"
+            df = pa.ipc.open_stream(response.read()).read_all().to_pandas()
+        times = np.unique(data["t"])
+        check(df[df["request"] == 0], data, [refs[0]])
+        check(df[df["request"] == 1], data, [refs[1]], times[1])
+        check(df[df["request"] == 2], data, [data["h3"][0]])
+
+        # a bad point is refused before anything is streamed
+        body = dict(points=[dict(h3=int(refs[0])), dict(h3=12345)])
+        with pytest.raises(HTTPError) as error:
+            urlopen(Request(url, data=json.dumps(body).encode(), method="POST"))
+        assert error.value.code == 400 and "error" in json.load(error.value)
+
+        # and a failure while streaming resets the connection
+        read_batch = store.read_batch
+        tiles = np.unique(mrms_query.mrms_h3.parents(data["h3"], 3))
+
+        def fail(tile, *args):
+            if tile == tiles[0]:
+                return read_batch(tile, *args)
+            time.sleep(0.2)
+            raise ValueError("unreadable tile")
+        store.read_batch = fail
+        body = dict(points=[dict(h3=int(x)) for x in np.unique(data["h3"])])
+        with pytest.raises(ConnectionError):
+            with urlopen(Request(url, data=json.dumps(body).encode(), method="POST")) as response:
+                response.read()
+    finally:
+        server.shutdown()
+
+
+def test_open_files():
+    root, data = tile_tree(hours=2)
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    assert mrms_query.TileStore(root).max_open <= soft // 2 or soft == resource.RLIM_INFINITY
+    store = mrms_query.TileStore(root, max_open=2)
+    dirs = store.dirs(DAY, DAY)
+    refs = np.unique(data["h3"])
+    fds = len(os.listdir("/proc/self/fd"))
+    check(store.query(refs, dirs), data, refs)
+    assert len(store.tiles) == 2
+    # evicted files are closed straight away
+    assert len(os.listdir("/proc/self/fd")) <= fds + 2
+
+    # but not while they are being read
+    names = mrms_query.mrms_tiles.list_tiles(dirs[0])
+    tile = store.open(os.path.join(dirs[0], names[0]), acquire=True)
+    for name in names[1:3]:
+        store.open(os.path.join(dirs[0], name))
+    assert tile not in store.tiles.values()
+    wanted = refs[mrms_query.mrms_h3.parents(refs, 3) == int(names[0].split("-")[-1])]
+    check(tile.read(wanted).to_pandas(), data, wanted)
+    tile.release()
+    assert len(os.listdir("/proc/self/fd")) <= fds + 2
+
+
+def test_cache():
+    root, data = tile_tree(hours=2, n=40, compact=True)
+    store = mrms_query.TileStore(root)
+    dirs = store.dirs(DAY, DAY)
+    refs = np.unique(data["h3"])[[3, 200, 201, 850]]
+    check(store.query(refs, dirs), data, refs)
+    misses = store.cache.misses
+    assert misses > 0 and store.cache.hits == 0
+    check(store.query(refs, dirs), data, refs)
+    assert store.cache.misses == misses
+    assert store.cache.hits == misses
+
+    # a tile replaced on disk is read again and its old blocks dropped
+    fname = os.path.join(dirs[0], "x-3-" + str(mrms_query.mrms_h3.parents(refs[:1], 3)[0]))
+    table = mrms_query.mrms_tiles.read_tile(fname)
+    tmp = fname + ".new"
+    mrms_query.mrms_tiles.write_tile(tmp, table["h3"].to_numpy(), table["t"].to_numpy(),
+                                     table["precipitation"].to_numpy() + 1)
+    os.replace(tmp, fname)
+    blocks = store.cache.stats()["blocks"]
+    df = store.query(refs[:1], dirs)
+    _, _, precipitation = expected(data, refs[:1])
+    assert np.allclose(df["precipitation"], precipitation + 1)
+    assert store.cache.stats()["blocks"] <= blocks
+
+    # the budget is respected
+    small = mrms_query.TileStore(root, cache_bytes=20000)
+    for i in range(0, 1600, 50):
+        small.query(np.unique(data["h3"])[i:i + 1], dirs)
+    stats = small.cache.stats()
+    assert stats["bytes"] <= 20000 and stats["evictions"] > 0
+
+    uncached = mrms_query.TileStore(root, cache_bytes=0)
+    assert uncached.cache is None
+    check(uncached.query(refs[1:], dirs), data, refs[1:])
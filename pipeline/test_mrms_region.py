@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+import mrms_h3
+import mrms_index
+import mrms_query
+import mrms_region
+from test_mrms_query import DAY, tile_tree
+
+FIELD = dict(type="Polygon", coordinates=[[[-94.5, 41.0], [-93.9, 41.0], [-93.9, 41.4], [-94.3, 41.6], [-94.5, 41.0]]])
+FAR = dict(type="Polygon", coordinates=[[[20.0, 10.0], [20.1, 10.0], [20.1, 10.1], [20.0, 10.0]]])
+
+# the synthetic grid is about 10 km apart, so coarser cells do
+RES, SEARCH = 7, 4
+
+
+def expected(data, geometry):
+    """Weights each covering cell by brute force and averages the data"""
+    points, first = np.unique(data["h3"], return_index=True)
+    cells = mrms_h3.cover(geometry, RES)
+    lats, lons = mrms_h3.centers(cells)
+    nearest = mrms_region.nearest(lats, lons, data["latitude"][first].astype(np.float64),
+                                  data["longitude"][first].astype(np.float64))
+    weight = np.bincount(nearest, minlength=len(points)) / len(cells)
+    result = []
+    for t in np.unique(data["t"]):
+        at = data["t"] == t
+        w = weight[np.searchsorted(points, data["h3"][at])]
+        result.append(np.sum(w * data["precipitation"][at]) / np.sum(w))
+    return np.array(result)
+
+
+def test_region():
+    for sparse in [False, True]:
+        root, data = tile_tree(hours=3, n=30, sparse=sparse)
+        store = mrms_query.TileStore(root)
+        dirs = store.dirs(DAY, DAY)
+        df = mrms_region.query_regions(store, {"field": FIELD, "far": FAR}, dirs, res=RES, search_level=SEARCH)
+        field = df[df["region"] == "field"]
+        assert field["t"].tolist() == np.unique(data["t"]).tolist()
+        # grid points are the h3 cells of float32 coordinates, so allow for that
+        assert np.allclose(field["precipitation"], expected(data, FIELD), rtol=1e-3)
+        assert df[df["region"] == "far"]["precipitation"].isna().all()
+
+        # the index gives the same weights without reading whole cells
+        fname = os.path.join(root, "index.arrow")
+        mrms_index.build_index(dirs, fname, level=SEARCH)
+        indexed = mrms_query.TileStore(root, index=mrms_index.GridIndex(fname))
+        df2 = mrms_region.query_regions(indexed, {"field": FIELD}, dirs, res=RES)
+        assert np.allclose(df2["precipitation"], field["precipitation"])
+
+        times = np.unique(data["t"])
+        df3 = mrms_region.query_regions(store, {"field": FIELD}, dirs, times[1], times[1], res=RES, search_level=SEARCH)
+        assert df3["t"].tolist() == [times[1]]
+        assert np.allclose(df3["precipitation"], field["precipitation"].iloc[1])
+
+
+def test_query_ranges():
+    root, data = tile_tree(hours=2, n=30, merge=False, sparse=True)
+    store = mrms_query.TileStore(root)
+    dirs = store.dirs(DAY, DAY)
+    cells = np.unique(mrms_h3.parents(data["h3"], 5))[[2, 9]]
+    lo, hi = mrms_h3.child_range(cells)
+    df = store.query_ranges(lo, hi, dirs)
+    refs = np.unique(data["h3"][np.isin(mrms_h3.parents(data["h3"], 5), cells)])
+    assert len(refs) > 0
+    assert df["h3"].tolist() == store.query(refs, dirs)["h3"].tolist()
+
+
+def test_serve_region():
+    root, data = tile_tree(hours=2, n=30)
+    store = mrms_query.TileStore(root)
+    server = mrms_query.serve(store, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        body = dict(type="FeatureCollection", features=[dict(type="Feature", id="a", geometry=FIELD)])
+        url = f"http://127.0.0.1:{server.server_port}/region?start=2021-08-21&end=2021-08-21"
+        with urlopen(Request(url, data=json.dumps(body).encode(), method="POST")) as response:
+            result = json.load(response)
+        assert [r["region"] for r in result["regions"]] == ["a"]
+        assert result["regions"][0]["t"] == np.unique(data["t"]).tolist()
+    finally:
+        server.shutdown()
@@ -0,0 +1,108 @@
+import datetime
+import os
+
+import numpy as np
+import pandas
+import pyarrow.parquet as pq
+
+import mrms_merge
+import mrms_query
+import mrms_rollup
+import mrms_split
+from test_mrms_query import DAY, tile_tree
+
+
+def expected_totals(data, refs=None):
+    df = pandas.DataFrame(dict(h3=data["h3"], p=data["precipitation"].astype(np.float64)))
+    if refs is not None:
+        df = df[df["h3"].isin(refs)]
+    return df.groupby("h3").agg(precipitation=("p", "sum"), max=("p", "max"),
+                                wet_hours=("p", lambda p: int((p > 0).sum())), hours=("p", "count"))
+
+
+def read_rollup(d):
+    return pandas.concat([pq.read_table(os.path.join(d, f)).to_pandas() for f in sorted(os.listdir(d))
+                          if f.startswith("x-")]).set_index("h3").sort_index()
+
+
+def check(df, data, refs=None):
+    want = expected_totals(data, refs)
+    assert df.index.tolist() == want.index.tolist()
+    assert np.allclose(df["precipitation"], want["precipitation"], rtol=1e-5)
+    assert np.allclose(df["max"], want["max"])
+    assert df["wet_hours"].tolist() == want["wet_hours"].tolist()
+    assert df["hours"].tolist() == want["hours"].tolist()
+
+
+def test_rollup():
+    for sparse in [False, True]:
+        root, data = tile_tree(hours=4, n=30, sparse=sparse)
+        mrms_rollup.rollup_days(root, DAY, DAY, workers=1)
+        daily = read_rollup(mrms_rollup.rollup_dir(root, "daily", DAY))
+        check(daily, data)
+        assert (daily["t"] == mrms_rollup.millis(DAY)).all()
+        monthly = read_rollup(mrms_rollup.rollup_dir(root, "monthly", DAY))
+        check(monthly, data)
+        assert (monthly["t"] == mrms_rollup.millis(DAY.replace(day=1))).all()
+
+        # nothing changed, so nothing is rebuilt
+        assert mrms_rollup.rollup_day(root, DAY, workers=1) == 0
+        assert mrms_rollup.rollup_month(root, DAY.year, DAY.month, workers=1) == 0
+
+
+def test_totals():
+    root, data = tile_tree(hours=4, n=30)
+    store = mrms_query.TileStore(root)
+    refs = np.unique(data["h3"])[[3, 200, 201, 850]]
+    start, end = DAY, DAY + datetime.timedelta(days=1)
+    kinds = [p for p, *_ in store.plan(mrms_query.millis(start), mrms_query.millis(end))]
+    assert kinds == ["hourly"]
+    before = store.totals(refs, start, end).set_index("h3")
+    check(before, data, refs)
+
+    mrms_rollup.rollup_days(root, DAY, DAY, workers=1)
+    kinds = [p for p, *_ in store.plan(mrms_query.millis(start), mrms_query.millis(end))]
+    assert kinds == ["daily"]
+    check(store.totals(refs, start, end).set_index("h3"), data, refs)
+
+    # a whole month is read from the monthly rollup
+    first = DAY.replace(day=1)
+    plan = list(store.plan(mrms_query.millis(first), mrms_query.millis(datetime.date(2021, 9, 1))))
+    assert [p for p, *_ in plan] == ["monthly"]
+    check(store.totals(refs, first, datetime.date(2021, 9, 1)).set_index("h3"), data, refs)
+
+    # part of a day is read hour by hour
+    times = np.unique(data["t"])
+    df = store.totals(refs, times[1], times[3]).set_index("h3")
+    keep = (data["t"] >= times[1]) & (data["t"] < times[3])
+    check(df, {k: v[keep] for k, v in data.items()}, refs)
+
+
+def test_partial_month():
+    root, data = tile_tree(hours=4, n=30)
+    mrms_rollup.rollup_days(root, DAY, DAY, workers=1)
+    store = mrms_query.TileStore(root)
+    refs = np.unique(data["h3"])[[3, 200, 201, 850]]
+    first, end = DAY.replace(day=1), datetime.date(2021, 9, 1)
+    assert mrms_rollup.month_complete(root, DAY)
+
+    # the next day arrives after the monthly rollup was built
+    later = dict(data, t=data["t"] + 86400_000, precipitation=data["precipitation"] * 2)
+    both = {k: np.concatenate([data[k], later[k]]) for k in data}
+    for k, t in enumerate(np.unique(later["t"])):
+        hour = {name: v[later["t"] == t] for name, v in later.items()}
+        mrms_split.split_data(hour, os.path.join(root, "hourly/data/2021/08/22", f"{k:02d}"),
+                              os.path.join(root, "hourly/hash/2021/08/22", f"{k:02d}"), 3)
+    assert not mrms_rollup.month_complete(root, DAY)
+    plan = list(store.plan(mrms_query.millis(first), mrms_query.millis(end)))
+    assert "monthly" not in [p for p, *_ in plan]
+    assert [p for p, _, t0, _ in plan if t0 == mrms_query.millis(DAY)] == ["daily"]
+    check(store.totals(refs, first, end).set_index("h3"), both, refs)
+
+    # once it is merged and rolled up, the monthly rollup covers it again
+    next_day = DAY + datetime.timedelta(days=1)
+    mrms_merge.merge_days(root, next_day, next_day, workers=1)
+    mrms_rollup.rollup_days(root, next_day, next_day, workers=1)
+    assert mrms_rollup.month_complete(root, DAY)
+    assert [p for p, *_ in store.plan(mrms_query.millis(first), mrms_query.millis(end))] == ["monthly"]
+    check(store.totals(refs, first, end).set_index("h3"), both, refs)
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import datetime
+import numpy as np
+import pyarrow.parquet as pq
+import mrms_h3
+import mrms_manifest
+import mrms_split
+import mrms_tiles
+
+
+def synthetic_hours(hours=2, n=60, tile_level=3):
+    """Builds a small grid over Iowa with a few hours of made up data"""
+    lats, lons = np.meshgrid(np.linspace(40.0, 43.0, n, dtype=np.float32),
+                             np.linspace(-96.0, -91.0, n, dtype=np.float32), indexing="ij")
+    lats = lats.reshape(-1)
+    lons = lons.reshape(-1)
+    h3 = mrms_h3.cells(lats, lons, 15)
+    base = int(datetime.datetime(2021, 8, 21, tzinfo=datetime.timezone.utc).timestamp()) * 1000
+    rand = np.random.default_rng(1)
+    data = dict(longitude=np.tile(lons, hours), latitude=np.tile(lats, hours),
+                h3=np.tile(h3, hours), tile=np.tile(mrms_h3.parents(h3, tile_level), hours),
+                t=np.repeat(base + 3600_000 * np.arange(hours, dtype=np.int64), len(h3)),
+                precipitation=rand.exponential(1.0, hours * len(h3)).astype(np.float32))
+    # shuffle so that the splitter has to do the sorting
+    order = rand.permutation(len(data["h3"]))
+    return {k: v[order] for k, v in data.items()}
+
+
+def test_split():
+    data = synthetic_hours()
+    out = tempfile.mkdtemp()
+    hashes = mrms_split.split_data(data, os.path.join(out, "data"), os.path.join(out, "hash"), 3)
+    tiles = mrms_tiles.list_tiles(os.path.join(out, "data"))
+    assert sorted(hashes) == tiles
+    assert len(tiles) == len(np.unique(data["tile"]))
+    assert mrms_tiles.list_tiles(os.path.join(out, "hash")) == tiles
+
+    rows = 0
+    for f in tiles:
+        df = mrms_tiles.read_tile(os.path.join(out, "data", f)).to_pandas()
+        rows += df.shape[0]
+        assert set(f"x-3-{x}" for x in mrms_h3.parents(df["h3"], 3)) == {f}
+        assert df.equals(df.sort_values(["h3", "t"], ignore_index=True))
+        assert df["t"].nunique() == 2
+        with open(os.path.join(out, "data", f), "rb") as input:
+            with open(os.path.join(out, "hash", f)) as h:
+                assert h.read().strip() == hashlib.sha256(input.read()).hexdigest()
+    assert rows == len(data["h3"])
+
+
+def test_find_hours():
+    source = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    day = os.path.join(source, "2021", "08", "21")
+    os.makedirs(day)
+    for h in [0, 1, 3]:
+        open(os.path.join(day, f"MultiSensor_QPE_01H_Pass2_00.00_20210821-{h:02d}0000.grib2.gz"), "w").close()
+    os.makedirs(os.path.join(dest, "hourly/data/2021/08/21/01"))
+
+    hours = mrms_split.find_hours(source, dest, datetime.date(2021, 8, 20), datetime.date(2021, 8, 21))
+    assert [(d, h) for _, d, h, _ in hours] == [("2021/08/21", 0), ("2021/08/21", 3)]
+
+    # an hour split by another version of the splitter is split again
+    mrms_manifest.Manifest("split-0", {"MultiSensor_QPE_01H_Pass2_00.00_20210821-010000.grib2.gz": "x"}).save(
+        os.path.join(dest, "hourly/data/2021/08/21/01", mrms_manifest.MANIFEST))
+    hours = mrms_split.find_hours(source, dest, datetime.date(2021, 8, 21), datetime.date(2021, 8, 21),
+                                  mrms_split.split_version(3))
+    assert [(d, h) for _, d, h, _ in hours] == [("2021/08/21", 0), ("2021/08/21", 1), ("2021/08/21", 3)]
+
+
+def test_sparse_split():
+    data = synthetic_hours()
+    data["precipitation"][data["precipitation"] < 1.5] = 0
+    out = tempfile.mkdtemp()
+    mrms_split.split_data(data, os.path.join(out, "dense"), os.path.join(out, "hash"), 3)
+    mrms_split.split_data(data, os.path.join(out, "sparse"), os.path.join(out, "hash"), 3, sparse=True)
+
+    tiles = mrms_tiles.list_tiles(os.path.join(out, "dense"))
+    assert mrms_tiles.list_tiles(os.path.join(out, "sparse")) == tiles
+    stored = 0
+    for f in tiles:
+        dense = mrms_tiles.read_tile(os.path.join(out, "dense", f))
+        sparse = mrms_tiles.read_tile(os.path.join(out, "sparse", f))
+        stored += sparse.num_rows
+        assert mrms_tiles.read_manifest(os.path.join(out, "dense", f)) is None
+        points, times = mrms_tiles.read_manifest(os.path.join(out, "sparse", f))
+        assert list(points) == sorted(set(dense["h3"].to_pylist()))
+        assert len(times) == 2
+        assert mrms_tiles.read_dense(os.path.join(out, "sparse", f)).equals(dense)
+
+        some = points[::3]
+        expected = dense.filter(np.isin(dense["h3"].to_numpy(), some))
+        assert mrms_tiles.read_dense(os.path.join(out, "sparse", f), h3=some).equals(expected)
+    assert stored == np.count_nonzero(data["precipitation"])
+
+
+def test_compact_split():
+    data = synthetic_hours(hours=24)
+    data["precipitation"] = np.round(data["precipitation"], 1)
+    out = tempfile.mkdtemp()
+    mrms_split.split_data(data, os.path.join(out, "plain"), os.path.join(out, "hash"), 3)
+    mrms_split.split_data(data, os.path.join(out, "compact"), os.path.join(out, "hash"), 3,
+                          compact=True, quantum=0.1)
+
+    plain_size = compact_size = 0
+    for f in mrms_tiles.list_tiles(os.path.join(out, "plain")):
+        plain = mrms_tiles.read_tile(os.path.join(out, "plain", f))
+        compact = mrms_tiles.read_tile(os.path.join(out, "compact", f))
+        assert compact.schema == mrms_tiles.SCHEMA
+        assert compact["h3"].equals(plain["h3"]) and compact["t"].equals(plain["t"])
+        assert np.allclose(compact["precipitation"].to_numpy(), plain["precipitation"].to_numpy(), atol=0.05)
+        plain_size += os.path.getsize(os.path.join(out, "plain", f))
+        compact_size += os.path.getsize(os.path.join(out, "compact", f))
+
+        some = plain["h3"].to_numpy()[::500]
+        selected = mrms_tiles.read_tile(os.path.join(out, "compact", f), h3=some)
+        assert set(selected["h3"].to_pylist()) == set(some)
+        assert selected.num_rows == 24 * len(set(some))
+    assert compact_size < plain_size
+
+
+def test_row_group_statistics():
+    h3 = np.repeat(np.arange(1000, dtype=np.int64) + (1 << 60), 200)
+    t = np.tile(1629504000000 + 3600_000 * np.arange(200, dtype=np.int64), 1000)
+    fname = os.path.join(tempfile.mkdtemp(), "x-3-1")
+    mrms_tiles.write_tile(fname, h3, t, np.zeros(len(h3), np.float32), compact=True, row_group_size=20_000)
+
+    metadata = pq.ParquetFile(fname).metadata
+    assert metadata.num_row_groups == 10
+    bounds = [(metadata.row_group(i).column(0).statistics.min, metadata.row_group(i).column(0).statistics.max)
+              for i in range(metadata.num_row_groups)]
+    assert all(a[1] < b[0] for a, b in zip(bounds, bounds[1:]))
+
+
+def test_swap_dir():
+    root = tempfile.mkdtemp()
+    target = os.path.join(root, "05")
+    for content in ["old", "new"]:
+        staging = target + ".partial"
+        os.makedirs(staging)
+        with open(os.path.join(staging, "x-3-1"), "w") as out:
+            out.write(content)
+        mrms_tiles.swap_dir(staging, target)
+    assert os.listdir(root) == ["05"]
+    assert open(os.path.join(target, "x-3-1")).read() == "new"
+
+    # a process that died between the renames left one hour moved aside and
+    # another both moved aside and replaced
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    os.rename(target, f"{target}{mrms_tiles.OLD}{dead.pid}")
+    os.makedirs(os.path.join(root, "06"))
+    os.makedirs(os.path.join(root, f"06{mrms_tiles.OLD}{dead.pid}"))
+    running = os.path.join(root, f"07{mrms_tiles.OLD}{os.getpid()}")
+    os.makedirs(running)
+    os.makedirs(os.path.join(root, "08.partial"))
+    mrms_tiles.swap_dir(os.path.join(root, "08.partial"), os.path.join(root, "08"))
+    assert sorted(os.listdir(root)) == ["05", "06", "07" + mrms_tiles.OLD + str(os.getpid()), "08"]
+    assert open(os.path.join(target, "x-3-1")).read() == "new"